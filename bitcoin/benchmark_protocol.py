@@ -0,0 +1,151 @@
+"""
+Microbenchmark of the decoding of the messages received while crawling.
+
+- addr/addrv2: it builds 1000-entry addr and addrv2 messages (the size of a reply to getaddr) and measures the time
+  needed to decode them with the per-field BytesIO decoder the crawler used to rely on and with the memoryview-based
+  decoder of deserialize_addr_payload, returning either dicts or compact tuples. The encoding of .onion addresses is
+  memoized by both decoders, as it is when crawling (the same addresses are advertised by many nodes).
+- relay traffic: it measures the time needed to handle the inv and block messages a node may send unsolicited, when
+  every payload is decoded and when only the payloads needed to crawl are (decode_commands=CRAWL_COMMANDS).
+
+Run it with `python benchmark_protocol.py [--repeat N]`.
+"""
+import network_decentralization.protocol as network_proto
+from io import BytesIO
+import argparse
+import random
+import struct
+import timeit
+
+ADDR_COUNT = 1000
+INV_COUNT = 500
+BLOCK_TX_COUNT = 200
+
+
+def make_addr_list(count, version=None):
+    """
+    Generates random addresses: mostly IPv4, some IPv6 and, for addrv2, some Tor v3 addresses.
+    :returns: list of (timestamp, services, ip, port) tuples
+    """
+    rng = random.Random(0)
+    addr_list = []
+    for idx in range(count):
+        if version == 2 and idx % 10 == 0:
+            pubkey = bytes(rng.getrandbits(8) for _ in range(32))
+            ip = network_proto.addr_to_onion_v3(pubkey)
+        elif idx % 4 == 0:
+            ip = ':'.join(f'{rng.getrandbits(16):x}' for _ in range(8))
+        else:
+            ip = '.'.join(str(rng.randint(1, 254)) for _ in range(4))
+        addr_list.append((rng.getrandbits(32), rng.choice([1, 1033, 3081]), ip, rng.choice([8333, 18333])))
+    return addr_list
+
+
+def make_msg(serializer, command, payload):
+    """
+    Builds a message from its payload, for the commands serialize_msg does not support.
+    """
+    return b''.join([
+        serializer.magic_number,
+        command + b'\x00' * (12 - len(command)),
+        struct.pack('<I', len(payload)),
+        network_proto.sha256(network_proto.sha256(payload))[:4],
+        payload,
+    ])
+
+
+def make_block_msg(serializer, tx_count):
+    """
+    Builds a block message with tx_count transactions of two inputs and two outputs.
+    """
+    rng = random.Random(0)
+    tx_in = {'prev_out_index': 0, 'script_length': 107, 'script': bytes(107), 'sequence': 0xFFFFFFFF}
+    tx_out = {'value': 50000, 'script_length': 25, 'script': bytes(25)}
+    txs = []
+    for _ in range(tx_count):
+        tx = {
+            'version': 2,
+            'tx_in_count': 2,
+            'tx_in': [dict(tx_in, prev_out_hash=f'{rng.getrandbits(256):064x}') for _ in range(2)],
+            'tx_out_count': 2,
+            'tx_out': [tx_out, tx_out],
+            'lock_time': 0,
+        }
+        txs.append(serializer.serialize_tx_payload(tx))
+    header = struct.pack('<I', 2) + bytes(64) + struct.pack('<III', 0, 0, 0)
+    payload = header + serializer.serialize_int(tx_count) + b''.join(txs)
+    return make_msg(serializer, b'block', payload)
+
+
+def legacy_deserialize_addr_payload(serializer, data, version=None):
+    """
+    The decoder that reads every field of every address from a BytesIO, kept as the baseline of the benchmark.
+    """
+    data = BytesIO(data)
+    msg = {'count': serializer.deserialize_int(data), 'addr_list': []}
+    for _ in range(msg['count']):
+        msg['addr_list'].append(serializer.deserialize_network_address(data, has_timestamp=True, version=version))
+    return msg
+
+
+def bench(label, func, repeat, baseline=None):
+    """
+    Times func and prints the mean time per call.
+    :returns: the mean time per call, in seconds
+    """
+    number = 20
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    speedup = f' ({baseline / best:.1f}x)' if baseline else ''
+    print(f'\t{label:<28} {best * 1e6:10.1f} us/msg{speedup}')
+    return best
+
+
+def bench_addr(repeat):
+    serializer = network_proto.Serializer()
+    tuple_serializer = network_proto.Serializer(addr_format='tuple')
+    for command, version in [(b'addr', None), (b'addrv2', 2)]:
+        addr_list = make_addr_list(ADDR_COUNT, version)
+        msg = serializer.serialize_msg(command=command, addr_list=addr_list)
+        payload = msg[network_proto.HEADER_LEN:]
+
+        expected = legacy_deserialize_addr_payload(serializer, payload, version)
+        assert serializer.deserialize_addr_payload(payload, version) == expected
+        records = tuple_serializer.deserialize_addr_payload(payload, version)['addr_list']
+        assert [network_proto.addr_record_to_dict(record) for record in records] == expected['addr_list']
+
+        print(f'{command.decode()} message with {ADDR_COUNT} addresses ({len(msg):,} bytes)')
+        baseline = bench('BytesIO decoder', lambda: legacy_deserialize_addr_payload(serializer, payload, version),
+                         repeat)
+        bench('memoryview decoder (dicts)', lambda: serializer.deserialize_addr_payload(payload, version),
+              repeat, baseline)
+        bench('memoryview decoder (tuples)', lambda: tuple_serializer.deserialize_addr_payload(payload, version),
+              repeat, baseline)
+        bench('full message (tuples)', lambda: tuple_serializer.deserialize_msg(msg), repeat, baseline)
+
+
+def bench_relay(repeat):
+    serializer = network_proto.Serializer()
+    crawl_serializer = network_proto.Serializer(decode_commands=network_proto.CRAWL_COMMANDS)
+    inventory = [(1, f'{idx:064x}') for idx in range(INV_COUNT)]
+    msgs = [
+        (f'inv message with {INV_COUNT} items', serializer.serialize_msg(command=b'inv', inventory=inventory)),
+        (f'block message with {BLOCK_TX_COUNT} txs', make_block_msg(serializer, BLOCK_TX_COUNT)),
+    ]
+    for label, msg in msgs:
+        assert crawl_serializer.deserialize_msg(msg)[0]['length'] == serializer.deserialize_msg(msg)[0]['length']
+        print(f'{label} ({len(msg):,} bytes)')
+        baseline = bench('all payloads decoded', lambda: serializer.deserialize_msg(msg), repeat)
+        bench('crawl payloads decoded', lambda: crawl_serializer.deserialize_msg(msg), repeat, baseline)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the decoding of the messages received while crawling.')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed rounds (the best one is reported)')
+    args = parser.parse_args()
+
+    bench_addr(args.repeat)
+    bench_relay(args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,74 @@
-import json
-import pathlib
-import os
 import network_decentralization.helper as hlp
+from network_decentralization.store import chunks
+import multiprocessing
 import logging
+import os
+import time
 
 logging.basicConfig(format='[%(asctime)s] %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', level=logging.INFO)
 
+RETIRE_BATCH_SIZE = 1000
+SHARDS_PER_PROCESS = 4
+
+
+def find_inactive_shard(ledger, node_ips, last_time_active):
+    """
+    Reads the last entries of a subset of the nodes (executed in a worker process).
+    :returns: the ip addresses of the nodes that were not reachable in any of their last last_time_active entries
+    """
+    active = set()
+    for node_ip, entries in hlp.get_store().iter_tails(ledger, last_time_active, node_ips):
+        if any(entry['status'] for entry in entries):
+            active.add(node_ip)
+    return [node_ip for node_ip in node_ips if node_ip not in active]
+
+
+def find_inactive_shard_star(args):
+    return find_inactive_shard(*args)
+
+
+def find_inactive_from_history(ledger, node_ips, last_time_active):
+    """
+    Finds the inactive nodes by reading the last entries of every node, sharding the nodes across worker processes.
+    """
+    processes = os.cpu_count() or 1
+    shard_size = max(1, -(-len(node_ips) // (processes * SHARDS_PER_PROCESS)))
+    args = [(ledger, shard, last_time_active) for shard in chunks(node_ips, shard_size)]
+    non_active = set()
+    with multiprocessing.Pool(processes=processes) as pool:
+        for idx, shard_non_active in enumerate(pool.imap_unordered(find_inactive_shard_star, args)):
+            print(f'{ledger} - parsed {idx + 1:,}/{len(args):,} shards', end='\r')
+            non_active.update(shard_non_active)
+    return non_active
+
+
+def find_inactive_from_index(ledger, node_ips, last_time_active):
+    """
+    Finds the inactive nodes using the node index. Nodes missing from the index are kept.
+    """
+    return hlp.get_node_index(ledger).inactive_nodes(ledger, last_time_active) & set(node_ips)
+
+
 def main():
     LEDGERS = hlp.get_ledgers()
     last_time_active = hlp.get_active()
+    cleanup_source = hlp.get_cleanup_source()
+    store = hlp.get_store()
 
     for ledger in LEDGERS:
-        active = set()
+        start = time.time()
         logging.info(f'Parsing {ledger}')
-        output_dir = hlp.get_output_directory(ledger)
-        filenames = list(pathlib.Path(output_dir).iterdir())
-        logging.info(f'{ledger} - {len(filenames):,} total nodes')
-        for idx, filename in enumerate(filenames):
-            print(f'{ledger} - parsed {idx:,}/{len(filenames):,} files ({100*idx/len(filenames):.2f}%)', end='\r')
-            if filename.is_file() and not str(filename).endswith('.swp'):
-                with open(filename) as f:
-                    entries = json.load(f)
-                    len_entries = len(entries)
-                    if len_entries < last_time_active:
-                        for nb in range(len_entries):
-                            if (entries[len_entries-nb-1])['status']:
-                                active.add(filename)
-                                break
-                    else:
-                        for nbr in range(last_time_active):
-                            if (entries[len_entries-nbr-1])['status']:
-                                active.add(filename)
-                                break
-        non_active = set(filenames) - active
-        logging.info(f'cleanup_dead_nodes.py: {ledger} - {len(active):,} active nodes')
+        node_ips = store.list_nodes(ledger)
+        logging.info(f'{ledger} - {len(node_ips):,} total nodes')
+        if cleanup_source == 'history':
+            non_active = find_inactive_from_history(ledger, node_ips, last_time_active)
+        else:
+            non_active = find_inactive_from_index(ledger, node_ips, last_time_active)
+        logging.info(f'cleanup_dead_nodes.py: {ledger} - {len(node_ips) - len(non_active):,} active nodes')
         logging.info(f'cleanup_dead_nodes.py: {ledger} - {len(non_active):,} never active nodes')
-        for filename in non_active: # move inactive node files to dead_nodes folder
-            f_name = os.path.basename(filename)
-            new_path = hlp.get_output_directory(ledger, True) / f_name
-            os.rename(filename, new_path)
+        for batch in chunks(sorted(non_active), RETIRE_BATCH_SIZE):
+            store.retire_nodes(ledger, batch)  # move inactive nodes to the dead nodes
+        logging.info(f'cleanup_dead_nodes.py: {ledger} - done in {time.time() - start:.1f} secs')
 
 
 if __name__ == '__main__':
@@ -1,4 +1,4 @@
-from network_decentralization.collect import crawl_network
+from network_decentralization.collect import crawl_network, crawl_networks
 from random import randint, shuffle
 import network_decentralization.helper as hlp
 import time
@@ -11,12 +11,15 @@ def main():
     ledgers = hlp.get_ledgers()
     shuffle(ledgers)
 
-    timings = {}
-    for ledger in ledgers:
-        start = time.time()
-        crawl_network(ledger)
-        total_time = time.time() - start
-        timings[ledger] = total_time
+    if hlp.get_multi_ledger_crawl():
+        timings = crawl_networks(ledgers)
+    else:
+        timings = {}
+        for ledger in ledgers:
+            start = time.time()
+            crawl_network(ledger)
+            total_time = time.time() - start
+            timings[ledger] = total_time
 
     print(2*'----------------\n')
     for ledger in ledgers:
@@ -0,0 +1,59 @@
+"""
+Imports the node histories kept as one JSON file per node (output/<ledger>/<ip> and output/dead_nodes/<ledger>/<ip>)
+into the SQLite observation store. Nodes already present in the SQLite store are skipped, so the script can be re-run
+safely. Once it has completed, set `storage: sqlite` in config.yaml.
+"""
+from network_decentralization.store import JsonStore, SqliteStore, SQLITE_FILENAME
+from network_decentralization.node_index import NodeIndex
+import network_decentralization.helper as hlp
+import time
+import logging
+
+logging.basicConfig(format='[%(asctime)s] %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', level=logging.INFO)
+
+BATCH_SIZE = 1000  # Number of nodes written per transaction
+
+
+def migrate_ledger(source, target, ledger, dead=False):
+    """
+    Copies the histories of all nodes of a ledger from a JSON store to an SQLite store.
+    :param source: the JsonStore to read from
+    :param target: the SqliteStore to write to
+    :param ledger: the ledger of the nodes
+    :param dead: optional, if set then the nodes are written to the dead nodes of the target store
+    :returns: the number of migrated nodes
+    """
+    table = 'dead_observations' if dead else 'observations'
+    is_migrated = target.is_retired if dead else target.has_node
+    node_ips = source.list_nodes(ledger)
+    batch, migrated = [], 0
+    for idx, (node_ip, entries) in enumerate(source.iter_histories(ledger, node_ips)):
+        print(f'{ledger} - migrated {idx:,}/{len(node_ips):,} nodes ({100*idx/len(node_ips):.2f}%)', end='\r')
+        if not entries or is_migrated(ledger, node_ip):
+            continue
+        batch.extend(dict(entry, ledger=ledger, ip=node_ip) for entry in entries)
+        migrated += 1
+        if migrated % BATCH_SIZE == 0:
+            target.write(batch, table)
+            batch = []
+    if batch:
+        target.write(batch, table)
+    return migrated
+
+
+def main():
+    output_dir = hlp.get_output_directory()
+    target = SqliteStore(output_dir / SQLITE_FILENAME)
+    index = NodeIndex(output_dir / SQLITE_FILENAME)
+    for ledger in hlp.get_ledgers():
+        start = time.time()
+        migrated = migrate_ledger(JsonStore(output_dir), target, ledger)
+        dead = migrate_ledger(JsonStore(output_dir / 'dead_nodes'), target, ledger, dead=True)
+        index.invalidate(ledger)  # The index is rebuilt on its next use
+        logging.info(f'migrate_store.py: {ledger} - {migrated:,} nodes and {dead:,} dead nodes migrated in {time.time() - start:.0f} secs')
+    target.close()
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,56 +1,110 @@
 import network_decentralization.protocol as network_proto
 from network_decentralization.constants import MAGIC_NUMBERS, PROTOCOL_VERSIONS
+from network_decentralization.frontier import Frontier, get_lane
+from network_decentralization.store import ObservationSink
 import network_decentralization.helper as hlp
+import asyncio
 import socket
 import json
 import time
 from itertools import repeat
 import multiprocessing
+import queue
 import logging
 import os
 
 logging.basicConfig(format='[%(asctime)s] %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', level=logging.INFO)
 
 
-def get_node_addresses(ledger, node_ip, node_port):
+NETWORK_TYPES = {
+    1: 'ipv4',
+    2: 'ipv6',
+    3: 'onion',
+    4: 'onion',
+}
+
+# Defaults of the Tor lane of the crawl (tor in config.yaml)
+TOR_PROXY = ('127.0.0.1', 9050)
+TOR_MAX_IN_FLIGHT = 100
+TOR_PROCESSES = 10
+TOR_HANDSHAKE_TIMEOUT = 30
+TOR_GETADDR_TIMEOUT = 30
+
+
+def get_addresses(addr_msgs):
+    """
+    Extracts the addresses advertised by a node from its addr/addrv2 messages.
+    :param addr_msgs: the addr messages returned by Connection.getaddr, with addresses decoded as compact tuples
+    (addr_format='tuple')
+    :returns: a set of (ip, port, services, timestamp, ip_type) tuples
+    """
+    addresses = set()
+    for addr_msg in addr_msgs or []:
+        for network_id, timestamp, services, address, port in addr_msg['addr_list']:
+            addresses.add((address, port, services, timestamp, NETWORK_TYPES[network_id]))
+    return addresses
+
+
+def get_connection_kwargs(ledger, node_ip, connect_timeout=None):
+    """
+    Retrieves the keyword arguments of the connection made to crawl a node. Only the payloads of the messages needed
+    to crawl are decoded, and advertised addresses are decoded as compact tuples. Onion nodes are connected to through
+    the Tor proxy, with the longer deadlines of the Tor lane.
+    :param ledger: the ledger of the node, which defines the magic number and protocol version of the connection
+    :param node_ip: the ip address of the node
+    :param connect_timeout: optional, the number of seconds after which opening the connection is given up
+    :returns: dictionary
+    """
+    kwargs = dict(
+        hlp.get_connection_parameters(),
+        magic_number=MAGIC_NUMBERS[ledger],
+        protocol_version=PROTOCOL_VERSIONS[ledger],
+        addr_format='tuple',
+        decode_commands=network_proto.CRAWL_COMMANDS)
+    if get_lane(node_ip) == 'onion':
+        tor = hlp.get_tor_parameters()
+        kwargs['proxy'] = tuple(tor.get('proxy', TOR_PROXY))
+        kwargs['handshake_timeout'] = tor.get('handshake_timeout', TOR_HANDSHAKE_TIMEOUT)
+        kwargs['getaddr_timeout'] = tor.get('getaddr_timeout', TOR_GETADDR_TIMEOUT)
+    if connect_timeout:
+        kwargs['connect_timeout'] = connect_timeout
+    return kwargs
+
+
+def get_node_addresses(ledger, node_ip, node_port, connect_timeout=None):
     """
-    Connects to the node, retrieves information about it from received packets and updates the node's file.
+    Connects to the node and retrieves information about it from received packets. The observation made is returned
+    rather than written, so that it is written by the single writer of the crawl (see ObservationSink).
     :param ledger: the ledger of the node
     :param node_ip: the ip address of the node
     :param node_port: the port of the node
+    :param connect_timeout: optional, the number of seconds after which opening the connection is given up
+    :returns: a tuple of the observation made (see hlp.make_observation), whose addresses are those returned by
+    get_addresses, and the number of seconds it took to open the connection (None if it could not be opened or the
+    handshake did not complete, i.e. the node was not reached). If the proxy of the node (Tor) is unavailable, the node
+    is not attempted and (None, None) is returned.
     """
-    network_types = {
-        1: 'ipv4',
-        2: 'ipv6',
-        3: 'onion',
-        4: 'onion',
-    }
-
-    proxy = None
-    if node_ip.endswith('onion'):
-        proxy = ('127.0.0.1', 9050)
-
-    version, protocol, addresses = None, None, set()
+    version, protocol, addresses, connect_time = None, None, set(), None
+    conn = None
     try:
-        if proxy:
-            conn = network_proto.Connection((node_ip, node_port), proxy=proxy)
-        else:
-            conn = network_proto.Connection((node_ip, node_port))
+        conn = network_proto.Connection((node_ip, node_port), **get_connection_kwargs(ledger, node_ip, connect_timeout))
+        start = time.monotonic()
         conn.open()
+        opened = time.monotonic() - start
         version_msg = conn.handshake()
+        connect_time = opened  # Only a node that completes the handshake is reached
         version = version_msg['user_agent']
         protocol = version_msg['version']
 
         addr_msgs = conn.getaddr()
         conn.ping()
 
-        if addr_msgs:
-            for msg in addr_msgs[0]['addr_list']:
-                network_id = msg['network_id']
-                ip_type = network_types[network_id]
-                addresses.add((msg[ip_type], msg['port'], msg['services'], msg['timestamp'], ip_type))
+        addresses = get_addresses(addr_msgs)
 
         logging.debug(f'{ledger} {node_ip}:{node_port} - Version {version}, Addresses {len(addresses)}')
+    except network_proto.ProxyUnavailable as err:
+        logging.debug(f'{ledger} {node_ip}:{node_port} - {err}')
+        return None, None  # The node was not attempted: nothing is observed about it
     except (network_proto.ProtocolError, network_proto.ConnectionError, socket.error) as err:
         logging.debug(f'{ledger} {node_ip}:{node_port} - {err}')
     except network_proto.UnsupportedNetworkIdError as err:
@@ -63,38 +117,282 @@ def get_node_addresses(ledger, node_ip, node_port):
     except KeyError:
         logging.debug(f'{ledger} {node_ip}:{node_port} - Could not connect.')
     finally:
-        conn.close()
+        if conn:
+            conn.close()
 
-    hlp.update_node(ledger, node_ip, node_port, version, addresses, protocol)
+    return hlp.make_observation(ledger, node_ip, node_port, version, addresses, protocol), connect_time
 
 
-def crawl_network(ledger):
+async def get_node_addresses_async(ledger, node_ip, node_port, connect_timeout=None):
     """
-    Crawls the network. Connects to nodes to collect information about them. 
-    :param ledger: the ledger to crawl
+    Asyncio counterpart of get_node_addresses.
+    :param ledger: the ledger of the node
+    :param node_ip: the ip address of the node
+    :param node_port: the port of the node
+    :param connect_timeout: optional, the number of seconds after which opening the connection is given up
+    :returns: a tuple of the observation made (see hlp.make_observation), whose addresses are those returned by
+    get_addresses, and the number of seconds it took to open the connection (None if it could not be opened or the
+    handshake did not complete)
     """
-    network_proto.MAGIC_NUMBER = MAGIC_NUMBERS[ledger]
-    network_proto.PROTOCOL_VERSION = PROTOCOL_VERSIONS[ledger]
+    version, protocol, addresses, connect_time = None, None, set(), None
+    conn = network_proto.AsyncConnection(
+        (node_ip, node_port), **get_connection_kwargs(ledger, node_ip, connect_timeout))
+    loop = asyncio.get_running_loop()
+    try:
+        start = loop.time()
+        await conn.open()
+        opened = loop.time() - start
+        version_msg = await conn.handshake()
+        connect_time = opened  # Only a node that completes the handshake is reached
+        version = version_msg['user_agent']
+        protocol = version_msg['version']
+
+        addr_msgs = await conn.getaddr()
+        await conn.ping()
+
+        addresses = get_addresses(addr_msgs)
+
+        logging.debug(f'{ledger} {node_ip}:{node_port} - Version {version}, Addresses {len(addresses)}')
+    except network_proto.ProxyUnavailable as err:
+        logging.debug(f'{ledger} {node_ip}:{node_port} - {err}')
+        return None, None  # The node was not attempted: nothing is observed about it
+    except (network_proto.ProtocolError, network_proto.ConnectionError, socket.error,
+            asyncio.TimeoutError, asyncio.IncompleteReadError) as err:
+        logging.debug(f'{ledger} {node_ip}:{node_port} - {err!r}')
+    except KeyError:
+        logging.debug(f'{ledger} {node_ip}:{node_port} - Could not connect.')
+    finally:
+        await conn.close()
+
+    return hlp.make_observation(ledger, node_ip, node_port, version, addresses, protocol), connect_time
 
-    concurrency = hlp.get_concurrency()
 
+async def crawl_frontier_async(frontier, reachability, max_in_flight, on_done):
+    """
+    Crawls the nodes of the frontier from a single process. Each lane of the frontier (clearnet, onion) has its own
+    workers, so that slow Tor circuits do not hold up clearnet connections. Returns once the frontier is empty (or its
+    budget exhausted) and no connection is left in flight, as a node still being crawled may advertise new nodes.
+    :param frontier: the Frontier of the crawl
+    :param reachability: the Reachability that provides the connect timeouts
+    :param max_in_flight: dictionary mapping each lane to its maximum number of simultaneous connections
+    :param on_done: function called once each node has been crawled, with its (ledger, ip, port) tuple, the observation
+    made (None if the proxy of the node was unavailable or the crawl failed unexpectedly) and the time it took to
+    connect to it, as returned by get_node_addresses
+    """
+    in_flight = 0
+    pushed = {lane: asyncio.Condition() for lane in max_in_flight}
+    lanes = [lane for lane, count in max_in_flight.items() if count]
+
+    def drained():
+        # A node of any lane may advertise nodes of the other lanes, so workers wait as long as any lane has work
+        return frontier.exhausted or not any(frontier.size(lane) for lane in lanes)
+
+    async def notify(count):
+        for condition in pushed.values():
+            async with condition:
+                if in_flight == 0:
+                    condition.notify_all()
+                else:
+                    condition.notify(count)
+
+    async def worker(lane):
+        # Only max_in_flight coroutines exist at any time regardless of the number of nodes to crawl. Idle workers
+        # wait for nodes to be pushed to their lane of the frontier.
+        nonlocal in_flight
+        while True:
+            target = frontier.pop(lane)
+            if target is None:
+                if in_flight == 0 and drained():
+                    await notify(0)  # Wakes up the idle workers of every lane, which return as well
+                    return
+                async with pushed[lane]:
+                    if not frontier.size(lane) and not (in_flight == 0 and drained()):
+                        await pushed[lane].wait()
+                continue
+            ledger, node_ip, node_port = target
+            in_flight += 1
+            observation, connect_time = None, None
+            try:
+                observation, connect_time = await get_node_addresses_async(
+                    ledger, node_ip, node_port, reachability.connect_timeout(node_ip))
+            except Exception as err:
+                logging.error(f'{ledger} {node_ip}:{node_port} - Unexpected error: {err!r}')
+            in_flight -= 1
+            await notify(on_done(target, observation, connect_time))
+
+    await asyncio.gather(*[worker(lane) for lane, count in max_in_flight.items() for _ in range(count)])
+
+
+def crawl_frontier_pool(frontier, reachability, processes, on_done):
+    """
+    Crawls the nodes of the frontier with a pool of processes per lane of the frontier (clearnet, onion), keeping each
+    process busy with one node at a time. Returns once the frontier is empty (or its budget exhausted) and no node is
+    left in the pools.
+    :param frontier: the Frontier of the crawl
+    :param reachability: the Reachability that provides the connect timeouts
+    :param processes: dictionary mapping each lane to its number of processes
+    :param on_done: function called once each node has been crawled, as in crawl_frontier_async
+    """
+    results = queue.SimpleQueue()  # Callbacks run in a single thread of this process
+    pools = {lane: multiprocessing.Pool(processes=count) for lane, count in processes.items() if count}
+    in_flight = {lane: 0 for lane in pools}
+    try:
+        while True:
+            for lane, pool in pools.items():
+                while in_flight[lane] < 2 * processes[lane]:
+                    target = frontier.pop(lane)
+                    if target is None:
+                        break
+                    pool.apply_async(get_node_addresses, args=target + (reachability.connect_timeout(target[1]),),
+                                     callback=lambda result, target=target: results.put((target, result)),
+                                     error_callback=lambda _, target=target: results.put((target, (None, None))))
+                    in_flight[lane] += 1
+            if not any(in_flight.values()):
+                break
+            target, (observation, connect_time) = results.get()
+            in_flight[get_lane(target[1])] -= 1
+            on_done(target, observation, connect_time)
+    finally:
+        for pool in pools.values():
+            pool.terminate()
+
+
+def raise_open_files_limit(required):
+    """
+    Raises the soft limit of open file descriptors of the process (up to the hard limit) so that the asyncio crawler
+    can keep the requested number of sockets open.
+    :param required: the number of file descriptors needed
+    """
+    try:
+        import resource
+    except ImportError:  # Not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = required if hard == resource.RLIM_INFINITY else min(required, hard)
+    if soft != resource.RLIM_INFINITY and soft < target:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        logging.info(f'Raised open files limit from {soft} to {target}')
+
+
+def get_targets(ledger, reachability):
+    """
+    Retrieves the nodes to crawl: the known nodes or, if scheduling is enabled, those likely to answer (see
+    Reachability.schedule).
+    :param ledger: the ledger to crawl
+    :param reachability: the Reachability of the crawled endpoints
+    :returns: list of distinct (ip, port) pairs
+    """
     logging.info(f'Collecting {ledger} known nodes')
     known_nodes = hlp.get_known_nodes(ledger)
     logging.info(f'{len(known_nodes)} {ledger} nodes found')
 
+    targets = []
     parsed_nodes = set()
-
-    pool = multiprocessing.Pool(processes=concurrency)
-    jobs = []
     for node in known_nodes:
         node_ip = node[0]
         node_port = node[1]
         if (node_ip, node_port) not in parsed_nodes:
-            p = pool.apply_async(get_node_addresses, args=(ledger, node_ip, node_port))
-            jobs.append(p)
-
+            targets.append((node_ip, node_port))
             parsed_nodes.add((node_ip, node_port))
-    [p.wait() for p in jobs]
+
+    schedule_parameters = hlp.get_schedule_parameters()
+    if schedule_parameters is not None:
+        scheduled = reachability.schedule(ledger, targets, **schedule_parameters)
+        logging.info(f'{ledger} - scheduled {len(scheduled)} of the {len(targets)} known nodes')
+        return scheduled
+    return targets
+
+
+def interleave(targets):
+    """
+    Merges the nodes of several ledgers in round-robin order, so that all ledgers are crawled at the same pace.
+    :param targets: dictionary mapping ledgers to lists of (ip, port) pairs
+    :returns: generator of (ledger, ip, port) tuples
+    """
+    iterators = [(ledger, iter(nodes)) for ledger, nodes in targets.items()]
+    while iterators:
+        remaining = []
+        for ledger, nodes in iterators:
+            node = next(nodes, None)
+            if node is not None:
+                yield (ledger,) + tuple(node)
+                remaining.append((ledger, nodes))
+        iterators = remaining
+
+
+def crawl_networks(ledgers):
+    """
+    Crawls the networks of several ledgers at once. The nodes of all ledgers share the same worker budget:
+    max_in_flight connections with the asyncio crawl engine, concurrency processes with the multiprocessing one.
+    The crawl starts from the known nodes and, if discovery is enabled, the addresses advertised by the crawled nodes
+    are crawled in the same run (see Frontier). It ends when no node is left to crawl or the budget of the run is
+    exhausted.
+    :param ledgers: list of ledgers to crawl
+    :returns: dictionary mapping each ledger to the number of seconds after which its last node had been crawled
+    """
+    start = time.time()
+    reachability = hlp.get_reachability()
+    hlp.resolve_dns_seeds(ledgers)
+    frontier = Frontier(exclude=reachability.is_backed_off, **hlp.get_frontier_parameters())
+    for ledger, node_ip, node_port in interleave({ledger: get_targets(ledger, reachability) for ledger in ledgers}):
+        frontier.push(ledger, node_ip, node_port)
+
+    # Workers only talk to the nodes: their observations are written by a single writer thread of this process.
+    sink = ObservationSink(hlp.get_store(), **hlp.get_sink_parameters())
+    discovery = hlp.get_frontier_discovery()
+    crawled = {ledger: 0 for ledger in ledgers}
+    discovered = {ledger: 0 for ledger in ledgers}
+    unattempted = {ledger: 0 for ledger in ledgers}
+    timings = {ledger: 0 for ledger in ledgers}
+
+    def on_done(target, observation, connect_time):
+        ledger, node_ip, node_port = target
+        crawled[ledger] += 1
+        timings[ledger] = time.time() - start
+        if observation is None:  # Proxy unavailable or unexpected error: says nothing about the node's reachability
+            unattempted[ledger] += 1
+            return 0
+        sink.put(observation)
+        if connect_time is None:
+            reachability.record_failure(ledger, node_ip, node_port)
+        else:
+            reachability.record_success(ledger, node_ip, node_port, connect_time)
+        added = frontier.push_addresses(ledger, observation['addresses']) if discovery else 0
+        discovered[ledger] += added
+        return added
+
+    tor = hlp.get_tor_parameters()
+    try:
+        if hlp.get_crawl_engine() == 'asyncio':
+            max_in_flight = {'clearnet': hlp.get_max_in_flight(), 'onion': tor.get('max_in_flight', TOR_MAX_IN_FLIGHT)}
+            raise_open_files_limit(sum(max_in_flight.values()) + 256)
+            asyncio.run(crawl_frontier_async(frontier, reachability, max_in_flight, on_done))
+        else:
+            processes = {'clearnet': hlp.get_concurrency(), 'onion': tor.get('processes', TOR_PROCESSES)}
+            crawl_frontier_pool(frontier, reachability, processes, on_done)
+    finally:
+        sink.close()
+        reachability.flush()
+    logging.info(f'Wrote {sink.written} observations in {sink.batches} batches')
+
+    if frontier.exhausted:
+        logging.info(f'Crawl budget exhausted, {len(frontier)} nodes left uncrawled')
+    if frontier.excluded:
+        logging.info(f'Skipped {frontier.excluded} nodes that could not be reached recently')
+    for ledger in ledgers:
+        logging.info(f'{ledger} - crawled {crawled[ledger]} nodes ({discovered[ledger]} discovered during the crawl)')
+        if unattempted[ledger]:
+            logging.warning(f'{ledger} - {unattempted[ledger]} nodes could not be attempted (proxy unavailable or '
+                            f'unexpected error)')
+    return timings
+
+
+def crawl_network(ledger):
+    """
+    Crawls the network. Connects to nodes to collect information about them. 
+    :param ledger: the ledger to crawl
+    """
+    crawl_networks([ledger])
 
 
 def collect_geodata(ledger):
@@ -115,17 +413,37 @@ def collect_geodata(ledger):
         logging.info(f'JSONDecodeError: {filename}')
         geodata = {}
 
+    cache = hlp.get_geodata_cache()
+    cache.import_file(filename)  # Entries collected before the shared cache was introduced
+
     nodes = hlp.get_reachable_nodes(ledger)
     logging.info(f'{ledger} - Got {len(nodes)} nodes')
-    for node in nodes:
-        node_ip = node[0]
-        if node_ip not in geodata.keys() and not node_ip.endswith('onion'):
-            geodata[node_ip] = hlp.get_ip_geodata(node_ip)
-            with open(filename, 'w') as f:
-                json.dump(geodata, f, indent=4)
-
-            logging.debug(f'{ledger} - Collected geodata for {node_ip}')
-            time.sleep(5)  # Sleep to avoid getting rate limited
+    node_ips = {node[0] for node in nodes if not node[0].endswith('onion')}
+    new_ips = cache.missing(node_ips)
+    ip_ranges, ip_ranges_mode = hlp.get_ip_ranges(), hlp.get_ip_ranges_mode()
+    offline = {}
+    if ip_ranges_mode == 'primary':
+        offline = {ip: ip_ranges.lookup(ip) for ip in new_ips}
+        offline = {ip: data for ip, data in offline.items() if data is not None}
+        new_ips = [ip for ip in new_ips if ip not in offline]
+        logging.info(f'{ledger} - Resolved {len(offline)} new nodes from the local IP ranges')
+    logging.info(f'{ledger} - Geolocating {len(new_ips)} new nodes')
+    batch = hlp.get_geolocation_batch()
+    for node_ip, data in hlp.get_geolocation_client().lookup_many(new_ips, batch=batch):
+        if data is None:
+            data = ip_ranges.lookup(node_ip) if ip_ranges_mode == 'fallback' else None
+            if data is not None:
+                offline[node_ip] = data
+            continue  # Retried on the next run
+        cache.put(node_ip, data)
+        logging.debug(f'{ledger} - Collected geodata for {node_ip}')
+    cache.flush()
+
+    geodata.update(offline)  # Not cached, so that the APIs are tried again on the next run
+    geodata.update(cache.get_many(node_ips))
+    with open(filename.with_suffix('.backup'), 'w') as f:
+        json.dump(geodata, f, indent=4)
+    os.replace(filename.with_suffix('.backup'), filename)
 
 
 def get_os_info(node, osdata, ledger, all_nodes):
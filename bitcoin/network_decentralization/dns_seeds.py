@@ -0,0 +1,113 @@
+"""
+Concurrent resolution of the DNS seeds of the ledgers (seed_info/<ledger>.json).
+
+The A and AAAA records of all seeds are queried at the same time on a pool of threads that share one resolver, each
+query being given up after a timeout. Answers are kept in a local cache for as long as their TTL allows, and the cache
+is persisted between runs. Names without records are cached for NEGATIVE_TTL seconds. When a query fails (e.g. times
+out), the last known answer is used even if it has expired, since the addresses of a seed rarely all go away at once.
+
+The nameservers (and their port) can be configured, so the resolver can be pointed at a local stub server.
+"""
+import json
+import logging
+import os
+import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dns.exception
+import dns.resolver
+
+RECORD_TYPES = ('A', 'AAAA')
+DEFAULT_TIMEOUT = 2
+DEFAULT_MAX_WORKERS = 32
+NEGATIVE_TTL = 300  # Seconds during which a name without records of a type is not queried again
+
+
+class SeedResolver(object):
+    """
+    :param cache_path: the path of the JSON file that holds the cache
+    :param nameservers: optional, the addresses of the nameservers to query (default: those of the system)
+    :param port: optional, the port of the nameservers
+    :param timeout: optional, the number of seconds after which a query is given up
+    :param max_workers: optional, the maximum number of concurrent queries
+    """
+
+    def __init__(self, cache_path, nameservers=None, port=53, timeout=DEFAULT_TIMEOUT,
+                 max_workers=DEFAULT_MAX_WORKERS):
+        self.cache_path = pathlib.Path(cache_path)
+        try:
+            self.resolver = dns.resolver.Resolver(configure=not nameservers)
+        except dns.resolver.NoResolverConfiguration:
+            logging.warning('No nameserver configured: only the cached DNS seed answers are used')
+            self.resolver = dns.resolver.Resolver(configure=False)
+        if nameservers:
+            self.resolver.nameservers = list(nameservers)
+        self.resolver.port = port
+        self.resolver.timeout = timeout
+        self.resolver.lifetime = timeout
+        self.max_workers = max_workers
+        try:
+            with open(self.cache_path) as f:
+                self.cache = json.load(f)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            self.cache = {}
+
+    @staticmethod
+    def cache_key(name, rdtype):
+        return f'{name} {rdtype}'
+
+    def query(self, name, rdtype):
+        """
+        Queries the records of a type of a name.
+        :returns: a (addresses, ttl) tuple
+        :raises dns.exception.DNSException: if the query failed, other than because the name has no such records
+        """
+        try:
+            answer = self.resolver.resolve(name, rdtype)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            return [], NEGATIVE_TTL
+        return [rdata.to_text() for rdata in answer], answer.rrset.ttl
+
+    def resolve_many(self, names):
+        """
+        Resolves the A and AAAA records of the given names concurrently, using the cached answers that have not expired.
+        :param names: iterable of hostnames
+        :returns: dictionary mapping each name to the list of its addresses
+        """
+        names = list(dict.fromkeys(names))
+        now = time.time()
+        queries = [
+            (name, rdtype) for name in names for rdtype in RECORD_TYPES
+            if self.cache.get(self.cache_key(name, rdtype), {}).get('expires', 0) <= now
+        ]
+        if queries:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(queries))) as executor:
+                futures = {executor.submit(self.query, name, rdtype): (name, rdtype) for name, rdtype in queries}
+            failures = 0
+            for future, (name, rdtype) in futures.items():
+                try:
+                    addresses, ttl = future.result()
+                except dns.exception.DNSException as err:
+                    failures += 1
+                    logging.debug(f'Could not resolve the {rdtype} records of {name}: {err!r}')
+                    continue  # The expired entry, if any, is used
+                self.cache[self.cache_key(name, rdtype)] = {'addresses': addresses, 'expires': now + ttl}
+            logging.info(f'Resolved {len(queries) - failures} of {len(queries)} DNS seed queries '
+                         f'({len(names) * len(RECORD_TYPES) - len(queries)} cached)')
+            self.save()
+
+        return {
+            name: [
+                address for rdtype in RECORD_TYPES
+                for address in self.cache.get(self.cache_key(name, rdtype), {}).get('addresses', [])
+            ]
+            for name in names
+        }
+
+    def save(self):
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        backup = self.cache_path.with_suffix('.backup')
+        with open(backup, 'w') as f:
+            json.dump(self.cache, f, indent=4)
+        os.replace(backup, self.cache_path)
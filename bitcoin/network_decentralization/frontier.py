@@ -0,0 +1,127 @@
+"""
+Frontier of a crawl: the nodes still to connect to in the current run.
+
+The crawl starts from the known nodes of every ledger, and the addresses advertised by the nodes it reaches are pushed
+to the frontier as they are received, so that nodes learned during the run are crawled in the same run. Every
+(ledger, ip, port) endpoint is crawled at most once per run. Endpoints are popped by priority: the more recently an
+address was advertised as seen, the sooner it is crawled, and addresses of nodes that serve the chain (NODE_NETWORK or
+NODE_NETWORK_LIMITED) get a head start. The run ends once the frontier is drained, or when its budget (number of nodes
+or duration) is exhausted.
+
+Onion endpoints, which are reached through Tor, are kept apart from the clearnet (ipv4/ipv6) ones, in their own lane,
+so that the crawler can give each lane its own workers and slow onion circuits do not hold up clearnet probing.
+"""
+import heapq
+import itertools
+import time
+
+NODE_NETWORK = 1
+NODE_NETWORK_LIMITED = 1 << 10
+# Advance (in seconds) given to the addresses of nodes that serve the chain, over more recently seen ones that do not
+FULL_NODE_BONUS = 3 * 3600
+DEFAULT_MAX_AGE_DAYS = 7
+LANES = ('clearnet', 'onion')
+
+
+def get_lane(ip):
+    """
+    :returns: the lane of an address: 'onion' or 'clearnet'
+    """
+    return 'onion' if ip.endswith('.onion') else 'clearnet'
+
+
+class Frontier(object):
+    """
+    :param budget: optional, the maximum number of nodes to pop (0: no limit)
+    :param max_duration: optional, the number of seconds after which no node is popped anymore (0: no limit)
+    :param max_age_days: optional, addresses advertised as last seen more than this number of days ago are ignored
+    :param exclude: optional, function called with the ledger, ip and port of an endpoint, that returns True if the
+    endpoint must not be crawled (e.g. Reachability.is_backed_off)
+    """
+
+    def __init__(self, budget=0, max_duration=0, max_age_days=DEFAULT_MAX_AGE_DAYS, exclude=None):
+        self.start = time.time()
+        self.budget = budget
+        self.deadline = self.start + max_duration if max_duration else None
+        self.min_timestamp = self.start - max_age_days * 86400 if max_age_days else 0
+        self.heaps = {lane: [] for lane in LANES}
+        self.seen = set()
+        self.popped = 0
+        self.exclude = exclude
+        self.excluded = 0
+        self.counter = itertools.count()  # Keeps the order of endpoints of equal priority
+
+    def __len__(self):
+        return sum(len(heap) for heap in self.heaps.values())
+
+    def size(self, lane):
+        """
+        :returns: the number of endpoints of the given lane in the frontier
+        """
+        return len(self.heaps[lane])
+
+    def priority(self, timestamp, services):
+        """
+        :returns: the priority of an address (the higher, the sooner it is crawled)
+        """
+        score = min(timestamp, self.start)  # Some nodes advertise timestamps in the future
+        if services & (NODE_NETWORK | NODE_NETWORK_LIMITED):
+            score += FULL_NODE_BONUS
+        return score
+
+    def push(self, ledger, ip, port, timestamp=None, services=0):
+        """
+        Adds an endpoint to the frontier, unless it was already added in this run.
+        :param ledger: the ledger of the node
+        :param ip: the ip address of the node
+        :param port: the port of the node
+        :param timestamp: optional, the time (seconds since the epoch) the node was last seen according to the node that
+        advertised it. Known nodes, which have none, are treated as seen at the start of the run.
+        :param services: optional, the services advertised for the node
+        :returns: True if the endpoint was added
+        """
+        if timestamp is not None and timestamp < self.min_timestamp:
+            return False
+        key = (ledger, ip, port)
+        if key in self.seen or not port:
+            return False
+        self.seen.add(key)
+        if self.exclude is not None and self.exclude(ledger, ip, port):
+            self.excluded += 1
+            return False
+        score = self.priority(self.start if timestamp is None else timestamp, services)
+        heapq.heappush(self.heaps[get_lane(ip)], (-score, next(self.counter), key))
+        return True
+
+    def push_addresses(self, ledger, addresses):
+        """
+        Adds the addresses advertised by a node to the frontier.
+        :param addresses: iterable of (ip, port, services, timestamp, ip_type) tuples, as returned by get_addresses
+        :returns: the number of endpoints added
+        """
+        return sum(self.push(ledger, ip, port, timestamp, services) for ip, port, services, timestamp, _ in addresses)
+
+    @property
+    def exhausted(self):
+        """
+        Whether the budget of the run has been used up.
+        """
+        if self.budget and self.popped >= self.budget:
+            return True
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def pop(self, lane=None):
+        """
+        :param lane: optional, the lane to pop from; by default, the endpoint with the highest priority of all lanes
+        :returns: the (ledger, ip, port) tuple of the endpoint to crawl next, or None if the frontier (lane) is empty or
+        its budget is exhausted
+        """
+        if lane is None:
+            heaps = [heap for heap in self.heaps.values() if heap]
+            heap = min(heaps, key=lambda h: h[0]) if heaps else None
+        else:
+            heap = self.heaps[lane]
+        if not heap or self.exhausted:
+            return None
+        self.popped += 1
+        return heapq.heappop(heap)[2]
@@ -1,14 +1,19 @@
+import pathlib
+import sys
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[2]))  # Root of the repository, for the shared modules
 from network_decentralization.constants import DEFAULT_PORTS
-import shutil
+from network_decentralization.store import open_store
+from network_decentralization.ip_ranges import IpRangeIndex
+from network_decentralization.reachability import Reachability
+from network_decentralization.dns_seeds import SeedResolver
+from shared.geodata_cache import GeodataCache, DEFAULT_TTL_DAYS
+from shared.geolocation import GeolocationClient
 import datetime
-import dns.resolver
 from yaml import safe_load
 import json
-import pathlib
-import requests
-import time
 import nmap3
 import logging
+import os
 
 logging.basicConfig(format='[%(asctime)s] %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', level=logging.INFO)
 
@@ -49,6 +54,14 @@ def get_active():
     """
     return get_config_data()['last_time_active']
 
+def get_cleanup_source():
+    """
+    Retrieves how cleanup_dead_nodes.py finds the inactive nodes: 'index' (from the node index) or 'history' (by
+    reading the last entries of every node)
+    :returns: string
+    """
+    return get_config_data().get('cleanup_source', 'index')
+
 def get_concurrency():
     """
     Retrieves the concurrency parameter that defines how many processes in parallel can be executed
@@ -57,6 +70,119 @@ def get_concurrency():
     return get_config_data()['execution_parameters']['concurrency']
 
 
+def get_crawl_engine():
+    """
+    Retrieves the engine used to crawl the network: 'asyncio' (a single process keeping many connections in flight) or
+    'multiprocessing' (one process per concurrent connection)
+    :returns: string
+    """
+    return get_config_data()['execution_parameters'].get('crawl_engine', 'asyncio')
+
+
+def get_max_in_flight():
+    """
+    Retrieves the maximum number of connections the asyncio crawler keeps open simultaneously
+    :returns: integer
+    """
+    return get_config_data()['execution_parameters'].get('max_in_flight', 2000)
+
+
+def get_multi_ledger_crawl():
+    """
+    Retrieves whether the ledgers are crawled concurrently, sharing the same worker budget, instead of one after the
+    other
+    :returns: boolean
+    """
+    return bool(get_config_data()['execution_parameters'].get('multi_ledger_crawl', False))
+
+
+def get_frontier_parameters():
+    """
+    Retrieves the budget of a crawl (maximum number of nodes and duration) and the maximum age of the advertised
+    addresses that are crawled, as keyword arguments for Frontier. Parameters missing from the config file fall back
+    to the defaults of the frontier module.
+    :returns: dictionary
+    """
+    params = get_config_data().get('crawl_frontier') or {}
+    keys = ['budget', 'max_duration', 'max_age_days']
+    return {key: params[key] for key in keys if params.get(key) is not None}
+
+
+def get_tor_parameters():
+    """
+    Retrieves the parameters of the Tor lane of the crawl (SOCKS5 proxy, number of simultaneous onion connections or
+    processes, deadlines of onion connections). Parameters missing from the config file fall back to the defaults of
+    the collect module.
+    :returns: dictionary
+    """
+    params = get_config_data().get('tor') or {}
+    keys = ['proxy', 'max_in_flight', 'processes', 'handshake_timeout', 'getaddr_timeout']
+    return {key: params[key] for key in keys if params.get(key) is not None}
+
+
+_reachability = None
+
+
+def get_reachability():
+    """
+    Opens (once) the reachability database of the crawled endpoints (connect times and negative cache), in the output
+    directory.
+    :returns: a Reachability
+    """
+    global _reachability
+    if _reachability is None:
+        params = get_config_data().get('reachability') or {}
+        keys = ['connect_percentile', 'connect_multiplier', 'min_connect_timeout', 'max_connect_timeout',
+                'max_onion_connect_timeout', 'backoff_hours', 'max_backoff_days']
+        _reachability = Reachability(get_output_directory() / 'reachability.db',
+                                     **{key: params[key] for key in keys if params.get(key) is not None})
+    return _reachability
+
+
+def get_schedule_parameters():
+    """
+    Retrieves the parameters used to choose the known nodes probed in each run, as keyword arguments for
+    Reachability.schedule. Parameters missing from the config file fall back to the defaults of the reachability module.
+    :returns: dictionary, or None if scheduling is disabled (all known nodes are probed)
+    """
+    params = get_config_data().get('schedule') or {}
+    if not params.get('enabled', False):
+        return None
+    keys = ['min_expected_yield', 'budget', 'explore', 'half_life_days']
+    return {key: params[key] for key in keys if params.get(key) is not None}
+
+
+def get_frontier_discovery():
+    """
+    Retrieves whether the addresses advertised by the crawled nodes are crawled in the same run
+    :returns: boolean
+    """
+    return bool((get_config_data().get('crawl_frontier') or {}).get('discovery', False))
+
+
+def get_sink_parameters():
+    """
+    Retrieves the size of the batches in which the observations of a crawl are written and the maximum time an
+    observation waits before being written, as keyword arguments for ObservationSink. Parameters missing from the
+    config file fall back to the defaults of the store module.
+    :returns: dictionary
+    """
+    params = get_config_data()['execution_parameters']
+    keys = {'write_batch_size': 'batch_size', 'write_flush_interval': 'flush_interval'}
+    return {arg: params[key] for key, arg in keys.items() if params.get(key) is not None}
+
+
+def get_connection_parameters():
+    """
+    Retrieves the deadlines and thresholds used when talking to a node, as keyword arguments for Connection.
+    Parameters missing from the config file fall back to the defaults of the protocol module.
+    :returns: dictionary
+    """
+    params = get_config_data().get('connection_parameters') or {}
+    keys = ['handshake_timeout', 'getaddr_timeout', 'getaddr_max_addrs']
+    return {key: params[key] for key in keys if params.get(key) is not None}
+
+
 def get_metrics_network():
     """
     Retrieves the list of metrics to compute for network analysis (organizations).
@@ -144,6 +270,23 @@ def get_without_tor_ledgers():
     return list(dict.fromkeys(ledgers)) or None
 
 
+def get_history_analyses():
+    """
+    Retrieves whether parse.py should also run the analyses that read the full history of every node (network edges,
+    response lengths, convergence)
+    :returns: boolean
+    """
+    return bool(get_config_data().get('parse_parameters', {}).get('history_analyses', False))
+
+
+def get_parse_processes():
+    """
+    Retrieves the number of worker processes used to scan the node histories
+    :returns: integer
+    """
+    return get_config_data().get('parse_parameters', {}).get('processes') or os.cpu_count() or 1
+
+
 def get_output_directory(ledger=None, dead=False):
     """
     Reads the config file and retrieves the output directory
@@ -174,53 +317,74 @@ def get_output_directory(ledger=None, dead=False):
     return output_dir
 
 
-def update_node(ledger, ip, port, version, addresses, protocol=0):
+def get_storage_backend():
+    """
+    Retrieves the backend used to store the observations made about nodes: 'json' (one file per node) or 'sqlite'
+    :returns: string
+    """
+    return get_config_data().get('storage', 'json')
+
+
+_stores = {}
+
+
+def get_store():
+    """
+    Opens (once per process) the observation store configured in the config file.
+    :returns: an ObservationStore
+    """
+    pid = os.getpid()  # Connections must not be shared with forked worker processes
+    if pid not in _stores:
+        _stores[pid] = open_store(get_storage_backend(), get_output_directory())
+    return _stores[pid]
+
+
+def make_observation(ledger, ip, port, version, addresses, protocol=0):
     """
-    Writes the information collected about the node during the crawling phase to the corresponding file.
+    Creates the record of a connection attempt to a node.
     :param ledger: the ledger of the node
     :param ip: the ip address of the node
     :param port: the port of the node
-    :param version: the version of the node
+    :param version: the version of the node, None if the node could not be reached
     :param addresses: the ip addresses sent by the node
     :param protocol: optional, the protocol version used by the node
+    :returns: an observation dictionary
     """
-
-    output_dir = get_output_directory(ledger)
-
-    try:
-        with open(output_dir / ip) as f:
-            entries = json.load(f)
-    except FileNotFoundError:
-        entries = []
-
     if version is None:
         status = False
-        if entries == []:
-            return  # If the node has never been reachable then don't record now
         version = ''
         addresses = []
     else:
         status = True
 
-    entries.append({
+    return {
+        'ledger': ledger,
+        'ip': ip,
         'date': datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S'),
         'port': port,
         'version': version,
         'protocol': protocol,
         'status': status,
         'addresses': [list(addr) for addr in addresses],
-    })
+    }
 
-    # Write output in two steps to avoid broken files in case of abrupt interruption
-    with open(output_dir / f'{ip}.backup', 'w') as f:
-        json.dump(entries, f)
 
-    shutil.move(output_dir / f'{ip}.backup', output_dir / ip)
+def update_node(ledger, ip, port, version, addresses, protocol=0):
+    """
+    Records the information collected about the node during the crawling phase in the observation store.
+    :param ledger: the ledger of the node
+    :param ip: the ip address of the node
+    :param port: the port of the node
+    :param version: the version of the node
+    :param addresses: the ip addresses sent by the node
+    :param protocol: optional, the protocol version used by the node
+    """
+    get_store().add_observations([make_observation(ledger, ip, port, version, addresses, protocol)])
 
 
 def get_last_days(days):
     """
-    Retrieves the dates of the last few days. Used by the get_nodes function to retrieve last X days nodes.
+    Retrieves the dates of the last few days. Used to select the entries of the last X days.
     :param days: the number of days
     :returns: a set containing the dates of the last few days
     """
@@ -232,41 +396,37 @@ def get_last_days(days):
     return past_week
 
 
+def get_node_index(ledger):
+    """
+    Retrieves the node index of the observation store, building the ledger's index from the full node histories if
+    it does not exist yet (e.g. on the first run after an upgrade).
+    :param ledger: the ledger of the nodes
+    :returns: a NodeIndex
+    """
+    store = get_store()
+    if not store.index.is_built(ledger):
+        logging.info(f'{ledger} - Building node index')
+        store.index.rebuild(ledger, store.iter_histories(ledger))
+    return store.index
+
+
 def get_nodes(ledger, reachable_only=False, time_window=0):
     """
     Retrieves nodes.
     :param ledger: the ledger of the nodes
     :param reachable_only: optional, boolean. If set then it returns only reachable nodes.
     :param time_window: optional, the number of days. If equals to 0, it returns all the nodes, regardless of the date. Otherwise, returns last X days nodes.
-    :returns: a set containing information on all corresponding nodes
+    :returns: a set of (ip, port, version, protocol) tuples. Reachable nodes are reported with the details of their
+    latest successful connection, advertised addresses with the details of the last node that advertised them.
     """
+    since = None
     if time_window > 0:
-        dates_in_time_window = get_last_days(time_window)
-    output_dir = get_output_directory(ledger)
-    filenames = list(pathlib.Path(output_dir).iterdir())
+        since = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(time_window - 1), datetime.time())
 
-    nodes = set()
-    for ctr, filename in enumerate(filenames):
-        print(f'{ledger} - parsed {ctr:,}/{len(filenames):,} files ({100*ctr/len(filenames):.2f}%)', end='\r')
-
-        if filename.is_file():
-            with open(filename) as f:
-                entries = json.load(f)
-                for entry in reversed(entries):
-                    if entry['status'] and ((time_window == 0) or (time_window > 0 and entry['date'].split()[0] in dates_in_time_window)):
-                        node_ip = str(filename).split('/')[-1]
-                        node_port = entry['port']
-                        node_version = entry['version']
-                        try:
-                            node_protocol = entry['protocol']
-                        except KeyError:
-                            node_protocol = 0
-                        nodes.add((node_ip, node_port, node_version, node_protocol))
-                        if reachable_only:
-                            break
-                        else:
-                            for addr in entry['addresses']:
-                                nodes.add((addr[0], addr[1], node_version, node_protocol))
+    index = get_node_index(ledger)
+    nodes = index.reachable_nodes(ledger, since)
+    if not reachable_only:
+        nodes |= index.advertised_addresses(ledger, since)
     return nodes
 
 
@@ -296,38 +456,58 @@ def get_ipv6_nodes(ledger):
     :param ledger: the ledger of the nodes
     :returns: a set containing IPV6 addresses.
     """
-    addresses = set()
-    output_dir = get_output_directory(ledger)
-    for filename in pathlib.Path(output_dir).iterdir():
-        if filename.is_file():
-            with open(filename) as f:
-                entries = json.load(f)
-                for entry in entries:
-                    for addr in entry['addresses']:
-                        if ':' in addr[0]:
-                            addresses.add((addr[0], addr[1]))
-    return addresses
+    return get_node_index(ledger).ipv6_addresses(ledger)
+
+
+_seed_resolver = None
+
+
+def get_seed_resolver():
+    """
+    Creates (once) the resolver of the DNS seeds, whose cache is kept in the output directory.
+    :returns: a SeedResolver
+    """
+    global _seed_resolver
+    if _seed_resolver is None:
+        params = get_config_data().get('dns_seeds') or {}
+        keys = ['nameservers', 'port', 'timeout', 'max_workers']
+        _seed_resolver = SeedResolver(get_output_directory() / 'dns_seeds.json',
+                                      **{key: params[key] for key in keys if params.get(key) is not None})
+    return _seed_resolver
+
+
+def get_seed_info(ledger):
+    """
+    Reads the DNS seeds and the seed nodes of a ledger from the seed_info folder.
+    :param ledger: the ledger of the nodes
+    :returns: dictionary with the keys 'dns' (list of hostnames) and 'seed_list' (list of {'ip', 'port'} dictionaries)
+    """
+    with open(ROOT_DIR / f'seed_info/{ledger}.json') as f:
+        return json.load(f)
+
+
+def resolve_dns_seeds(ledgers):
+    """
+    Resolves the DNS seeds of several ledgers at once, so that the answers are cached when the seed nodes of each
+    ledger are retrieved.
+    :param ledgers: list of ledgers
+    """
+    get_seed_resolver().resolve_many(name for ledger in ledgers for name in get_seed_info(ledger)['dns'])
 
 
 def get_seed_nodes(ledger):
     """
-    Retrieves the seed nodes from the seed_info folder.
+    Retrieves the seed nodes from the seed_info folder, and the IPv4 and IPv6 addresses of the DNS seeds.
     :param ledger: the ledger of the nodes
     :returns: a set containing the address and port of the seed nodes.
     """
-    with open(ROOT_DIR / f'seed_info/{ledger}.json') as f:
-        seeds = json.load(f)
+    seeds = get_seed_info(ledger)
 
     nodes = set()
 
-    dns_list = seeds['dns']
-    for dns_url in dns_list:
-        try:
-            answers = dns.resolver.resolve(dns_url)
-            for rdata in answers:
-                nodes.add((rdata.to_text(), DEFAULT_PORTS[ledger]))
-        except Exception:
-            pass
+    for addresses in get_seed_resolver().resolve_many(seeds['dns']).values():
+        for address in addresses:
+            nodes.add((address, DEFAULT_PORTS[ledger]))
 
     for seed in seeds['seed_list']:
         nodes.add((seed['ip'], seed['port']))
@@ -345,30 +525,90 @@ def get_known_nodes(ledger, time_window=0):
     return get_all_nodes(ledger, time_window).union(get_seed_nodes(ledger))
 
 
+def get_geolocation_parameters():
+    """
+    Retrieves the parameters of the geolocation client (base URLs and rate limits of the APIs, number of concurrent
+    lookups), as keyword arguments for GeolocationClient. Parameters missing from the config file fall back to the
+    defaults of the geolocation module.
+    :returns: dictionary
+    """
+    params = get_config_data().get('geolocation') or {}
+    keys = ['ip_api_url', 'ipapi_is_url', 'ip_api_rate', 'ipapi_is_rate', 'ip_api_batch_rate', 'max_workers',
+            'max_retries', 'max_rate_limited']
+    return {key: params[key] for key in keys if params.get(key) is not None}
+
+
+def get_geolocation_batch():
+    """
+    Retrieves whether new addresses are geolocated with the batch endpoint of ip-api.com (100 addresses per request)
+    :returns: boolean
+    """
+    return bool((get_config_data().get('geolocation') or {}).get('batch', False))
+
+
+_geolocation_client = None
+
+
+def get_geolocation_client():
+    """
+    Creates (once) the client used to geolocate ip addresses, so that all lookups share its connections and rate
+    limits.
+    :returns: a GeolocationClient
+    """
+    global _geolocation_client
+    if _geolocation_client is None:
+        _geolocation_client = GeolocationClient(**get_geolocation_parameters())
+    return _geolocation_client
+
+
+_geodata_cache = None
+
+
+def get_geodata_cache():
+    """
+    Opens (once) the geodata cache shared by the bitcoin, cardano and ethereum pipelines.
+    :returns: a GeodataCache
+    """
+    global _geodata_cache
+    if _geodata_cache is None:
+        params = get_config_data().get('geodata_cache') or {}
+        path = ROOT_DIR / params.get('path', '../geodata_cache.db')
+        _geodata_cache = GeodataCache(
+            path, params.get('ttl_days', DEFAULT_TTL_DAYS), params.get('ipv4_prefix'), params.get('ipv6_prefix'))
+    return _geodata_cache
+
+
+def get_ip_ranges_mode():
+    """
+    Retrieves how the local table of IP ranges is used: 'primary' (before the geolocation APIs), 'fallback' (for the
+    addresses the APIs could not geolocate) or None (not used)
+    :returns: string or None
+    """
+    params = get_config_data().get('ip_ranges') or {}
+    return params.get('mode') if params.get('path') else None
+
+
+_ip_ranges = None
+
+
+def get_ip_ranges():
+    """
+    Loads (once) the local table of IP ranges configured in the config file.
+    :returns: an IpRangeIndex, or None if no table is configured
+    """
+    global _ip_ranges
+    if _ip_ranges is None and get_ip_ranges_mode():
+        _ip_ranges = IpRangeIndex.load(ROOT_DIR / get_config_data()['ip_ranges']['path'])
+    return _ip_ranges
+
+
 def get_ip_geodata(ip_addr):
     """
     Retrieves the node geolocation using ip-api.com or api.ipapi.is.
     :param ip_addr: the ip address of the node
-    :returns: geolocation information
-    """
-    data = None
-    while not data:
-        r = requests.get(f'http://ip-api.com/json/{ip_addr}') # Max 45 HTTP requests per minute
-        try:
-            data = r.json()
-            if not data.get('org') and data.get('as'):
-                data['org'] = data['as'][data['as'].find(' ')+1:]
-            if not data.get('org') or not data.get('country'):
-                new_r = requests.get(f'https://api.ipapi.is/?q={ip_addr}') # Max 1000 HTTP requests per day
-                data = new_r.json()
-            if 'error' in data:
-                data = None
-        except requests.exceptions.JSONDecodeError:
-            pass
-        if data is None:
-            logging.error('Geodata rate limited, sleeping for 1 min...')
-            time.sleep(60)
-    return data
+    :returns: geolocation information, or None if it could not be retrieved
+    """
+    return get_geolocation_client().lookup(ip_addr)
 
 
 def get_os_info(ip_addr):
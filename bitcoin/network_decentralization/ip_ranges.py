@@ -0,0 +1,144 @@
+"""
+Offline resolution of IP addresses to their ASN, organisation and country, using a local table of IP ranges.
+
+Two table formats are supported:
+- the tab-separated ip2asn format (e.g. ip2asn-combined.tsv from iptoasn.com): range_start, range_end, AS number,
+  country code, AS description, without header
+- CSV files with a header, where each row has either a 'network' column (CIDR prefix) or 'start' and 'end' columns,
+  and optionally 'asn', 'org' (or 'as_name') and 'country' (or 'country_code') columns. This is also the format of
+  the CSV exports of MMDB databases.
+
+The ranges are flattened into disjoint intervals (where ranges overlap, the most specific one wins) that are kept
+sorted by their first address, so that an address is resolved with a binary search.
+"""
+import bisect
+import csv
+import ipaddress
+import logging
+import pathlib
+
+
+def flatten(ranges):
+    """
+    Converts possibly nested or overlapping ranges into disjoint ones.
+    :param ranges: list of (first, last, record) tuples, where first and last are integers
+    :returns: list of disjoint (first, last, record) tuples, sorted by first
+    """
+    flat = []
+    stack = []  # (last, record) of the ranges containing the current position, innermost last
+    cursor = 0  # First address not covered by flat yet
+    for first, last, record in sorted(ranges, key=lambda r: (r[0], -r[1])):
+        while stack and stack[-1][0] < first:
+            outer_last, outer_record = stack.pop()
+            if cursor <= outer_last:
+                flat.append((cursor, outer_last, outer_record))
+                cursor = outer_last + 1
+        if stack and cursor < first:
+            flat.append((cursor, first - 1, stack[-1][1]))
+        cursor = max(cursor, first)
+        stack.append((last, record))
+    while stack:
+        outer_last, outer_record = stack.pop()
+        if cursor <= outer_last:
+            flat.append((cursor, outer_last, outer_record))
+            cursor = outer_last + 1
+    return flat
+
+
+MISSING_VALUES = {'', 'None'}  # 'None' is the country of the ranges without a country in the ip2asn tables
+
+
+def make_record(asn, org, country):
+    """
+    Creates a record in the same format as the replies of ip-api.com, so that it can be used wherever those are.
+    :returns: the record, or None if the ASN, organisation or country is missing (such records would otherwise be
+    grouped under one placeholder organisation or country)
+    """
+    asn = str(asn or '').strip().upper().removeprefix('AS')
+    org, country = (org or '').strip(), (country or '').strip()
+    if asn in MISSING_VALUES or asn == '0' or org in MISSING_VALUES or country in MISSING_VALUES:
+        return None
+    return {
+        'country': country,
+        'org': org,
+        'as': f'AS{asn} {org}',
+        'source': 'ip_ranges',
+    }
+
+
+class IpRangeIndex(object):
+    def __init__(self, ranges):
+        """
+        :param ranges: iterable of (first address, last address, record) tuples, with addresses as strings or
+        ipaddress objects. Ranges with a None record are kept, so that their addresses are not resolved to the record
+        of an enclosing range.
+        """
+        by_version = {4: [], 6: []}
+        for first, last, record in ranges:
+            first, last = ipaddress.ip_address(first), ipaddress.ip_address(last)
+            by_version[first.version].append((int(first), int(last), record))
+        self.firsts, self.intervals = {}, {}
+        for version, version_ranges in by_version.items():
+            self.intervals[version] = flatten(version_ranges)
+            self.firsts[version] = [interval[0] for interval in self.intervals[version]]
+
+    def __len__(self):
+        return sum(len(intervals) for intervals in self.intervals.values())
+
+    def lookup(self, ip_addr):
+        """
+        :param ip_addr: the ip address
+        :returns: the record of the range that contains the address, or None if there is no such range or its record
+        is incomplete
+        """
+        try:
+            address = ipaddress.ip_address(ip_addr)
+        except ValueError:
+            return None  # e.g. onion addresses
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        value = int(address)
+        idx = bisect.bisect_right(self.firsts[address.version], value) - 1
+        if idx >= 0:
+            first, last, record = self.intervals[address.version][idx]
+            if value <= last and record is not None:
+                return dict(record)
+        return None
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a table of IP ranges (see the module docstring for the supported formats).
+        :param path: the path of the table
+        :returns: an IpRangeIndex
+        """
+        path = pathlib.Path(path)
+        with open(path, newline='', encoding='utf-8') as f:
+            first_line = f.readline()
+            f.seek(0)
+            if '\t' in first_line:
+                ranges = cls.read_ip2asn(f)
+            else:
+                ranges = cls.read_csv(f)
+            index = cls(ranges)
+        logging.info(f'Loaded {len(index):,} IP ranges from {path}')
+        return index
+
+    @staticmethod
+    def read_ip2asn(f):
+        for row in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+            if len(row) >= 5 and row[2] != '0':  # AS 0: range not routed
+                yield row[0], row[1], make_record(row[2], row[4], row[3])
+
+    @staticmethod
+    def read_csv(f):
+        for row in csv.DictReader(f):
+            row = {key.strip().lower(): (value or '').strip() for key, value in row.items() if key}
+            if row.get('network'):
+                network = ipaddress.ip_network(row['network'], strict=False)
+                first, last = network.network_address, network.broadcast_address
+            else:
+                first, last = row['start'], row['end']
+            record = make_record(
+                row.get('asn'), row.get('org') or row.get('as_name'), row.get('country') or row.get('country_code'))
+            yield first, last, record
@@ -0,0 +1,198 @@
+"""
+Compact per-ledger index of the nodes held in an observation store.
+
+For every node the index keeps a single row with the outcome of its latest observation and the details of its latest
+successful one, and for every advertised address the date it was last advertised. It is updated incrementally as
+observations are written, so that the set of reachable or known nodes can be retrieved without decoding the history
+of every node.
+"""
+import pathlib
+import sqlite3
+import threading
+
+from network_decentralization.store import to_iso_date, chunks, SQLITE_MAX_VARIABLES
+
+INDEX_FILENAME = 'node_index.db'
+
+
+class NodeIndex(object):
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS nodes (
+            ledger TEXT NOT NULL,
+            ip TEXT NOT NULL,
+            port INTEGER,
+            version TEXT,
+            protocol INTEGER,
+            last_seen TEXT,
+            last_status INTEGER,
+            last_reachable TEXT,
+            failures INTEGER,
+            PRIMARY KEY (ledger, ip))''',
+        'CREATE INDEX IF NOT EXISTS nodes_reachable ON nodes (ledger, last_reachable)',
+        '''CREATE TABLE IF NOT EXISTS addresses (
+            ledger TEXT NOT NULL,
+            ip TEXT NOT NULL,
+            port INTEGER NOT NULL,
+            version TEXT,
+            protocol INTEGER,
+            last_advertised TEXT,
+            PRIMARY KEY (ledger, ip, port))''',
+        'CREATE INDEX IF NOT EXISTS addresses_advertised ON addresses (ledger, last_advertised)',
+        'CREATE TABLE IF NOT EXISTS built_ledgers (ledger TEXT PRIMARY KEY)',
+    ]
+
+    UPSERT_NODE = '''
+        INSERT INTO nodes (ledger, ip, port, version, protocol, last_seen, last_status, last_reachable, failures)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (ledger, ip) DO UPDATE SET
+            port = CASE WHEN excluded.last_status THEN excluded.port ELSE nodes.port END,
+            version = CASE WHEN excluded.last_status THEN excluded.version ELSE nodes.version END,
+            protocol = CASE WHEN excluded.last_status THEN excluded.protocol ELSE nodes.protocol END,
+            last_reachable = CASE WHEN excluded.last_status THEN excluded.last_reachable ELSE nodes.last_reachable END,
+            failures = CASE WHEN excluded.last_status THEN 0 ELSE nodes.failures + 1 END,
+            last_seen = excluded.last_seen,
+            last_status = excluded.last_status
+        WHERE excluded.last_seen >= nodes.last_seen'''
+
+    UPSERT_ADDRESS = '''
+        INSERT INTO addresses (ledger, ip, port, version, protocol, last_advertised)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (ledger, ip, port) DO UPDATE SET
+            version = excluded.version,
+            protocol = excluded.protocol,
+            last_advertised = excluded.last_advertised
+        WHERE excluded.last_advertised >= addresses.last_advertised'''
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.local = threading.local()
+        with self.connection as conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+
+    @property
+    def connection(self):
+        conn = getattr(self.local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = conn
+        return conn
+
+    @staticmethod
+    def to_rows(observations):
+        """
+        Converts observations (in chronological order) to the rows upserted into the nodes and addresses tables.
+        """
+        node_rows, address_rows = [], []
+        for obs in observations:
+            date = to_iso_date(obs['date'])
+            status = bool(obs['status'])
+            node_rows.append((
+                obs['ledger'], obs['ip'], obs['port'], obs['version'], obs.get('protocol', 0),
+                date, int(status), date if status else None, 0 if status else 1,
+            ))
+            for addr in obs['addresses']:
+                address_rows.append((obs['ledger'], addr[0], addr[1], obs['version'], obs.get('protocol', 0), date))
+        return node_rows, address_rows
+
+    def update(self, observations):
+        """
+        Applies a batch of observations (in chronological order) to the index.
+        :param observations: list of observation dictionaries
+        """
+        node_rows, address_rows = self.to_rows(observations)
+        with self.connection as conn:
+            conn.executemany(self.UPSERT_NODE, node_rows)
+            conn.executemany(self.UPSERT_ADDRESS, address_rows)
+
+    def remove(self, ledger, ips):
+        """
+        Removes nodes from the index (e.g. when they are moved to the dead nodes). The addresses they advertised are
+        kept, since the index does not record which node advertised them.
+        """
+        with self.connection as conn:
+            for chunk in chunks(list(ips), SQLITE_MAX_VARIABLES):
+                placeholders = ', '.join('?' * len(chunk))
+                conn.execute(f'DELETE FROM nodes WHERE ledger = ? AND ip IN ({placeholders})', [ledger] + chunk)
+
+    def is_built(self, ledger):
+        row = self.connection.execute('SELECT 1 FROM built_ledgers WHERE ledger = ?', (ledger,)).fetchone()
+        return row is not None
+
+    def invalidate(self, ledger):
+        """
+        Marks the index of the ledger as out of date, so that it is rebuilt on its next use.
+        """
+        with self.connection as conn:
+            conn.execute('DELETE FROM built_ledgers WHERE ledger = ?', (ledger,))
+
+    def rebuild(self, ledger, histories):
+        """
+        Rebuilds the index of a ledger from scratch.
+        :param ledger: the ledger of the nodes
+        :param histories: iterable of (ip, entries) pairs, e.g. ObservationStore.iter_histories(ledger)
+        """
+        with self.connection as conn:
+            conn.execute('DELETE FROM nodes WHERE ledger = ?', (ledger,))
+            conn.execute('DELETE FROM addresses WHERE ledger = ?', (ledger,))
+            for ip, entries in histories:
+                node_rows, address_rows = self.to_rows(dict(entry, ledger=ledger, ip=ip) for entry in entries)
+                conn.executemany(self.UPSERT_NODE, node_rows)
+                conn.executemany(self.UPSERT_ADDRESS, address_rows)
+            conn.execute('INSERT OR IGNORE INTO built_ledgers (ledger) VALUES (?)', (ledger,))
+
+    def reachable_nodes(self, ledger, since=None):
+        """
+        Retrieves the nodes whose latest successful observation was made at or after the given date.
+        :param ledger: the ledger of the nodes
+        :param since: optional, datetime. If not set, all nodes that have ever been reachable are returned.
+        :returns: a set of (ip, port, version, protocol) tuples
+        """
+        query = 'SELECT ip, port, version, protocol FROM nodes WHERE ledger = ? AND last_reachable IS NOT NULL'
+        values = [ledger]
+        if since is not None:
+            query += ' AND last_reachable >= ?'
+            values.append(since.strftime('%Y-%m-%d %H:%M:%S'))
+        return set(self.connection.execute(query, values))
+
+    def advertised_addresses(self, ledger, since=None):
+        """
+        Retrieves the addresses advertised by nodes at or after the given date.
+        :param ledger: the ledger of the nodes
+        :param since: optional, datetime. If not set, all addresses ever advertised are returned.
+        :returns: a set of (ip, port, version, protocol) tuples, where version and protocol are those of the last node
+        that advertised the address
+        """
+        query = 'SELECT ip, port, version, protocol FROM addresses WHERE ledger = ?'
+        values = [ledger]
+        if since is not None:
+            query += ' AND last_advertised >= ?'
+            values.append(since.strftime('%Y-%m-%d %H:%M:%S'))
+        return set(self.connection.execute(query, values))
+
+    def inactive_nodes(self, ledger, last_time_active):
+        """
+        Retrieves the nodes that were not reachable in any of their last observations.
+        :param ledger: the ledger of the nodes
+        :param last_time_active: the number of most recent observations to consider
+        :returns: a set of ip addresses
+        """
+        rows = self.connection.execute(
+            'SELECT ip FROM nodes WHERE ledger = ? AND (last_reachable IS NULL OR failures >= ?)',
+            (ledger, last_time_active))
+        return {row[0] for row in rows}
+
+    def ipv6_addresses(self, ledger):
+        """
+        :returns: a set of (ip, port) tuples with all IPv6 addresses ever advertised
+        """
+        return set(self.connection.execute(
+            "SELECT ip, port FROM addresses WHERE ledger = ? AND ip LIKE '%:%'", (ledger,)))
+
+    def close(self):
+        conn = getattr(self.local, 'connection', None)
+        if conn is not None:
+            conn.close()
+            self.local.connection = None
@@ -138,6 +138,8 @@ Reference: https://en.bitcoin.it/wiki/Protocol_specification
 -------------------------------------------------------------------------------
 """
 
+import asyncio
+import functools
 import gevent
 import hashlib
 import logging
@@ -169,6 +171,12 @@ SOCKET_BUFSIZE = 8192
 SOCKET_TIMEOUT = 30
 HEADER_LEN = 24
 
+# Deadlines (seconds) for the replies to version and getaddr.
+HANDSHAKE_TIMEOUT = 10
+GETADDR_TIMEOUT = 10
+# Stop collecting addr messages once this many addresses were received.
+GETADDR_MAX_ADDRS = 1000
+
 # IPv6 prefix for .onion address (use in addr message only).
 ONION_PREFIX = b'\xFD\x87\xD8\x7E\xEB\x43'
 
@@ -198,6 +206,30 @@ SUPPORTED_NETWORKS = [
 
 ONION_V3_LEN = 62
 
+# Number of .onion addresses whose encoding is memoized. The same addresses
+# are advertised by many nodes, and base32 encoding is comparatively slow.
+ONION_CACHE_SIZE = 65536
+
+# Precompiled structs of the fast addr/addrv2 decoder.
+UINT8 = struct.Struct('<B')
+UINT16 = struct.Struct('<H')
+UINT32 = struct.Struct('<I')
+UINT64 = struct.Struct('<Q')
+PORT_STRUCT = struct.Struct('>H')
+# MAGIC_NUMBER, COMMAND, LENGTH and CHECKSUM.
+HEADER_STRUCT = struct.Struct('<4s12sI4s')
+# TIMESTAMP, SERVICES, IP_ADDR (first 12 bytes, last 4 bytes) and PORT. The
+# port is big-endian and is byte-swapped after unpacking.
+ADDR_STRUCT = struct.Struct('<IQ12s4sH')
+
+# IPv6 prefix of IPv4-mapped addresses (use in addr message only).
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xFF' * 2
+
+# Fields of the compact tuples returned by the addr/addrv2 decoder when the
+# serializer is created with addr_format='tuple'. address is the IPv4, IPv6
+# or .onion address, depending on network_id.
+ADDR_RECORD_FIELDS = ('network_id', 'timestamp', 'services', 'address', 'port')
+
 
 class ProtocolError(Exception):
     pass
@@ -251,10 +283,19 @@ class RemoteHostClosedConnection(ConnectionError):
     pass
 
 
+class ProxyUnavailable(ConnectionError):
+    """
+    The proxy could not be connected to or rejected the SOCKS5 greeting, which
+    says nothing about the reachability of the target.
+    """
+    pass
+
+
 def sha256(data):
     return hashlib.sha256(data).digest()
 
 
+@functools.lru_cache(maxsize=ONION_CACHE_SIZE)
 def addr_to_onion_v2(addr):
     """
     Returns .onion address for the specified v2 onion addr.
@@ -262,6 +303,7 @@ def addr_to_onion_v2(addr):
     return (b32encode(addr).lower() + b'.onion').decode()
 
 
+@functools.lru_cache(maxsize=ONION_CACHE_SIZE)
 def addr_to_onion_v3(addr):
     """
     Returns .onion address for the specified v3 onion addr (PUBKEY).
@@ -285,18 +327,161 @@ def unpack(fmt, string):
         raise ReadError(err)
 
 
+def read_int(view, offset):
+    """
+    Decodes the variable integer at the specified offset of a memoryview.
+    Returns (value, offset of the next field).
+    """
+    try:
+        value = view[offset]
+        if value < 0xFD:
+            return value, offset + 1
+        elif value == 0xFD:
+            return UINT16.unpack_from(view, offset + 1)[0], offset + 3
+        elif value == 0xFE:
+            return UINT32.unpack_from(view, offset + 1)[0], offset + 5
+        return UINT64.unpack_from(view, offset + 1)[0], offset + 9
+    except (IndexError, struct.error) as err:
+        raise ReadError(err)
+
+
+def decode_addr_records(view, offset, count):
+    """
+    Decodes count fixed-size (30 bytes) addr entries starting at the
+    specified offset of a memoryview. Returns a list of tuples (see
+    ADDR_RECORD_FIELDS).
+    """
+    end = offset + count * ADDR_STRUCT.size
+    if end > len(view):
+        raise ReadError(f'got {len(view)} of {end} bytes')
+    records = []
+    append = records.append
+    inet_ntop = socket.inet_ntop
+    for (timestamp, services, prefix, ipv4, port) in ADDR_STRUCT.iter_unpack(
+            view[offset:end]):
+        port = ((port & 0xFF) << 8) | (port >> 8)
+        if prefix == IPV4_MAPPED_PREFIX:
+            append((NETWORK_IPV4, timestamp, services,
+                    inet_ntop(socket.AF_INET, ipv4), port))
+        elif prefix[:6] == ONION_PREFIX:
+            append((NETWORK_TORV2, timestamp, services,
+                    addr_to_onion_v2(prefix[6:] + ipv4), port))
+        else:
+            ipv6 = inet_ntop(socket.AF_INET6, prefix + ipv4)
+            if '.' in ipv6:  # Embedded IPv4 address, e.g. ::a.b.c.d
+                append((NETWORK_IPV4, timestamp, services,
+                        inet_ntop(socket.AF_INET, ipv4), port))
+            else:
+                append((NETWORK_IPV6, timestamp, services, ipv6, port))
+    return records
+
+
+def check_network_id(network_id, addr_len):
+    """
+    Raises the error matching an addrv2 entry with an unknown or
+    unsupported network id, or with an invalid address length.
+    """
+    if network_id not in NETWORK_LENGTHS:
+        raise UnknownNetworkIdError(f'unknown network id {network_id}')
+    if network_id not in SUPPORTED_NETWORKS:
+        raise UnsupportedNetworkIdError(f'unsupported network id {network_id}')
+    if addr_len != NETWORK_LENGTHS[network_id]:
+        raise InvalidAddrLenError
+
+
+def decode_addrv2_records(view, offset, count):
+    """
+    Decodes count variable-size addrv2 entries starting at the specified
+    offset of a memoryview. Returns a list of tuples (see
+    ADDR_RECORD_FIELDS).
+    """
+    records = []
+    append = records.append
+    inet_ntop = socket.inet_ntop
+    unpack_uint16 = UINT16.unpack_from
+    unpack_uint32 = UINT32.unpack_from
+    unpack_port = PORT_STRUCT.unpack_from
+    supported_lengths = {network_id: NETWORK_LENGTHS[network_id]
+                         for network_id in SUPPORTED_NETWORKS}
+    try:
+        for _ in range(count):
+            timestamp = unpack_uint32(view, offset)[0]
+            # Services are a variable integer, usually of 1 or 3 bytes.
+            services = view[offset + 4]
+            if services < 0xFD:
+                offset += 5
+            elif services == 0xFD:
+                services = unpack_uint16(view, offset + 5)[0]
+                offset += 7
+            else:
+                services, offset = read_int(view, offset + 4)
+
+            # Supported addresses are at most 32 bytes long, so their length
+            # is normally a single byte.
+            network_id = view[offset]
+            addr_len = view[offset + 1]
+            if addr_len == supported_lengths.get(network_id):
+                offset += 2
+            else:
+                addr_len, offset = read_int(view, offset + 1)
+                check_network_id(network_id, addr_len)
+
+            addr = view[offset:offset + addr_len].tobytes()
+            offset += addr_len
+            if network_id == NETWORK_IPV4:
+                address = inet_ntop(socket.AF_INET, addr)
+            elif network_id == NETWORK_IPV6:
+                address = inet_ntop(socket.AF_INET6, addr)
+            elif network_id == NETWORK_TORV3:
+                address = addr_to_onion_v3(addr)
+            else:
+                address = addr_to_onion_v2(addr)
+
+            port = unpack_port(view, offset)[0]
+            offset += 2
+            append((network_id, timestamp, services, address, port))
+    except (IndexError, ValueError, struct.error) as err:
+        # ValueError: truncated address passed to inet_ntop().
+        raise ReadError(err)
+    return records
+
+
+def addr_record_to_dict(record):
+    """
+    Converts a compact tuple returned by the addr/addrv2 decoder to the dict
+    returned by Serializer.deserialize_network_address().
+    """
+    (network_id, timestamp, services, address, port) = record
+    return {
+        'network_id': network_id,
+        'timestamp': timestamp,
+        'services': services,
+        'ipv4': address if network_id == NETWORK_IPV4 else '',
+        'ipv6': address if network_id == NETWORK_IPV6 else '',
+        'onion': address if network_id in (NETWORK_TORV2,
+                                           NETWORK_TORV3) else '',
+        'port': port,
+    }
+
+
 def create_connection(address, timeout=SOCKET_TIMEOUT, source_address=None,
                       proxy=None):
     if address[0].endswith('.onion') and proxy is None:
         raise ProxyRequired(
             'tor proxy is required to connect to .onion address')
     if proxy:
-        socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS5, proxy[0], proxy[1])
+        # The proxy is set on this socket only, not as the default proxy of
+        # the process, and resolves the hostname (e.g. .onion addresses).
         sock = socks.socksocket()
+        sock.set_proxy(socks.SOCKS5, proxy[0], proxy[1], rdns=True)
         sock.settimeout(timeout)
         try:
             sock.connect(address)
         except socks.ProxyError as err:
+            # PySocks wraps the errors of the negotiation in GeneralProxyError
+            if isinstance(err, socks.ProxyConnectionError) or isinstance(
+                    getattr(err, 'socket_err', None), socks.SOCKS5AuthError):
+                raise ProxyUnavailable(err)
             raise ConnectionError(err)
         return sock
     if ':' in address[0] and source_address and ':' not in source_address[0]:
@@ -305,6 +490,135 @@ def create_connection(address, timeout=SOCKET_TIMEOUT, source_address=None,
                                     source_address=source_address)
 
 
+async def socks5_connect(reader, writer, address):
+    """
+    Performs a SOCKS5 CONNECT (no authentication) over an already open
+    stream to the proxy. The hostname is sent unresolved so that .onion
+    addresses are resolved by the proxy. A failed greeting raises
+    ProxyUnavailable, a failed CONNECT ConnectionError.
+    """
+    writer.write(b'\x05\x01\x00')
+    await writer.drain()
+    try:
+        reply = await reader.readexactly(2)
+    except asyncio.IncompleteReadError:
+        raise ProxyUnavailable('socks5 proxy closed the connection')
+    if reply != b'\x05\x00':
+        raise ProxyUnavailable(f'socks5 greeting rejected: {hexlify(reply)}')
+
+    host = address[0].encode()
+    writer.write(b'\x05\x01\x00\x03' + struct.pack('B', len(host)) + host +
+                 struct.pack('>H', address[1]))
+    await writer.drain()
+    reply = await reader.readexactly(4)
+    if reply[1] != 0x00:
+        raise ConnectionError(f'socks5 connect failed with code {reply[1]}')
+
+    # Discard the bound address sent back by the proxy.
+    if reply[3] == 0x01:
+        await reader.readexactly(4 + 2)
+    elif reply[3] == 0x04:
+        await reader.readexactly(16 + 2)
+    else:
+        length = await reader.readexactly(1)
+        await reader.readexactly(length[0] + 2)
+
+
+async def open_async_connection(address, timeout=SOCKET_TIMEOUT,
+                                source_address=None, proxy=None):
+    """
+    Asyncio counterpart of create_connection(); returns a (reader, writer)
+    stream pair.
+    """
+    if address[0].endswith('.onion') and proxy is None:
+        raise ProxyRequired(
+            'tor proxy is required to connect to .onion address')
+    if proxy:
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(proxy[0], proxy[1]), timeout)
+        except (OSError, asyncio.TimeoutError) as err:
+            raise ProxyUnavailable(
+                f'could not connect to proxy {proxy[0]}:{proxy[1]}: {err!r}')
+        try:
+            await asyncio.wait_for(
+                socks5_connect(reader, writer, address), timeout)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+    if ':' in address[0] and source_address and ':' not in source_address[0]:
+        source_address = None
+    if source_address == ('0.0.0.0', 0):
+        source_address = None
+    return await asyncio.wait_for(
+        asyncio.open_connection(address[0], address[1],
+                                local_addr=source_address), timeout)
+
+
+HANDSHAKE_COMMANDS = (b'version', b'sendaddrv2', b'verack')
+ADDR_COMMANDS = (b'addr', b'addrv2')
+# Connections reply to these messages as soon as they are received, so their
+# payloads are always decoded.
+REPLY_COMMANDS = (b'version', b'ping')
+# Messages whose payloads are needed to crawl the network (decode_commands).
+CRAWL_COMMANDS = HANDSHAKE_COMMANDS + ADDR_COMMANDS + REPLY_COMMANDS
+
+
+class LazyMessage(dict):
+    """
+    Message whose payload is only decoded when one of its fields other than
+    those of the header is first accessed. The payload is decoded with the
+    state of the serializer at that time.
+    """
+    def __init__(self, header, payload, serializer):
+        super().__init__(header)
+        self.payload = payload
+        self.serializer = serializer
+
+    def decode(self):
+        if self.payload is not None:
+            payload, self.payload = self.payload, None
+            self.serializer.decode_payload(self, payload)
+
+    def __missing__(self, key):
+        if self.payload is None:
+            raise KeyError(key)
+        self.decode()
+        return self[key]
+
+    def __contains__(self, key):
+        if not dict.__contains__(self, key):
+            self.decode()
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        if not dict.__contains__(self, key):
+            self.decode()
+        return dict.get(self, key, default)
+
+
+def handshake_done(msgs):
+    """
+    The handshake is complete once verack is received; version and
+    sendaddrv2 (BIP155) are always sent before it.
+    """
+    return any(msg['command'] == b'verack' for msg in msgs)
+
+
+def getaddr_done(msgs, max_addrs=GETADDR_MAX_ADDRS):
+    """
+    Collecting addresses is complete once max_addrs addresses have been
+    received; otherwise addr messages are collected until the deadline, since
+    a node may split its reply to getaddr across several messages.
+    """
+    count = 0
+    for msg in msgs:
+        if msg['command'] in ADDR_COMMANDS:
+            count += len(msg['addr_list'])
+    return count >= max_addrs
+
+
 class Serializer(object):
     def __init__(self, **conf):
         self.magic_number = conf.get('magic_number', MAGIC_NUMBER)
@@ -318,6 +632,19 @@ class Serializer(object):
         if self.height is None:
             self.height = HEIGHT
         self.relay = conf.get('relay', RELAY)
+        # Set to 'tuple' to receive the addresses of addr/addrv2 messages as
+        # compact tuples (see ADDR_RECORD_FIELDS) instead of dicts.
+        self.addr_format = conf.get('addr_format', 'dict')
+
+        # Commands whose payloads are decoded (all of them if None). The
+        # checksum of every message is verified, but the other messages
+        # only carry their header, or are decoded when their fields are first
+        # accessed if lazy_payloads is set (see LazyMessage).
+        self.decode_commands = conf.get('decode_commands', None)
+        if self.decode_commands is not None:
+            self.decode_commands = frozenset(self.decode_commands).union(
+                REPLY_COMMANDS)
+        self.lazy_payloads = conf.get('lazy_payloads', False)
 
         # This is set prior to throwing PayloadTooShortError exception to
         # allow caller to fetch more data over the network.
@@ -344,6 +671,9 @@ class Serializer(object):
         elif command == b'addr':
             addr_list = kwargs['addr_list']
             payload = self.serialize_addr_payload(addr_list)
+        elif command == b'addrv2':
+            addr_list = kwargs['addr_list']
+            payload = self.serialize_addr_payload(addr_list, version=2)
         elif command == b'inv' or command == b'getdata':
             inventory = kwargs['inventory']
             payload = self.serialize_inv_payload(inventory)
@@ -365,60 +695,83 @@ class Serializer(object):
         return b''.join(msg)
 
     def deserialize_msg(self, data):
-        msg = {}
-
         data_len = len(data)
         if data_len < HEADER_LEN:
             raise HeaderTooShortError(f'got {data_len} of {HEADER_LEN} bytes')
 
-        data = BytesIO(data)
-        header = data.read(HEADER_LEN)
-        msg.update(self.deserialize_header(header))
+        msg = self.deserialize_header(data)
 
-        if (data_len - HEADER_LEN) < msg['length']:
-            self.required_len = HEADER_LEN + msg['length']
+        end = HEADER_LEN + msg['length']
+        if data_len < end:
+            self.required_len = end
             raise PayloadTooShortError(
                 f'got {data_len} of {self.required_len} bytes')
 
-        payload = data.read(msg['length'])
+        msg = self.deserialize_payload(msg, data[HEADER_LEN:end])
+
+        return (msg, data[end:])
+
+    def deserialize_header(self, data):
+        """
+        Decodes the first HEADER_LEN bytes of data (bytes or memoryview).
+        """
+        (magic_number, command, length, checksum) = HEADER_STRUCT.unpack_from(
+            data)
+        if magic_number != self.magic_number:
+            raise InvalidMagicNumberError(
+                f'{hexlify(magic_number)} != {hexlify(self.magic_number)}')
+
+        return {
+            'magic_number': magic_number,
+            'command': command.strip(b'\x00'),
+            'length': length,
+            'checksum': checksum,
+        }
+
+    def deserialize_payload(self, msg, payload):
+        """
+        Verifies the checksum of the payload (bytes or memoryview) of the
+        message whose header is msg, and decodes the payload according to
+        decode_commands. Returns the message.
+        """
         computed_checksum = sha256(sha256(payload))[:4]
         if computed_checksum != msg['checksum']:
             raise InvalidPayloadChecksum(
                 f"{hexlify(computed_checksum)} != {hexlify(msg['checksum'])}")
 
-        if msg['command'] == b'version':
-            msg.update(self.deserialize_version_payload(payload))
-        elif msg['command'] == b'ping' or msg['command'] == b'pong':
-            msg.update(self.deserialize_ping_payload(payload))
-        elif msg['command'] == b'addr':
+        if (self.decode_commands is None
+                or msg['command'] in self.decode_commands):
+            return self.decode_payload(msg, payload)
+        if self.lazy_payloads:
+            # The payload may be a view of a reused buffer.
+            return LazyMessage(msg, bytes(payload), self)
+        return msg
+
+    def decode_payload(self, msg, payload):
+        """
+        Adds the decoded payload to msg. Returns msg.
+        """
+        command = msg['command']
+        if command == b'addr':
             msg.update(self.deserialize_addr_payload(payload))
-        elif msg['command'] == b'addrv2':
+            return msg
+        elif command == b'addrv2':
             msg.update(self.deserialize_addr_payload(payload, version=2))
-        elif msg['command'] == b'inv':
+            return msg
+
+        # The other decoders read from BytesIO, which copies the payload.
+        if command == b'version':
+            msg.update(self.deserialize_version_payload(payload))
+        elif command == b'ping' or command == b'pong':
+            msg.update(self.deserialize_ping_payload(payload))
+        elif command == b'inv':
             msg.update(self.deserialize_inv_payload(payload))
-        elif msg['command'] == b'tx':
+        elif command == b'tx':
             msg.update(self.deserialize_tx_payload(payload))
-        elif msg['command'] == b'block':
-            msg.update(self.deserialize_block_payload(payload))
-        elif msg['command'] == b'headers':
+        elif command == b'block':
+            msg.update(self.deserialize_block_payload(bytes(payload)))
+        elif command == b'headers':
             msg.update(self.deserialize_block_headers_payload(payload))
-
-        return (msg, data.read())
-
-    def deserialize_header(self, data):
-        msg = {}
-        data = BytesIO(data)
-
-        msg['magic_number'] = data.read(4)
-        if msg['magic_number'] != self.magic_number:
-            raise InvalidMagicNumberError(
-                f"{hexlify(msg['magic_number'])} "
-                f"!= {hexlify(self.magic_number)}")
-
-        msg['command'] = data.read(12).strip(b'\x00')
-        msg['length'] = struct.unpack('<I', data.read(4))[0]
-        msg['checksum'] = data.read(4)
-
         return msg
 
     def serialize_version_payload(self, to_addr, from_addr):
@@ -481,24 +834,33 @@ class Serializer(object):
         }
         return msg
 
-    def serialize_addr_payload(self, addr_list):
+    def serialize_addr_payload(self, addr_list, version=None):
         payload = [
             self.serialize_int(len(addr_list)),
         ]
-        payload.extend(
-            [self.serialize_network_address(addr) for addr in addr_list])
+        payload.extend([
+            self.serialize_network_address(addr, version=version)
+            for addr in addr_list
+        ])
         return b''.join(payload)
 
     def deserialize_addr_payload(self, data, version=None):
+        """
+        Decodes the payload in a single pass over a memoryview, using
+        precompiled structs and offset arithmetic instead of reading each
+        field from a BytesIO.
+        """
         msg = {}
-        data = BytesIO(data)
+        view = memoryview(data)
 
-        msg['count'] = self.deserialize_int(data)
-        msg['addr_list'] = []
-        for _ in range(msg['count']):
-            network_address = self.deserialize_network_address(
-                data, has_timestamp=True, version=version)
-            msg['addr_list'].append(network_address)
+        msg['count'], offset = read_int(view, 0)
+        if version == 2:
+            addr_list = decode_addrv2_records(view, offset, msg['count'])
+        else:
+            addr_list = decode_addr_records(view, offset, msg['count'])
+        if self.addr_format != 'tuple':
+            addr_list = [addr_record_to_dict(record) for record in addr_list]
+        msg['addr_list'] = addr_list
 
         return msg
 
@@ -661,6 +1023,9 @@ class Serializer(object):
 
         if version == 2:
             network_address.append(self.serialize_int(services))
+            network_address.append(UINT8.pack(network_id))
+            network_address.append(
+                self.serialize_int(NETWORK_LENGTHS[network_id]))
 
             if network_id == NETWORK_TORV3:
                 # 32 bytes
@@ -883,13 +1248,15 @@ class Serializer(object):
         return (length, str)
 
     def serialize_int(self, length):
+        # The prefix is a single byte, so UINT8 rather than chr().encode(),
+        # which gives two bytes for values >= 0x80.
         if length < 0xFD:
-            return chr(length).encode()
+            return UINT8.pack(length)
         elif length <= 0xFFFF:
-            return chr(0xFD).encode() + struct.pack('<H', length)
+            return b'\xFD' + UINT16.pack(length)
         elif length <= 0xFFFFFFFF:
-            return chr(0xFE).encode() + struct.pack('<I', length)
-        return chr(0xFF).encode() + struct.pack('<Q', length)
+            return b'\xFE' + UINT32.pack(length)
+        return b'\xFF' + UINT64.pack(length)
 
     def deserialize_int(self, data):
         length = unpack('<B', data.read(1))
@@ -902,22 +1269,134 @@ class Serializer(object):
         return length
 
 
+class MessageFramer(object):
+    """
+    Incremental framer that splits the bytes received from a node into
+    messages. Received bytes are written straight into a reusable bytearray
+    (see writable() and advance(), e.g. with socket.recv_into()), the header
+    of each message is parsed once, and every complete message is decoded
+    from a memoryview of the buffer, so no received byte is copied more than
+    once however many messages arrive at once. The unparsed tail is moved to
+    the front of the buffer when it runs out of space at its end, and the
+    buffer only grows to fit a message larger than itself.
+
+    Iterating over the framer yields the complete messages buffered so far;
+    iteration can be resumed once more bytes have been received.
+    """
+    def __init__(self, serializer, size=4 * SOCKET_BUFSIZE):
+        self.serializer = serializer
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First byte not parsed yet.
+        self.end = 0  # End of the received bytes.
+        # Header of the next message, once parsed.
+        self.header = None
+
+    @property
+    def buffered(self):
+        """
+        Whether a partially received message is buffered.
+        """
+        return self.header is not None or self.end > self.start
+
+    @property
+    def missing(self):
+        """
+        Number of bytes still to receive to complete the next message.
+        """
+        available = self.end - self.start
+        if self.header is None:
+            return max(HEADER_LEN - available, 0)
+        return max(self.header['length'] - available, 0)
+
+    def writable(self, min_size=SOCKET_BUFSIZE):
+        """
+        Returns a memoryview of the free space at the end of the buffer, of
+        at least min_size bytes (or the bytes missing to complete the next
+        message, if more).
+        """
+        min_size = max(min_size, self.missing)
+        if len(self.buffer) - self.end < min_size:
+            unparsed = self.end - self.start
+            if len(self.buffer) - unparsed >= min_size:
+                self.view[:unparsed] = self.view[self.start:self.end]
+            else:
+                buffer = bytearray(max(2 * len(self.buffer),
+                                       unparsed + min_size))
+                buffer[:unparsed] = self.view[self.start:self.end]
+                self.view.release()
+                self.buffer = buffer
+                self.view = memoryview(self.buffer)
+            self.start, self.end = 0, unparsed
+        return self.view[self.end:]
+
+    def advance(self, length):
+        """
+        Marks length bytes written into writable() as received.
+        """
+        self.end += length
+
+    def feed(self, data):
+        """
+        Copies received bytes into the buffer.
+        """
+        self.writable(len(data))[:len(data)] = data
+        self.advance(len(data))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.header is None:
+            if self.end - self.start < HEADER_LEN:
+                raise StopIteration
+            self.header = self.serializer.deserialize_header(
+                self.view[self.start:self.start + HEADER_LEN])
+            self.start += HEADER_LEN
+
+        msg = self.header
+        end = self.start + msg['length']
+        if end > self.end:
+            raise StopIteration
+        self.header = None
+
+        payload = self.view[self.start:end]
+        self.start = end
+        if self.start == self.end:
+            self.start = self.end = 0
+        try:
+            return self.serializer.deserialize_payload(msg, payload)
+        finally:
+            payload.release()
+
+
 class Connection(object):
     def __init__(self, to_addr, from_addr=('0.0.0.0', 0), **conf):
         self.to_addr = to_addr
         self.from_addr = from_addr
         self.serializer = Serializer(**conf)
         self.socket_timeout = conf.get('socket_timeout', SOCKET_TIMEOUT)
+        # Deadline to open the connection (defaults to socket_timeout).
+        self.connect_timeout = conf.get('connect_timeout') or \
+            self.socket_timeout
+        self.handshake_timeout = conf.get('handshake_timeout',
+                                          HANDSHAKE_TIMEOUT)
+        self.getaddr_timeout = conf.get('getaddr_timeout', GETADDR_TIMEOUT)
+        self.getaddr_max_addrs = conf.get('getaddr_max_addrs',
+                                          GETADDR_MAX_ADDRS)
         self.proxy = conf.get('proxy', None)
         self.socket = None
+        # Received bytes not yet parsed into complete messages.
+        self.framer = MessageFramer(self.serializer)
         # Bits per second (bps) samples for this connection.
         self.bps = deque([], maxlen=128)
 
     def open(self):
         self.socket = create_connection(self.to_addr,
-                                        timeout=self.socket_timeout,
+                                        timeout=self.connect_timeout,
                                         source_address=self.from_addr,
                                         proxy=self.proxy)
+        self.socket.settimeout(self.socket_timeout)
 
     def close(self):
         if self.socket:
@@ -932,52 +1411,96 @@ class Connection(object):
         self.socket.sendall(data)
 
     def recv(self, length=0):
+        """
+        Receives at least length bytes (or whatever is available if length
+        is 0) straight into the framer. Returns the number of bytes received.
+        """
         start_t = time.time()
-        if length > 0:
-            chunks = []
-            while length > 0:
-                chunk = self.socket.recv(SOCKET_BUFSIZE)
-                if not chunk:
-                    raise RemoteHostClosedConnection(
-                        f'{self.to_addr} closed connection')
-                chunks.append(chunk)
-                length -= len(chunk)
-            data = b''.join(chunks)
-        else:
-            data = self.socket.recv(SOCKET_BUFSIZE)
-            if not data:
+        received = 0
+        while True:
+            nbytes = self.socket.recv_into(self.framer.writable())
+            if not nbytes:
                 raise RemoteHostClosedConnection(
                     f'{self.to_addr} closed connection')
-        if len(data) > SOCKET_BUFSIZE:
+            self.framer.advance(nbytes)
+            received += nbytes
+            if received >= length:
+                break
+        if received > SOCKET_BUFSIZE:
             end_t = time.time()
-            self.bps.append((len(data) * 8) / (end_t - start_t))
-        return data
+            self.bps.append((received * 8) / (end_t - start_t))
+        return received
 
     def get_messages(self, length=0, commands=None):
         msgs = []
-        data = self.recv(length=length)
-        while len(data) > 0:
+        if not self.framer.buffered:
+            self.recv(length=length)
+        while True:
             gevent.sleep(0)
-            try:
-                (msg, data) = self.serializer.deserialize_msg(data)
-            except PayloadTooShortError:
-                data += self.recv(
-                    length=self.serializer.required_len - len(data))
-                (msg, data) = self.serializer.deserialize_msg(data)
-            if msg.get('command') == b'ping':
-                self.pong(msg['nonce'])  # Respond to ping immediately.
-            elif msg.get('command') == b'version':
-                self.version_reply(msg)  # Respond to version immediately.
-            elif msg.get('command') == b'getheaders':
-                self.headers([])  # Respond to getheaders immediately.
-            msgs.append(msg)
+            for msg in self.framer:
+                self.handle_message(msg)
+                msgs.append(msg)
+            if not self.framer.buffered:
+                break
+            self.recv(length=self.framer.missing)
         if len(msgs) > 0 and commands:
             msgs[:] = [m for m in msgs if m.get('command') in commands]
         return msgs
 
+    def iter_messages(self, timeout=None):
+        """
+        Yields messages as they arrive, receiving more bytes whenever no
+        complete message is buffered, until timeout seconds have elapsed
+        (if set). Messages not consumed stay buffered.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            for msg in self.framer:
+                self.handle_message(msg)
+                yield msg
+            if deadline is None:
+                self.recv()
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            self.socket.settimeout(remaining)
+            try:
+                self.recv()
+            except socket.timeout:
+                return
+            finally:
+                self.socket.settimeout(self.socket_timeout)
+
+    def handle_message(self, msg):
+        if msg.get('command') == b'ping':
+            self.pong(msg['nonce'])  # Respond to ping immediately.
+        elif msg.get('command') == b'version':
+            self.version_reply(msg)  # Respond to version immediately.
+        elif msg.get('command') == b'getheaders':
+            self.headers([])  # Respond to getheaders immediately.
+
+    def wait_for_messages(self, done, timeout):
+        """
+        Reads messages until done(msgs) returns True or timeout seconds have
+        elapsed, whichever comes first. Returns all messages read.
+        """
+        msgs = []
+        if done(msgs):
+            return msgs
+        messages = self.iter_messages(timeout)
+        try:
+            for msg in messages:
+                msgs.append(msg)
+                if done(msgs):
+                    break
+        finally:
+            messages.close()
+        return msgs
+
     def version_reply(self, version):
         # 70016 is the min. protocol version to accept sendaddrv2.
-        if version.get('version', PROTOCOL_VERSION) >= 70016:
+        if version.get('version', self.serializer.protocol_version) >= 70016:
             # [sendaddrv2] + [verack] >>>
             msg = self.serializer.serialize_msg(command=b'sendaddrv2') \
                 + self.serializer.serialize_msg(command=b'verack')
@@ -989,7 +1512,7 @@ class Connection(object):
     def set_min_version(self, version):
         self.serializer.protocol_version = min(
             self.serializer.protocol_version,
-            version.get('version', PROTOCOL_VERSION))
+            version.get('version', self.serializer.protocol_version))
 
     def set_addrv2(self, sendaddrv2):
         self.serializer.addr_version = 2 if sendaddrv2 else None
@@ -1001,10 +1524,9 @@ class Connection(object):
         self.send(msg)
 
         # <<< [version 124 bytes] [sendaddrv2 24 bytes] [verack 24 bytes]
-        gevent.sleep(1)
         version_msg = {}
-        msgs = self.get_messages(
-            commands=[b'version', b'sendaddrv2', b'verack'])
+        msgs = self.wait_for_messages(handshake_done, self.handshake_timeout)
+        msgs = [msg for msg in msgs if msg['command'] in HANDSHAKE_COMMANDS]
         if len(msgs) > 0:
             version_msg = next(
                 (msg for msg in msgs if msg['command'] == b'version'), {})
@@ -1025,9 +1547,10 @@ class Connection(object):
             return None
 
         # <<< [addr]..
-        gevent.sleep(1)
-        msgs = self.get_messages(commands=[b'addr', b'addrv2'])
-        return msgs
+        msgs = self.wait_for_messages(
+            lambda msgs: getaddr_done(msgs, self.getaddr_max_addrs),
+            self.getaddr_timeout)
+        return [msg for msg in msgs if msg['command'] in ADDR_COMMANDS]
 
     def addr(self, addr_list):
         if self.serializer.addr_version == 2:
@@ -1119,6 +1642,209 @@ class Connection(object):
         self.send(msg)
 
 
+class AsyncConnection(object):
+    """
+    Non-blocking variant of Connection for use from an asyncio event loop.
+    Only the subset of commands needed for crawling is implemented.
+    """
+    def __init__(self, to_addr, from_addr=('0.0.0.0', 0), **conf):
+        self.to_addr = to_addr
+        self.from_addr = from_addr
+        self.serializer = Serializer(**conf)
+        self.socket_timeout = conf.get('socket_timeout', SOCKET_TIMEOUT)
+        # Deadline to open the connection (defaults to socket_timeout).
+        self.connect_timeout = conf.get('connect_timeout') or \
+            self.socket_timeout
+        self.handshake_timeout = conf.get('handshake_timeout',
+                                          HANDSHAKE_TIMEOUT)
+        self.getaddr_timeout = conf.get('getaddr_timeout', GETADDR_TIMEOUT)
+        self.getaddr_max_addrs = conf.get('getaddr_max_addrs',
+                                          GETADDR_MAX_ADDRS)
+        self.proxy = conf.get('proxy', None)
+        self.reader = None
+        self.writer = None
+        # Received bytes not yet parsed into complete messages.
+        self.framer = MessageFramer(self.serializer)
+
+    async def open(self):
+        self.reader, self.writer = await open_async_connection(
+            self.to_addr,
+            timeout=self.connect_timeout,
+            source_address=self.from_addr,
+            proxy=self.proxy)
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (socket.error, asyncio.IncompleteReadError):
+                pass
+
+    async def send(self, data):
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), self.socket_timeout)
+
+    async def recv(self, length=0, timeout=None):
+        """
+        Receives at least length bytes (or whatever is available if length
+        is 0) into the framer. Returns the number of bytes received.
+        """
+        if timeout is None:
+            timeout = self.socket_timeout
+        received = 0
+        while True:
+            # StreamReader has no readinto(), so each chunk is copied once
+            # into the framer.
+            data = await asyncio.wait_for(
+                self.reader.read(max(SOCKET_BUFSIZE, length - received)),
+                timeout)
+            if not data:
+                raise RemoteHostClosedConnection(
+                    f'{self.to_addr} closed connection')
+            self.framer.feed(data)
+            received += len(data)
+            if received >= length:
+                return received
+
+    async def get_messages(self, length=0, commands=None):
+        msgs = []
+        if not self.framer.buffered:
+            await self.recv(length=length)
+        while True:
+            for msg in self.framer:
+                await self.handle_message(msg)
+                msgs.append(msg)
+            if not self.framer.buffered:
+                break
+            await self.recv(length=self.framer.missing)
+        if len(msgs) > 0 and commands:
+            msgs[:] = [m for m in msgs if m.get('command') in commands]
+        return msgs
+
+    async def iter_messages(self, timeout=None):
+        """
+        Asynchronous iterator over the messages as they arrive (see
+        Connection.iter_messages).
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            for msg in self.framer:
+                await self.handle_message(msg)
+                yield msg
+            if deadline is None:
+                await self.recv()
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            try:
+                await self.recv(timeout=remaining)
+            except asyncio.TimeoutError:
+                return
+
+    async def handle_message(self, msg):
+        if msg.get('command') == b'ping':
+            await self.pong(msg['nonce'])
+        elif msg.get('command') == b'version':
+            await self.version_reply(msg)
+        elif msg.get('command') == b'getheaders':
+            await self.headers([])
+
+    async def wait_for_messages(self, done, timeout):
+        """
+        Reads messages until done(msgs) returns True or timeout seconds have
+        elapsed, whichever comes first. Returns all messages read.
+        """
+        msgs = []
+        if done(msgs):
+            return msgs
+        messages = self.iter_messages(timeout)
+        try:
+            async for msg in messages:
+                msgs.append(msg)
+                if done(msgs):
+                    break
+        finally:
+            await messages.aclose()
+        return msgs
+
+    async def version_reply(self, version):
+        # 70016 is the min. protocol version to accept sendaddrv2.
+        if version.get('version', self.serializer.protocol_version) >= 70016:
+            # [sendaddrv2] + [verack] >>>
+            msg = self.serializer.serialize_msg(command=b'sendaddrv2') \
+                + self.serializer.serialize_msg(command=b'verack')
+        else:
+            # [verack] >>>
+            msg = self.serializer.serialize_msg(command=b'verack')
+        await self.send(msg)
+
+    def set_min_version(self, version):
+        self.serializer.protocol_version = min(
+            self.serializer.protocol_version,
+            version.get('version', self.serializer.protocol_version))
+
+    def set_addrv2(self, sendaddrv2):
+        self.serializer.addr_version = 2 if sendaddrv2 else None
+
+    async def handshake(self):
+        # [version] >>>
+        msg = self.serializer.serialize_msg(
+            command=b'version', to_addr=self.to_addr, from_addr=self.from_addr)
+        await self.send(msg)
+
+        # <<< [version 124 bytes] [sendaddrv2 24 bytes] [verack 24 bytes]
+        version_msg = {}
+        msgs = await self.wait_for_messages(handshake_done,
+                                            self.handshake_timeout)
+        msgs = [msg for msg in msgs if msg['command'] in HANDSHAKE_COMMANDS]
+        if len(msgs) > 0:
+            version_msg = next(
+                (msg for msg in msgs if msg['command'] == b'version'), {})
+            self.set_min_version(version_msg)
+            sendaddrv2_msg = next(
+                (msg for msg in msgs if msg['command'] == b'sendaddrv2'), None)
+            self.set_addrv2(sendaddrv2_msg)
+
+        return version_msg
+
+    async def getaddr(self, block=True):
+        # [getaddr] >>>
+        msg = self.serializer.serialize_msg(command=b'getaddr')
+        await self.send(msg)
+
+        # Caller should call get_messages separately.
+        if not block:
+            return None
+
+        # <<< [addr]..
+        msgs = await self.wait_for_messages(
+            lambda msgs: getaddr_done(msgs, self.getaddr_max_addrs),
+            self.getaddr_timeout)
+        return [msg for msg in msgs if msg['command'] in ADDR_COMMANDS]
+
+    async def ping(self, nonce=None):
+        if nonce is None:
+            nonce = random.getrandbits(64)
+
+        # [ping] >>>
+        msg = self.serializer.serialize_msg(command=b'ping', nonce=nonce)
+        await self.send(msg)
+
+    async def pong(self, nonce):
+        # [pong] >>>
+        msg = self.serializer.serialize_msg(command=b'pong', nonce=nonce)
+        await self.send(msg)
+
+    async def headers(self, headers):
+        # [headers] >>>
+        msg = self.serializer.serialize_msg(
+            command=b'headers', headers=headers)
+        await self.send(msg)
+
+
 def main():
     logformat = ('[%(process)d] %(asctime)s,%(msecs)05.1f %(levelname)s '
                  '(%(funcName)s) %(message)s')
@@ -0,0 +1,314 @@
+"""
+Reachability of the endpoints crawled, persisted between runs: connect timeouts adapted to each network type and a
+negative cache of the endpoints that could not be connected to.
+
+- Connect timeouts: the time needed to open a connection is recorded for every node reached, per network type (ipv4,
+  ipv6, onion). The connect timeout of a network type is a multiple of a high percentile of its recent connect times,
+  within bounds, so that unreachable addresses (most of those gossiped in addr messages) release their slot as soon as
+  a reachable node would have answered. Until enough connect times are known, the maximum timeout is used.
+- Negative cache: an endpoint that could not be reached (no connection, or no completed handshake) is skipped for a
+  backoff period, which doubles after every further consecutive failure (up to a maximum) and is reset once the
+  endpoint is reached again.
+- Scheduling: the number of connection attempts and successes and the time of the last attempt and success of every
+  endpoint are kept, so that each run only probes the known endpoints likely to answer. The expected yield of an
+  endpoint is its success rate (with one success and one failure as prior, so unknown endpoints start at 0.5), halved
+  for every half-life elapsed since its last success. Endpoints whose expected yield is below a threshold are dropped,
+  except for a share of exploration probes spent on those attempted least recently, so that chronically dead addresses
+  are still probed, less and less often as more addresses accumulate. The crawl thus tracks the live network rather
+  than the union of all addresses ever gossiped.
+
+The negative cache and the attempts are kept per ledger, since the same address can run a node of one ledger and
+not of another one (a crawl of several ledgers shares one Reachability).
+
+All are kept in a SQLite database. Updates are buffered in memory and written in one transaction per flush.
+"""
+import collections
+import logging
+import pathlib
+import sqlite3
+import time
+
+NETWORK_TYPES = ('ipv4', 'ipv6', 'onion')
+SAMPLE_SIZE = 1000  # Number of recent connect times kept per network type
+MIN_SAMPLES = 50  # Number of connect times needed before the connect timeout of a network type adapts to them
+RECOMPUTE_EVERY = 50  # Number of new connect times after which the connect timeout of a network type is recomputed
+DEFAULT_PERCENTILE = 95
+DEFAULT_MULTIPLIER = 2
+DEFAULT_MIN_CONNECT_TIMEOUT = 1
+DEFAULT_MAX_CONNECT_TIMEOUT = 30
+DEFAULT_MAX_ONION_CONNECT_TIMEOUT = 60  # Connections through Tor build a circuit first
+DEFAULT_BACKOFF_HOURS = 24
+DEFAULT_MAX_BACKOFF_DAYS = 30
+DEFAULT_MIN_EXPECTED_YIELD = 0.2
+DEFAULT_YIELD_HALF_LIFE_DAYS = 30
+DEFAULT_EXPLORE = 0.1
+FLUSH_SIZE = 5000  # Number of buffered updates after which they are written
+
+
+def get_network_type(ip):
+    """
+    :returns: the network type of an address: 'onion', 'ipv6' or 'ipv4'
+    """
+    if ip.endswith('.onion'):
+        return 'onion'
+    return 'ipv6' if ':' in ip else 'ipv4'
+
+
+def percentile(values, pct):
+    """
+    :param values: non-empty sorted list of numbers
+    :param pct: the percentile, between 0 and 100
+    :returns: the value below which pct percent of the values fall (nearest rank)
+    """
+    rank = max(0, min(len(values) - 1, int(round(pct / 100 * len(values))) - 1))
+    return values[rank]
+
+
+class Reachability(object):
+    """
+    :param path: the path of the SQLite database
+    :param connect_percentile: optional, the percentile of the recent connect times the connect timeout is based on
+    :param connect_multiplier: optional, the factor applied to that percentile
+    :param min_connect_timeout: optional, the lower bound of the connect timeout (seconds)
+    :param max_connect_timeout: optional, the upper bound of the connect timeout (seconds), also used until enough
+    connect times are known
+    :param max_onion_connect_timeout: optional, the same for onion addresses
+    :param backoff_hours: optional, the number of hours an endpoint is skipped after a failure (0 disables the negative
+    cache)
+    :param max_backoff_days: optional, the maximum number of days an endpoint is skipped
+    """
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS failures (
+            ledger TEXT NOT NULL,
+            ip TEXT NOT NULL,
+            port INTEGER NOT NULL,
+            failures INTEGER NOT NULL,
+            last_failure REAL NOT NULL,
+            retry_at REAL NOT NULL,
+            PRIMARY KEY (ledger, ip, port))''',
+        '''CREATE TABLE IF NOT EXISTS connect_times (
+            network TEXT NOT NULL,
+            seconds REAL NOT NULL,
+            measured_at REAL NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS endpoints (
+            ledger TEXT NOT NULL,
+            ip TEXT NOT NULL,
+            port INTEGER NOT NULL,
+            attempts INTEGER NOT NULL,
+            successes INTEGER NOT NULL,
+            last_attempt REAL NOT NULL,
+            last_success REAL,
+            PRIMARY KEY (ledger, ip, port))''',
+    ]
+
+    def __init__(self, path, connect_percentile=DEFAULT_PERCENTILE, connect_multiplier=DEFAULT_MULTIPLIER,
+                 min_connect_timeout=DEFAULT_MIN_CONNECT_TIMEOUT, max_connect_timeout=DEFAULT_MAX_CONNECT_TIMEOUT,
+                 max_onion_connect_timeout=DEFAULT_MAX_ONION_CONNECT_TIMEOUT, backoff_hours=DEFAULT_BACKOFF_HOURS,
+                 max_backoff_days=DEFAULT_MAX_BACKOFF_DAYS):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connect_percentile = connect_percentile
+        self.connect_multiplier = connect_multiplier
+        self.min_connect_timeout = min_connect_timeout
+        self.max_connect_timeouts = {network: max_connect_timeout for network in NETWORK_TYPES}
+        self.max_connect_timeouts['onion'] = max_onion_connect_timeout
+        self.backoff = backoff_hours * 3600
+        self.max_backoff = max_backoff_days * 86400
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection as conn:
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(failures)')]
+            if columns and 'ledger' not in columns:  # Databases that were not kept per ledger are started afresh
+                logging.warning(f'Resetting the negative cache and endpoint stats of {self.path}')
+                conn.execute('DROP TABLE failures')
+                conn.execute('DROP TABLE endpoints')
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+
+        self.samples = {network: collections.deque(maxlen=SAMPLE_SIZE) for network in NETWORK_TYPES}
+        for network, samples in self.samples.items():
+            rows = self.connection.execute(
+                'SELECT seconds FROM connect_times WHERE network = ? ORDER BY measured_at DESC LIMIT ?',
+                (network, SAMPLE_SIZE)).fetchall()
+            samples.extend(seconds for seconds, in reversed(rows))
+        self.timeouts = {network: self.compute_timeout(network) for network in NETWORK_TYPES}
+        self.new_samples = collections.Counter()
+
+        # Consecutive failures of the endpoints in the negative cache, and the time until which they are skipped
+        self.failures = {}
+        self.retry_at = {}
+        for ledger, ip, port, failures, retry_at in self.connection.execute(
+                'SELECT ledger, ip, port, failures, retry_at FROM failures'):
+            self.failures[(ledger, ip, port)] = failures
+            self.retry_at[(ledger, ip, port)] = retry_at
+        self.pending_samples = []
+        self.pending_failures = {}
+        self.pending_successes = set()
+        self.pending_attempts = {}  # (ledger, ip, port) -> [attempts, successes, last attempt, last success]
+
+    def compute_timeout(self, network):
+        samples = self.samples[network]
+        if len(samples) < MIN_SAMPLES:
+            return self.max_connect_timeouts[network]
+        timeout = self.connect_multiplier * percentile(sorted(samples), self.connect_percentile)
+        return min(self.max_connect_timeouts[network], max(self.min_connect_timeout, timeout))
+
+    def connect_timeout(self, ip):
+        """
+        :param ip: the ip address (or onion address) to connect to
+        :returns: the connect timeout for the network type of the address, in seconds
+        """
+        return self.timeouts[get_network_type(ip)]
+
+    def is_backed_off(self, ledger, ip, port):
+        """
+        :returns: True if the endpoint failed recently and should not be connected to yet for this ledger
+        """
+        return self.retry_at.get((ledger, ip, port), 0) > time.time()
+
+    def record_success(self, ledger, ip, port, connect_time):
+        """
+        Records that the node of a ledger was reached (the handshake completed), which removes it from the negative
+        cache.
+        :param connect_time: the number of seconds it took to open the connection
+        """
+        network = get_network_type(ip)
+        self.samples[network].append(connect_time)
+        self.new_samples[network] += 1
+        if self.new_samples[network] >= RECOMPUTE_EVERY:
+            self.timeouts[network] = self.compute_timeout(network)
+            self.new_samples[network] = 0
+        now = time.time()
+        self.pending_samples.append((network, connect_time, now))
+        key = (ledger, ip, port)
+        self.add_attempt(key, now, success=True)
+        if key in self.failures:
+            del self.failures[key], self.retry_at[key]
+            self.pending_failures.pop(key, None)
+            self.pending_successes.add(key)
+        self.flush_if_full()
+
+    def record_failure(self, ledger, ip, port):
+        """
+        Records that the node of a ledger could not be reached (the connection could not be opened or the handshake did
+        not complete), which adds it to the negative cache or doubles its backoff.
+        """
+        key = (ledger, ip, port)
+        now = time.time()
+        self.add_attempt(key, now, success=False)
+        if not self.backoff:
+            self.flush_if_full()
+            return
+        failures = self.failures.get(key, 0) + 1
+        self.failures[key] = failures
+        self.retry_at[key] = now + min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+        self.pending_failures[key] = (failures, now, self.retry_at[key])
+        self.pending_successes.discard(key)
+        self.flush_if_full()
+
+    def add_attempt(self, key, now, success):
+        attempt = self.pending_attempts.setdefault(key, [0, 0, now, None])
+        attempt[0] += 1
+        attempt[2] = now
+        if success:
+            attempt[1] += 1
+            attempt[3] = now
+
+    def flush_if_full(self):
+        if len(self.pending_samples) + len(self.pending_failures) + len(self.pending_attempts) >= FLUSH_SIZE:
+            self.flush()
+
+    def get_stats(self, ledger):
+        """
+        :param ledger: the ledger of the endpoints
+        :returns: dictionary mapping the (ip, port) pairs of the endpoints of the ledger attempted in previous runs to
+        their (attempts, successes, last attempt, last success) tuple. The last success is None for the endpoints never
+        reached.
+        """
+        self.flush()
+        rows = self.connection.execute(
+            'SELECT ip, port, attempts, successes, last_attempt, last_success FROM endpoints WHERE ledger = ?',
+            (ledger,))
+        return {(ip, port): tuple(stats) for ip, port, *stats in rows}
+
+    @staticmethod
+    def expected_yield(stats, now, half_life_days=DEFAULT_YIELD_HALF_LIFE_DAYS):
+        """
+        :param stats: the (attempts, successes, last attempt, last success) tuple of an endpoint, or None if it was
+        never attempted
+        :param now: the current time (seconds since the epoch)
+        :param half_life_days: optional, the number of days after which the expected yield of an endpoint that has not
+        been reached since is halved
+        :returns: the estimated probability that the endpoint answers
+        """
+        if stats is None:
+            return 0.5
+        attempts, successes, _, last_success = stats
+        expected = (successes + 1) / (attempts + 2)
+        if last_success is not None:
+            expected *= 0.5 ** ((now - last_success) / (half_life_days * 86400))
+        return expected
+
+    def schedule(self, ledger, endpoints, min_expected_yield=DEFAULT_MIN_EXPECTED_YIELD, budget=0,
+                 explore=DEFAULT_EXPLORE, half_life_days=DEFAULT_YIELD_HALF_LIFE_DAYS):
+        """
+        Chooses the endpoints to probe in a run, among the known ones.
+        :param ledger: the ledger of the endpoints
+        :param endpoints: iterable of distinct (ip, port) pairs
+        :param min_expected_yield: optional, the expected yield below which an endpoint is not probed, unless it is
+        picked for exploration
+        :param budget: optional, the maximum number of endpoints to probe (0: no limit)
+        :param explore: optional, the number of endpoints picked for exploration among those below min_expected_yield
+        (least recently attempted first), as a fraction of those chosen by expected yield, and at least one
+        :param half_life_days: optional, see expected_yield
+        :returns: list of the chosen (ip, port) pairs, by decreasing expected yield followed by the exploration probes
+        """
+        now = time.time()
+        stats = self.get_stats(ledger)
+        ranked = sorted(
+            ((self.expected_yield(stats.get(endpoint), now, half_life_days), endpoint)
+             for endpoint in endpoints if not self.is_backed_off(ledger, *endpoint)),
+            key=lambda item: item[0], reverse=True)
+        chosen = [endpoint for expected, endpoint in ranked if expected >= min_expected_yield]
+        rest = [endpoint for expected, endpoint in ranked if expected < min_expected_yield]
+        rest.sort(key=lambda endpoint: stats[endpoint][2] if endpoint in stats else 0)
+        # Every endpoint below the threshold is eventually probed again, even when none is above it
+        explore_count = max(1, int(len(chosen) * explore)) if rest else 0
+        if budget:
+            explore_count = min(explore_count, max(1, int(budget * explore)) if rest else 0, budget)
+            chosen = chosen[:budget - explore_count]
+        return chosen + rest[:explore_count]
+
+    def flush(self):
+        """
+        Writes all buffered updates in a single transaction.
+        """
+        with self.connection as conn:
+            conn.executemany('INSERT INTO connect_times (network, seconds, measured_at) VALUES (?, ?, ?)',
+                             self.pending_samples)
+            conn.executemany(
+                'INSERT OR REPLACE INTO failures (ledger, ip, port, failures, last_failure, retry_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [key + values for key, values in self.pending_failures.items()])
+            conn.executemany('DELETE FROM failures WHERE ledger = ? AND ip = ? AND port = ?', self.pending_successes)
+            conn.executemany(
+                'INSERT INTO endpoints (ledger, ip, port, attempts, successes, last_attempt, last_success) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (ledger, ip, port) DO UPDATE SET '
+                'attempts = attempts + excluded.attempts, successes = successes + excluded.successes, '
+                'last_attempt = MAX(last_attempt, excluded.last_attempt), '
+                'last_success = COALESCE(excluded.last_success, last_success)',
+                [key + tuple(values) for key, values in self.pending_attempts.items()])
+            if self.pending_samples:
+                for network in NETWORK_TYPES:
+                    conn.execute(
+                        'DELETE FROM connect_times WHERE network = ? AND rowid NOT IN ('
+                        'SELECT rowid FROM connect_times WHERE network = ? ORDER BY measured_at DESC LIMIT ?)',
+                        (network, network, SAMPLE_SIZE))
+        self.pending_samples.clear()
+        self.pending_failures.clear()
+        self.pending_successes.clear()
+        self.pending_attempts.clear()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
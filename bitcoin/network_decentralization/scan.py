@@ -0,0 +1,146 @@
+"""
+Single-pass analysis of the node histories held in the observation store.
+
+Every analysis is a visitor that is fed the history of each node. scan_ledger() reads the history of every node exactly
+once and hands it to all visitors, optionally splitting the nodes into shards that are scanned by a pool of worker
+processes. Each worker runs its own copies of the visitors, which are then merged into the visitors given by the
+caller, so visitors must be picklable (module-level classes with plain attributes).
+"""
+import copy
+import logging
+import multiprocessing
+from collections import defaultdict
+
+import network_decentralization.helper as hlp
+from network_decentralization.store import chunks
+
+SHARDS_PER_PROCESS = 4
+
+
+class Visitor(object):
+    """
+    Base class of the analyses run by scan_ledger(). Subclasses override visit_entry() (per-entry analyses) or
+    visit_node() (analyses that need the whole history), and merge() to combine the partial results of two shards.
+    """
+
+    def visit_node(self, ip, entries):
+        for entry in entries:
+            self.visit_entry(ip, entry)
+
+    def visit_entry(self, ip, entry):
+        pass
+
+    def merge(self, other):
+        raise NotImplementedError
+
+
+class EdgesVisitor(Visitor):
+    """
+    Collects the (source, dest) edges reported in the last days, where dest was reachable during the same days.
+    """
+
+    def __init__(self, days=7):
+        self.dates = hlp.get_last_days(days)
+        self.reachable_nodes = set()
+        self.edges = set()
+
+    def visit_entry(self, ip, entry):
+        if entry['date'].split()[0] in self.dates:
+            if entry['status']:
+                self.reachable_nodes.add(ip)
+            for addr in entry['addresses']:
+                self.edges.add((ip, addr[0]))
+
+    def merge(self, other):
+        self.reachable_nodes |= other.reachable_nodes
+        self.edges |= other.edges
+
+    def result(self):
+        return [(source, dest) for source, dest in self.edges if dest in self.reachable_nodes]
+
+
+class ResponseLengthVisitor(Visitor):
+    """
+    Groups nodes by the average number of addresses they return.
+    """
+
+    def __init__(self):
+        self.response_length = defaultdict(list)
+
+    def visit_node(self, ip, entries):
+        received_addrs = [len(entry['addresses']) for entry in entries if entry['addresses']]
+        if received_addrs:
+            avg_responses = sum(received_addrs) / len(received_addrs)
+            self.response_length[int(avg_responses)].append(ip)
+
+    def merge(self, other):
+        for key, val in other.response_length.items():
+            self.response_length[key].extend(val)
+
+
+class ConvergenceVisitor(Visitor):
+    """
+    Groups nodes by the index of the first entry in which less than convergence_param % of the received addresses
+    were new (-1 for nodes that never converged).
+    """
+
+    def __init__(self, convergence_param=0.1):
+        self.convergence_param = convergence_param
+        self.convergence = defaultdict(list)
+
+    def visit_node(self, ip, entries):
+        received_addrs = set()
+        for entry_idx, entry in enumerate(entries):
+            if entry['addresses']:
+                new_addrs = set()
+                for addr in entry['addresses']:
+                    if addr[0] not in received_addrs:
+                        new_addrs.add(addr[0])
+                        received_addrs.add(addr[0])
+                if 100*len(new_addrs) / len(entry['addresses']) < self.convergence_param:
+                    self.convergence[entry_idx].append(ip)
+                    return
+        if received_addrs:
+            self.convergence[-1].append(ip)
+
+    def merge(self, other):
+        for key, val in other.convergence.items():
+            self.convergence[key].extend(val)
+
+
+def scan_shard(ledger, ips, visitors):
+    """
+    Runs the visitors over the histories of a subset of the nodes (executed in a worker process).
+    :returns: the visitors
+    """
+    for ip, entries in hlp.get_store().iter_histories(ledger, ips):
+        for visitor in visitors:
+            visitor.visit_node(ip, entries)
+    return visitors
+
+
+def scan_ledger(ledger, visitors, processes=1):
+    """
+    Reads the history of every node of a ledger once and feeds it to all visitors.
+    :param ledger: the ledger of the nodes
+    :param visitors: list of Visitor objects, updated in place
+    :param processes: optional, the number of worker processes. If 1, the scan runs in the current process.
+    :returns: the visitors
+    """
+    store = hlp.get_store()
+    if processes <= 1:
+        for ip, entries in store.iter_histories(ledger):
+            for visitor in visitors:
+                visitor.visit_node(ip, entries)
+        return visitors
+
+    node_ips = store.list_nodes(ledger)
+    shard_size = max(1, -(-len(node_ips) // (processes * SHARDS_PER_PROCESS)))
+    shards = list(chunks(node_ips, shard_size))
+    logging.info(f'{ledger} - Scanning {len(node_ips):,} nodes in {len(shards)} shards with {processes} processes')
+    args = [(ledger, shard, copy.deepcopy(visitors)) for shard in shards]
+    with multiprocessing.Pool(processes=processes) as pool:
+        for shard_visitors in pool.starmap(scan_shard, args, chunksize=1):
+            for visitor, shard_visitor in zip(visitors, shard_visitors):
+                visitor.merge(shard_visitor)
+    return visitors
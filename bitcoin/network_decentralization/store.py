@@ -0,0 +1,568 @@
+"""
+Storage backends for the observations made about nodes during the crawls.
+
+An observation is the outcome of one connection attempt to a node, i.e. a dictionary with the keys 'ledger', 'ip',
+'date', 'port', 'version', 'protocol', 'status' and 'addresses'. Without 'ledger' and 'ip' it is an entry of the node's
+history, in the same format as the one used by the original one-file-per-node layout.
+
+Two backends are available:
+- JsonStore: one JSON file per node under <output>/<ledger>/<ip> (original layout)
+- SqliteStore: a single SQLite database with one row per observation, indexed by ledger, ip, date and status
+
+During a crawl, observations are written by an ObservationSink: the crawler puts them in a queue, and a single writer
+thread adds them to the store in batches, with one sync of the store per batch.
+"""
+import datetime
+import json
+import logging
+import os
+import pathlib
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+import zlib
+from collections import defaultdict
+
+DATE_FORMAT = '%d/%m/%Y %H:%M:%S'
+SQLITE_FILENAME = 'observations.db'
+SQLITE_MAX_VARIABLES = 500  # Max number of values bound to an "IN (...)" clause
+TAIL_BLOCK_SIZE = 65536  # Bytes read from the end of a history file when looking for its last entries
+ENTRY_START = b'{"date"'  # Every entry written by json.dump starts with its date
+SINK_BATCH_SIZE = 1000  # Maximum number of observations written at once by an ObservationSink
+SINK_FLUSH_INTERVAL = 5  # Maximum number of seconds an observation waits in an ObservationSink before being written
+
+
+def parse_date(date):
+    """
+    Converts the date of an entry to a datetime object.
+    :param date: string in DATE_FORMAT
+    :returns: datetime.datetime
+    """
+    return datetime.datetime.strptime(date, DATE_FORMAT)
+
+
+def to_iso_date(date):
+    """
+    Converts a DATE_FORMAT string ('dd/mm/YYYY HH:MM:SS') to a sortable ISO string ('YYYY-mm-dd HH:MM:SS').
+    """
+    return f'{date[6:10]}-{date[3:5]}-{date[0:2]}{date[10:]}'
+
+
+def from_iso_date(date):
+    """
+    Converts an ISO string ('YYYY-mm-dd HH:MM:SS') back to DATE_FORMAT ('dd/mm/YYYY HH:MM:SS').
+    """
+    return f'{date[8:10]}/{date[5:7]}/{date[0:4]}{date[10:]}'
+
+
+def chunks(items, size):
+    """
+    Splits a list into consecutive chunks of at most size items.
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class ObservationStore(object):
+    """
+    Interface shared by all backends. If the store has a node index (see node_index.py), the index is kept up to date
+    with the observations written and the nodes retired through the store.
+    """
+    index = None
+
+    def add_observations(self, observations):
+        """
+        Appends a batch of observations. Failed observations of nodes that have never been reachable are dropped, so
+        that only nodes that answered at least once get a history.
+        :param observations: iterable of observation dictionaries
+        """
+        known = set()
+        batch = []
+        for obs in observations:
+            key = (obs['ledger'], obs['ip'])
+            if obs['status'] or key in known or self.has_node(*key):
+                known.add(key)
+                batch.append(obs)
+        if batch:
+            self.write(batch)
+            if self.index is not None:
+                self.index.update(batch)
+
+    def write(self, observations):
+        raise NotImplementedError
+
+    def sync(self):
+        """
+        Makes the observations written so far durable.
+        """
+        pass
+
+    def has_node(self, ledger, ip):
+        """
+        :returns: True if the store holds at least one observation of the node
+        """
+        raise NotImplementedError
+
+    def list_nodes(self, ledger):
+        """
+        :returns: a list with the ip addresses of all nodes of the ledger
+        """
+        raise NotImplementedError
+
+    def get_history(self, ledger, ip):
+        """
+        :returns: the list of entries of the node, oldest first
+        """
+        raise NotImplementedError
+
+    def iter_histories(self, ledger, ips=None):
+        """
+        Iterates over the histories of the nodes of a ledger.
+        :param ledger: the ledger of the nodes
+        :param ips: optional, restricts the iteration to these nodes
+        :returns: generator of (ip, entries) pairs
+        """
+        raise NotImplementedError
+
+    def iter_tails(self, ledger, count, ips=None):
+        """
+        Iterates over the last entries of the histories of the nodes of a ledger.
+        :param ledger: the ledger of the nodes
+        :param count: the maximum number of entries per node
+        :param ips: optional, restricts the iteration to these nodes
+        :returns: generator of (ip, entries) pairs, where entries are the (at most) count most recent entries of the
+        node, oldest first
+        """
+        for ip, entries in self.iter_histories(ledger, ips):
+            yield ip, entries[-count:] if count > 0 else []
+
+    def query(self, ledger, ip=None, since=None, until=None, status=None):
+        """
+        Retrieves the observations that match all given criteria.
+        :param ledger: the ledger of the nodes
+        :param ip: optional, the ip address of the node
+        :param since: optional, datetime; only observations made at or after it
+        :param until: optional, datetime; only observations made before it
+        :param status: optional, boolean; only successful (True) or failed (False) observations
+        :returns: generator of (ip, entry) pairs
+        """
+        raise NotImplementedError
+
+    def retire_nodes(self, ledger, ips):
+        """
+        Moves the histories of the given nodes out of the active set (the "dead nodes").
+        """
+        ips = list(ips)
+        self.move_to_dead(ledger, ips)
+        if self.index is not None:
+            self.index.remove(ledger, ips)
+
+    def move_to_dead(self, ledger, ips):
+        raise NotImplementedError
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+
+
+class JsonStore(ObservationStore):
+    """
+    One JSON file per node, containing the list of its entries.
+    """
+
+    def __init__(self, output_dir, index=None):
+        self.output_dir = pathlib.Path(output_dir)
+        self.index = index
+        self.ledger_dirs = {}
+
+    def ledger_dir(self, ledger):
+        directory = self.ledger_dirs.get(ledger)
+        if directory is None:
+            directory = self.output_dir / ledger
+            directory.mkdir(parents=True, exist_ok=True)
+            self.ledger_dirs[ledger] = directory
+        return directory
+
+    def has_node(self, ledger, ip):
+        return (self.output_dir / ledger / ip).is_file()
+
+    def write(self, observations):
+        grouped = defaultdict(list)
+        for obs in observations:
+            grouped[(obs['ledger'], obs['ip'])].append(obs)
+
+        for (ledger, ip), node_observations in grouped.items():
+            output_dir = self.ledger_dir(ledger)
+            try:
+                with open(output_dir / ip) as f:
+                    entries = json.load(f)
+            except FileNotFoundError:
+                entries = []
+
+            for obs in node_observations:
+                entries.append(self.to_entry(obs))
+
+            # Write output in two steps to avoid broken files in case of abrupt interruption
+            with open(output_dir / f'{ip}.backup', 'w') as f:
+                json.dump(entries, f)
+
+            shutil.move(output_dir / f'{ip}.backup', output_dir / ip)
+
+    def sync(self):
+        if hasattr(os, 'sync'):  # Not available on Windows
+            os.sync()
+
+    @staticmethod
+    def to_entry(obs):
+        return {
+            'date': obs['date'],
+            'port': obs['port'],
+            'version': obs['version'],
+            'protocol': obs.get('protocol', 0),
+            'status': obs['status'],
+            'addresses': [list(addr) for addr in obs['addresses']],
+        }
+
+    def list_nodes(self, ledger):
+        directory = self.output_dir / ledger
+        if not directory.is_dir():
+            return []
+        return [
+            filename.name for filename in directory.iterdir()
+            if filename.is_file() and not filename.name.endswith(('.swp', '.backup'))
+        ]
+
+    def get_history(self, ledger, ip):
+        try:
+            with open(self.output_dir / ledger / ip) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def iter_histories(self, ledger, ips=None):
+        if ips is None:
+            ips = self.list_nodes(ledger)
+        for ip in ips:
+            try:
+                entries = self.get_history(ledger, ip)
+            except json.decoder.JSONDecodeError:
+                logging.warning(f'{ledger} - could not decode the history of {ip}')
+                continue
+            yield ip, entries
+
+    @staticmethod
+    def read_tail(path, count):
+        """
+        Decodes only the last entries of a history file, reading it backwards in growing blocks until count entry
+        boundaries are found. Falls back to decoding the whole file if it is not in the layout written by json.dump.
+        :param path: the path of the history file
+        :param count: the maximum number of entries to decode
+        :returns: the (at most) count last entries, oldest first
+        """
+        if count <= 0:
+            return []
+        with open(path, 'rb') as f:
+            size = f.seek(0, os.SEEK_END)
+            block_size = TAIL_BLOCK_SIZE
+            while True:
+                start = max(0, size - block_size)
+                f.seek(start)
+                data = f.read(size - start)
+                boundary = len(data)
+                for _ in range(count):
+                    boundary = data.rfind(ENTRY_START, 0, boundary)
+                    if boundary < 0:
+                        break
+                if boundary >= 0:
+                    try:
+                        return json.loads(b'[' + data[boundary:])
+                    except json.decoder.JSONDecodeError:
+                        f.seek(0)
+                        return json.load(f)[-count:]
+                if start == 0:
+                    return json.loads(data)[-count:]
+                block_size *= 4
+
+    def iter_tails(self, ledger, count, ips=None):
+        if ips is None:
+            ips = self.list_nodes(ledger)
+        for ip in ips:
+            try:
+                entries = self.read_tail(self.output_dir / ledger / ip, count)
+            except FileNotFoundError:
+                entries = []
+            except json.decoder.JSONDecodeError:
+                logging.warning(f'{ledger} - could not decode the history of {ip}')
+                continue
+            yield ip, entries
+
+    def query(self, ledger, ip=None, since=None, until=None, status=None):
+        histories = self.iter_histories(ledger, None if ip is None else [ip])
+        for node_ip, entries in histories:
+            for entry in entries:
+                if status is not None and entry['status'] != status:
+                    continue
+                if since is not None or until is not None:
+                    date = parse_date(entry['date'])
+                    if (since is not None and date < since) or (until is not None and date >= until):
+                        continue
+                yield node_ip, entry
+
+    def move_to_dead(self, ledger, ips):
+        dead_dir = self.output_dir / 'dead_nodes' / ledger
+        dead_dir.mkdir(parents=True, exist_ok=True)
+        for ip in ips:
+            os.rename(self.output_dir / ledger / ip, dead_dir / ip)
+
+
+class SqliteStore(ObservationStore):
+    """
+    A single SQLite database with one row per observation. The addresses of an observation are stored as a
+    zlib-compressed JSON list. Each thread uses its own connection, so the store can be shared by the threads of a
+    process; processes must open their own store.
+    """
+    COLUMNS = 'ledger, ip, date, port, version, protocol, status, addresses'
+    SCHEMA = [
+        f'CREATE TABLE IF NOT EXISTS observations ({COLUMNS})',
+        f'CREATE TABLE IF NOT EXISTS dead_observations ({COLUMNS})',
+        'CREATE INDEX IF NOT EXISTS observations_ip ON observations (ledger, ip, date)',
+        'CREATE INDEX IF NOT EXISTS observations_date ON observations (ledger, date)',
+        'CREATE INDEX IF NOT EXISTS observations_status ON observations (ledger, status, date)',
+        'CREATE INDEX IF NOT EXISTS dead_observations_ip ON dead_observations (ledger, ip, date)',
+    ]
+
+    def __init__(self, path, index=None):
+        self.path = pathlib.Path(path)
+        self.index = index
+        self.local = threading.local()
+        with self.connection as conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+
+    @property
+    def connection(self):
+        conn = getattr(self.local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = conn
+        return conn
+
+    def has_node(self, ledger, ip):
+        row = self.connection.execute(
+            'SELECT 1 FROM observations WHERE ledger = ? AND ip = ? LIMIT 1', (ledger, ip)).fetchone()
+        return row is not None
+
+    def is_retired(self, ledger, ip):
+        """
+        :returns: True if the store holds at least one observation of the node among the dead nodes
+        """
+        row = self.connection.execute(
+            'SELECT 1 FROM dead_observations WHERE ledger = ? AND ip = ? LIMIT 1', (ledger, ip)).fetchone()
+        return row is not None
+
+    def write(self, observations, table='observations'):
+        rows = [(
+            obs['ledger'],
+            obs['ip'],
+            to_iso_date(obs['date']),
+            obs['port'],
+            obs['version'],
+            obs.get('protocol', 0),
+            int(bool(obs['status'])),
+            zlib.compress(json.dumps([list(addr) for addr in obs['addresses']]).encode()),
+        ) for obs in observations]
+        with self.connection as conn:
+            conn.executemany(f'INSERT INTO {table} ({self.COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    @staticmethod
+    def to_entry(row):
+        (date, port, version, protocol, status, addresses) = row
+        return {
+            'date': from_iso_date(date),
+            'port': port,
+            'version': version,
+            'protocol': protocol,
+            'status': bool(status),
+            'addresses': json.loads(zlib.decompress(addresses)) if addresses else [],
+        }
+
+    def list_nodes(self, ledger):
+        rows = self.connection.execute('SELECT DISTINCT ip FROM observations WHERE ledger = ?', (ledger,))
+        return [row[0] for row in rows]
+
+    def get_history(self, ledger, ip):
+        rows = self.connection.execute(
+            'SELECT date, port, version, protocol, status, addresses FROM observations '
+            'WHERE ledger = ? AND ip = ? ORDER BY date, rowid', (ledger, ip))
+        return [self.to_entry(row) for row in rows]
+
+    def iter_histories(self, ledger, ips=None):
+        if ips is not None:
+            for ip in ips:
+                yield ip, self.get_history(ledger, ip)
+            return
+
+        rows = self.connection.execute(
+            'SELECT ip, date, port, version, protocol, status, addresses FROM observations '
+            'WHERE ledger = ? ORDER BY ip, date, rowid', (ledger,))
+        current_ip, entries = None, []
+        for row in rows:
+            if row[0] != current_ip:
+                if current_ip is not None:
+                    yield current_ip, entries
+                current_ip, entries = row[0], []
+            entries.append(self.to_entry(row[1:]))
+        if current_ip is not None:
+            yield current_ip, entries
+
+    def iter_tails(self, ledger, count, ips=None):
+        query = (
+            'SELECT ip, date, port, version, protocol, status, addresses FROM ('
+            '    SELECT rowid AS id, *, ROW_NUMBER() OVER (PARTITION BY ip ORDER BY date DESC, rowid DESC) AS position'
+            '    FROM observations WHERE ledger = ?{})'
+            ' WHERE position <= ? ORDER BY ip, date, id')
+        if ips is None:
+            batches = [(query.format(''), [ledger, count])]
+        else:
+            batches = [
+                (query.format(f' AND ip IN ({", ".join("?" * len(chunk))})'), [ledger] + chunk + [count])
+                for chunk in chunks(list(ips), SQLITE_MAX_VARIABLES)
+            ]
+
+        for statement, values in batches:
+            current_ip, entries = None, []
+            for row in self.connection.execute(statement, values):
+                if row[0] != current_ip:
+                    if current_ip is not None:
+                        yield current_ip, entries
+                    current_ip, entries = row[0], []
+                entries.append(self.to_entry(row[1:]))
+            if current_ip is not None:
+                yield current_ip, entries
+
+    def query(self, ledger, ip=None, since=None, until=None, status=None):
+        conditions, values = ['ledger = ?'], [ledger]
+        if ip is not None:
+            conditions.append('ip = ?')
+            values.append(ip)
+        if since is not None:
+            conditions.append('date >= ?')
+            values.append(since.strftime('%Y-%m-%d %H:%M:%S'))
+        if until is not None:
+            conditions.append('date < ?')
+            values.append(until.strftime('%Y-%m-%d %H:%M:%S'))
+        if status is not None:
+            conditions.append('status = ?')
+            values.append(int(bool(status)))
+        rows = self.connection.execute(
+            'SELECT ip, date, port, version, protocol, status, addresses FROM observations '
+            f'WHERE {" AND ".join(conditions)} ORDER BY ip, date, rowid', values)
+        for row in rows:
+            yield row[0], self.to_entry(row[1:])
+
+    def sync(self):
+        # Commits are not synced in WAL mode with synchronous=NORMAL; a checkpoint syncs the log and the database
+        self.connection.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def move_to_dead(self, ledger, ips):
+        with self.connection as conn:
+            for chunk in chunks(list(ips), SQLITE_MAX_VARIABLES):
+                placeholders = ', '.join('?' * len(chunk))
+                conn.execute(
+                    f'INSERT INTO dead_observations SELECT {self.COLUMNS} FROM observations '
+                    f'WHERE ledger = ? AND ip IN ({placeholders})', [ledger] + chunk)
+                conn.execute(f'DELETE FROM observations WHERE ledger = ? AND ip IN ({placeholders})', [ledger] + chunk)
+
+    def close(self):
+        super().close()
+        conn = getattr(self.local, 'connection', None)
+        if conn is not None:
+            conn.close()
+            self.local.connection = None
+
+
+class ObservationSink(object):
+    """
+    Single writer of the observations made during a crawl, so that the crawler workers do not touch the filesystem.
+    Observations put in the sink are written by a background thread, in batches of up to batch_size observations (or
+    those received within flush_interval seconds), each added to the store at once and followed by one sync.
+    :param store: the ObservationStore to write to
+    :param batch_size: optional, the maximum number of observations per batch
+    :param flush_interval: optional, the maximum number of seconds an observation waits before being written
+    """
+
+    def __init__(self, store, batch_size=SINK_BATCH_SIZE, flush_interval=SINK_FLUSH_INTERVAL):
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.SimpleQueue()
+        self.written = 0
+        self.batches = 0
+        self.thread = threading.Thread(target=self.run, name='observation-sink', daemon=True)
+        self.thread.start()
+
+    def put(self, observation):
+        """
+        Adds an observation (see helper.make_observation) to the queue of observations to write.
+        """
+        self.queue.put(observation)
+
+    def run(self):
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            if batch[0] is None:
+                break
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    observation = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if observation is None:
+                    done = True
+                    break
+                batch.append(observation)
+            self.write(batch)
+
+    def write(self, batch):
+        try:
+            self.store.add_observations(batch)
+            self.store.sync()
+        except Exception as err:
+            logging.error(f'Could not write {len(batch)} observations: {err!r}')
+            return
+        self.written += len(batch)
+        self.batches += 1
+
+    def close(self):
+        """
+        Writes the observations left in the queue and stops the writer thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+def open_store(backend, output_dir, with_index=True):
+    """
+    Opens the observation store of the given type.
+    :param backend: 'json' or 'sqlite'
+    :param output_dir: the output directory of the project
+    :param with_index: optional, if set then the store maintains a node index. The index of the sqlite backend is kept
+    in the same database, the one of the json backend in a separate database.
+    :returns: an ObservationStore
+    """
+    from network_decentralization.node_index import NodeIndex, INDEX_FILENAME
+
+    output_dir = pathlib.Path(output_dir)
+    if backend == 'json':
+        index = NodeIndex(output_dir / INDEX_FILENAME) if with_index else None
+        return JsonStore(output_dir, index)
+    if backend == 'sqlite':
+        index = NodeIndex(output_dir / SQLITE_FILENAME) if with_index else None
+        return SqliteStore(output_dir / SQLITE_FILENAME, index)
+    raise ValueError(f'Unknown storage backend: {backend}')
@@ -3,6 +3,7 @@ import re
 import csv
 from pathlib import Path
 import network_decentralization.helper as hlp
+import network_decentralization.scan as scan
 from collections import defaultdict
 import logging
 import pandas as pd
@@ -12,41 +13,43 @@ from datetime import datetime
 logging.basicConfig(format='[%(asctime)s] %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', level=logging.INFO)
 
 
-def network_edges():
+HISTORY_ANALYSES = {
+    'network_edges': scan.EdgesVisitor,
+    'response_length': scan.ResponseLengthVisitor,
+    'convergence': scan.ConvergenceVisitor,
+}
+
+
+def scan_histories(analyses=None):
+    """
+    Reads the history of every node once per ledger and runs the given history analyses over it.
+    :param analyses: optional, list of keys of HISTORY_ANALYSES. If not set, all analyses are run.
+    :returns: dictionary mapping each ledger to a dictionary of analysis names to visitors
+    """
+    analyses = analyses or list(HISTORY_ANALYSES)
+    processes = hlp.get_parse_processes()
+    results = {}
+    for ledger in LEDGERS:
+        logging.info(f'Scanning {ledger} node histories ({", ".join(analyses)})')
+        visitors = {name: HISTORY_ANALYSES[name]() for name in analyses}
+        scan.scan_ledger(ledger, list(visitors.values()), processes)
+        results[ledger] = visitors
+    return results
+
+
+def network_edges(scans=None):
     """
     Parses node connection data from the past 7 days and constructs a network edge list for each ledger, saving the results as CSV files.
+    :param scans: optional, the output of scan_histories. If not set, the node histories are scanned.
     """
+    scans = scans or scan_histories(['network_edges'])
     network_edge_dir = hlp.get_output_directory() / 'network_edges'
     if not network_edge_dir.is_dir():
         network_edge_dir.mkdir()
 
-    past_week = hlp.get_last_days(7)
-
     for ledger in LEDGERS:
-        reachable_nodes = set()
-        output_data = [['source', 'dest']]
-        edges = set()
-        logging.info(f'Parsing {ledger} graph edges')
-        output_dir = hlp.get_output_directory(ledger)
-        filenames = list(Path(output_dir).iterdir())
-        for idx, filename in enumerate(filenames):
-            print(f'{ledger} - parsed {idx:,}/{len(filenames):,} files ({100*idx/len(filenames):.2f}%)', end='\r')
-            node_ip = str(filename).split('/')[-1]
-            try:
-                with open(filename) as f:
-                    entries = json.load(f)
-            except json.decoder.JSONDecodeError:
-                continue
-            for entry in entries:
-                if entry['date'].split()[0] in past_week:
-                    if entry['status']:
-                        reachable_nodes.add(node_ip)
-                    for addr in entry['addresses']:
-                        edges.add((node_ip, addr[0]))
-        for source, dest in edges:
-            if dest in reachable_nodes:
-                output_data.append([source, dest])
-
+        logging.info(f'Writing {ledger} graph edges')
+        output_data = [['source', 'dest']] + [[source, dest] for source, dest in scans[ledger]['network_edges'].result()]
         with open(hlp.get_output_directory() / 'network_edges' / f'{ledger}.csv', 'w') as f:
             csv_writer = csv.writer(f)
             csv_writer.writerows(output_data)
@@ -77,92 +80,37 @@ def ip_type(reachable_nodes):
         csv_writer.writerows(output_data)
 
 
-def response_length():
+def response_length(scans=None):
     """
     Analyses the average number of addresses returned by each node. The results are saved in a JSON file.
+    :param scans: optional, the output of scan_histories. If not set, the node histories are scanned.
     """
+    scans = scans or scan_histories(['response_length'])
     output = {}
 
     for ledger in LEDGERS:
-        logging.info(f'Analyzing {ledger} response lengths')
-        output_dir = hlp.get_output_directory(ledger)
-
-        response_length = defaultdict(list)
-        filenames = list(Path(output_dir).iterdir())
-        for idx, filename in enumerate(filenames):
-            print(f'{ledger} - parsed {idx:,}/{len(filenames):,} files ({100*idx/len(filenames):.2f}%)', end='\r')
-            node_ip = str(filename).split('/')[-1]
-
-            received_addrs = []
-            if filename.is_file() and not node_ip.endswith('.swp'):
-                try:
-                    with open(filename) as f:
-                        entries = json.load(f)
-                except json.decoder.JSONDecodeError:
-                    continue
-                for entry_idx, entry in enumerate(entries):
-                    if entry['addresses']:
-                        received_addrs.append(len(entry['addresses']))
-
-            if received_addrs:
-                avg_responses = sum(received_addrs) / len(received_addrs)
-                response_length[int(avg_responses)].append(node_ip)
-
-        logging.info(ledger)
+        response_length = scans[ledger]['response_length'].response_length
         output[ledger] = []
         for key, val in sorted(response_length.items(), key=lambda x: len(x[1]), reverse=True):
             output[ledger].append([key, len(val)])
-            # logging.info(f'\t {key} {len(val)}')
     output_dir = hlp.get_output_directory()
     with open(output_dir / 'response_length.json', 'w') as f:
         json.dump(output, f, indent=4)
 
 
-def convergence():
+def convergence(scans=None):
     """
     Determines convergence behaviour for each node based on the uniqueness of addresses received over time. Results are saved in a JSON file.
+    :param scans: optional, the output of scan_histories. If not set, the node histories are scanned.
     """
-    CONVERGENCE_PARAM = 0.1
-
+    scans = scans or scan_histories(['convergence'])
     output = {}
 
     for ledger in LEDGERS:
-        logging.info(f'Analyzing {ledger} convergence')
-        output_dir = hlp.get_output_directory(ledger)
-
-        convergence = defaultdict(list)
-        filenames = list(Path(output_dir).iterdir())
-        for idx, filename in enumerate(filenames):
-            print(f'{ledger} - parsed {idx:,}/{len(filenames):,} files ({100*idx/len(filenames):.2f}%)', end='\r')
-            node_ip = str(filename).split('/')[-1]
-
-            received_addrs = set()
-            converged = False
-            if filename.is_file() and not node_ip.endswith('.swp'):
-                try:
-                    with open(filename) as f:
-                        entries = json.load(f)
-                except json.decoder.JSONDecodeError:
-                    continue
-                for entry_idx, entry in enumerate(entries):
-                    if entry['addresses']:
-                        new_addrs = set()
-                        for addr in entry['addresses']:
-                            if addr[0] not in received_addrs:
-                                new_addrs.add(addr[0])
-                                received_addrs.add(addr[0])
-                        if 100*len(new_addrs) / len(entry['addresses']) < CONVERGENCE_PARAM:
-                            convergence[entry_idx].append(node_ip)
-                            converged = True
-                            break
-            if received_addrs and not converged:
-                convergence[-1].append(node_ip)
-
-        logging.info(ledger)
+        convergence = scans[ledger]['convergence'].convergence
         output[ledger] = []
         for key, val in sorted(convergence.items(), key=lambda x: len(x[1]), reverse=True):
             output[ledger].append([key, len(val)])
-            # logging.info(f'\t {key} {len(val)}')
     output_dir = hlp.get_output_directory()
     with open(output_dir / 'convergence.json', 'w') as f:
         json.dump(output, f, indent=4)
@@ -182,10 +130,13 @@ def get_geodata(ledger, reachable_nodes, mode):
     with open(output_dir / f'{ledger}.json') as f:
         geodata = json.load(f)
 
+    ip_ranges, ip_ranges_mode = hlp.get_ip_ranges(), hlp.get_ip_ranges_mode()
     for node in reachable_nodes[ledger]:
         ip_addr = node[0]
-        if ip_addr in geodata:
-            ip_info = geodata[ip_addr]
+        ip_info = geodata.get(ip_addr)
+        if ip_ranges_mode == 'primary' or (ip_ranges_mode == 'fallback' and not ip_info):
+            ip_info = ip_ranges.lookup(ip_addr) or ip_info
+        if ip_info:
             if 'error' in ip_info and ip_info['error']:
                 continue
             if mode == 'Countries':
@@ -450,5 +401,12 @@ def main():
     if 'Clients' in MODES:
         record_versions(reachable_nodes, 1)
 
+    if hlp.get_history_analyses():
+        ip_type(reachable_nodes)
+        scans = scan_histories()
+        network_edges(scans)
+        response_length(scans)
+        convergence(scans)
+
 if __name__ == '__main__':
     main()
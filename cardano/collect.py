@@ -1,63 +1,333 @@
 """
 Collects Cardano relay node data using the Blockfrost API.
 The Blockfrost API key must be set in the BLOCKFROST_API_KEY environment variable.
+
+Requests are made concurrently by a pool of threads that share the connections of a single HTTP session, and are
+paced by a token bucket matched to the limits of Blockfrost (10 requests per second, with bursts of up to 500 requests).
+Requests that fail with 429 (rate limited) or 5xx are retried after a jittered exponential backoff. The relays fetched
+so far are checkpointed in the output directory, so an interrupted run resumes where it stopped. The base URL of the
+API is configurable (`blockfrost` in config.yaml), so the fetcher can be pointed at a local stub server.
+
+In incremental mode (`relay_snapshots` in config.yaml), only the relays of the pools that are new, whose registration
+parameters changed (i.e. re-registered pools) or whose relays were fetched more than max_age_days ago are fetched; the
+relays of the other pools are carried over from the previous snapshot, and retired pools are dropped. Since a pool can
+re-register with new relays only, the relays of a pool can be up to max_age_days old. Each run writes a new version of
+the snapshot in output/relay_snapshots/, with the diff of the relays of every pool and the pools refetched in the run
+(the only ones whose relay changes can show in the diff).
 """
 import os
+import random
+import threading
 import requests
 import time
 import logging
 import json
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+import helper as hlp
 
-BLOCKFROST_API_KEY = os.environ.get("BLOCKFROST_API_KEY")
-if not BLOCKFROST_API_KEY:
-    raise RuntimeError("BLOCKFROST_API_KEY environment variable not set. Please set your Blockfrost API key in the system environment.")
 BASE_URL = "https://cardano-mainnet.blockfrost.io/api/v0"
-HEADERS = {"project_id": BLOCKFROST_API_KEY}
+RATE = 10  # Requests per second
+BURST = 500  # Requests that can be made at once after a pause
+PAGE_SIZE = 100
+REQUEST_TIMEOUT = 30
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5  # Seconds
+MAX_BACKOFF = 60  # Seconds
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+CHECKPOINT_INTERVAL = 100  # Pools fetched between two checkpoints
+CHECKPOINT_MAX_AGE = 86400  # Seconds after which a checkpoint is not resumed anymore
 
 logging.basicConfig(format='[%(asctime)s] %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', level=logging.INFO)
 
-def get_all_pools():
-    """Fetch all pool IDs from Blockfrost."""
-    pools = []
-    page = 1
-    while True:
-        url = f"{BASE_URL}/pools?page={page}&count=100"
-        resp = requests.get(url, headers=HEADERS)
-        if resp.status_code != 200:
-            logging.error(f"Failed to fetch pools: {resp.status_code} {resp.text}")
-            break
-        data = resp.json()
-        if not data:
-            break
-        pools.extend(data)
-        logging.info(f"Fetched {len(pools)} pools so far (page {page})")
-        page += 1
-        time.sleep(0.2)  # Respect Blockfrost rate limits
-    return pools
-
-def get_pool_relays(pool_id):
-    """Fetch relay nodes for a given pool ID."""
-    url = f"{BASE_URL}/pools/{pool_id}/relays"
-    resp = requests.get(url, headers=HEADERS)
-    if resp.status_code != 200:
-        logging.warning(f"Failed to fetch relays for pool {pool_id}: {resp.status_code} {resp.text}")
-        return []
-    return resp.json()
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket that allows `rate` requests per second, with bursts of up to `capacity` requests.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        if now > self.updated:  # The bucket does not refill while it is paused
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def acquire(self):
+        """Block until a request can be made."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Block all requests for the given time and empty the bucket (after a "too many requests" reply)."""
+        with self.lock:
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.tokens = 0
+            self.updated = self.paused_until
+
+
+class BlockfrostClient(object):
+    """
+    Client of the Blockfrost API whose requests share one HTTP session and one token bucket.
+    """
+
+    def __init__(self, api_key, url=BASE_URL, rate=RATE, burst=BURST, max_workers=10, max_retries=MAX_RETRIES):
+        self.url = url.rstrip('/')
+        self.bucket = TokenBucket(rate, burst)
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        self.session.headers.update({"project_id": api_key})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, path, **params):
+        """
+        Make a GET request, retrying it with a jittered exponential backoff when it fails with 429, 5xx or a network
+        error.
+        :returns: the decoded JSON reply, or None if the request failed
+        """
+        failures = 0
+        while True:
+            self.bucket.acquire()
+            resp = None
+            try:
+                resp = self.session.get(f"{self.url}{path}", params=params, timeout=REQUEST_TIMEOUT)
+            except requests.exceptions.RequestException as e:
+                error = repr(e)
+            else:
+                if resp.status_code == 200:
+                    return resp.json()
+                error = f"{resp.status_code} {resp.text}"
+                if resp.status_code not in RETRY_STATUSES:
+                    logging.warning(f"Request to {path} failed: {error}")
+                    return None
+            failures += 1
+            if failures > self.max_retries:
+                logging.warning(f"Request to {path} failed after {failures} attempts: {error}")
+                return None
+            backoff = random.uniform(0, min(MAX_BACKOFF, BACKOFF_BASE * 2 ** failures))
+            if resp is not None and resp.status_code == 429:
+                self.bucket.pause(max(backoff, retry_after(resp)))  # Holds back the other requests too
+            else:
+                time.sleep(backoff)
+
+    def get_all_pools(self):
+        """Fetch all registered pools with their registration parameters, max_workers pages at a time."""
+        pools = []
+        page = 1
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                pages = list(range(page, page + self.max_workers))
+                results = list(executor.map(lambda p: self.get("/pools/extended", page=p, count=PAGE_SIZE), pages))
+                for p, data in zip(pages, results):
+                    if data is None:
+                        raise RuntimeError(f"Failed to fetch page {p} of the pools")
+                    pools.extend(data)
+                    if len(data) < PAGE_SIZE:
+                        logging.info(f"Fetched {len(pools)} pools ({p} pages)")
+                        return pools
+                page += self.max_workers
+                logging.info(f"Fetched {len(pools)} pools so far (page {page - 1})")
+
+    def get_pool_relays(self, pool_id):
+        """Fetch relay nodes for a given pool ID (None if the request failed)."""
+        return self.get(f"/pools/{pool_id}/relays")
+
+
+def retry_after(resp):
+    """:returns: the number of seconds the server asks to wait before the next request (0 if it does not say)"""
+    try:
+        return float(resp.headers.get('Retry-After', 0))
+    except ValueError:
+        return 0
+
+
+def load_checkpoint(path):
+    """:returns: the checkpoint of an interrupted run (pools and relays fetched so far), or None"""
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return None
+    if 'targets' not in checkpoint or time.time() - checkpoint.get('started_at', 0) > CHECKPOINT_MAX_AGE:
+        logging.info("Ignoring the checkpoint of a previous run, which is too old")
+        return None
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    backup = path.with_suffix('.backup')
+    with open(backup, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(backup, path)
+
+
+def get_fingerprint(pool):
+    """
+    :returns: the registration parameters of a pool (pledge, costs and metadata hash), which change when the pool is
+    re-registered with other parameters
+    """
+    metadata = pool.get('metadata') or {}
+    return f"{pool.get('declared_pledge')}|{pool.get('margin_cost')}|{pool.get('fixed_cost')}|{metadata.get('hash')}"
+
+
+def is_expired(pool_id, entry, now, max_age_days):
+    """
+    Whether the relays of a pool are old enough to be fetched again even though its registration parameters did not
+    change (relays can be updated alone). The age limit of each pool is spread between half and all of max_age_days, so
+    the pools fetched in the same run do not all expire in the same run later.
+    """
+    if not max_age_days:
+        return False
+    spread = zlib.crc32(pool_id.encode()) / 2 ** 32
+    return now - (entry.get('fetched_at') or 0) > max_age_days * 86400 * (1 - spread / 2)
+
+
+def get_pools_to_fetch(fingerprints, previous, max_age_days, now):
+    """
+    :param fingerprints: dictionary mapping the registered pools to their fingerprint
+    :param previous: the previous snapshot, or None to fetch the relays of all pools
+    :returns: the pools whose relays must be fetched: those that are new, whose registration parameters changed or
+    whose relays are too old
+    """
+    if previous is None:
+        return list(fingerprints)
+    targets = []
+    for pool_id, fingerprint in fingerprints.items():
+        entry = previous['pools'].get(pool_id)
+        if entry is None or entry['fingerprint'] != fingerprint or is_expired(pool_id, entry, now, max_age_days):
+            targets.append(pool_id)
+    return targets
+
+
+def load_latest_snapshot(snapshot_dir):
+    """:returns: the snapshot with the highest version in the directory, or None"""
+    paths = sorted(snapshot_dir.glob('relays_v*.json'), key=lambda path: int(path.stem[len('relays_v'):]))
+    if not paths:
+        return None
+    with open(paths[-1]) as f:
+        return json.load(f)
+
+
+def diff_snapshots(previous_pools, pools):
+    """
+    :returns: the diff between the pools of two snapshots: the pools added and removed (e.g. retired), and, per pool
+    whose relays changed, the relays added and removed
+    """
+    changed = {}
+    for pool_id in pools.keys() & previous_pools.keys():
+        old, new = previous_pools[pool_id]['relays'], pools[pool_id]['relays']
+        if old != new:
+            changed[pool_id] = {
+                'added': [relay for relay in new if relay not in old],
+                'removed': [relay for relay in old if relay not in new],
+            }
+    return {
+        'added': [pool_id for pool_id in pools if pool_id not in previous_pools],
+        'removed': [pool_id for pool_id in previous_pools if pool_id not in pools],
+        'changed': changed,
+    }
+
+
+def save_snapshot(snapshot_dir, previous, fingerprints, fetched, now):
+    """
+    Write the next version of the snapshot: the relays fetched in this run, and those of the previous snapshot for the
+    other pools (including the pools whose relays could not be fetched, which keep their previous fingerprint so that
+    they are fetched again at the next run).
+    :returns: the new snapshot
+    """
+    previous_pools = previous['pools'] if previous else {}
+    pools = {}
+    for pool_id, fingerprint in fingerprints.items():
+        if pool_id in fetched:
+            pools[pool_id] = {'relays': fetched[pool_id], 'fingerprint': fingerprint, 'fetched_at': int(now)}
+        else:
+            pools[pool_id] = previous_pools.get(pool_id, {'relays': [], 'fingerprint': None, 'fetched_at': None})
+    snapshot = {
+        'version': previous['version'] + 1 if previous else 1,
+        'created_at': int(now),
+        'previous_version': previous['version'] if previous else None,
+        'pools': pools,
+        'refetched': [pool_id for pool_id in fingerprints if pool_id in fetched],
+        'diff': diff_snapshots(previous_pools, pools),
+    }
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    save_checkpoint(snapshot_dir / f"relays_v{snapshot['version']}.json", snapshot)
+    return snapshot
+
 
 def main():
-    pools = get_all_pools()
-    logging.info(f"Total pools fetched: {len(pools)}")
-    all_relays = {}
-    for i, pool_id in enumerate(pools, 1):
-        relays = get_pool_relays(pool_id)
-        all_relays[pool_id] = relays
-        if i % 50 == 0:
-            logging.info(f"Processed {i}/{len(pools)} pools...")
-        time.sleep(0.2)  # Respect Blockfrost rate limits
-    # Save results
+    api_key = os.environ.get("BLOCKFROST_API_KEY")
+    if not api_key:
+        raise RuntimeError("BLOCKFROST_API_KEY environment variable not set. Please set your Blockfrost API key in the system environment.")
+    client = BlockfrostClient(api_key, **hlp.get_blockfrost_parameters())
+    snapshot_params = hlp.get_relay_snapshot_parameters()
+    snapshot_dir = hlp.get_output_directory() / 'relay_snapshots'
+    previous = load_latest_snapshot(snapshot_dir)
+    checkpoint_path = hlp.get_output_directory() / 'blockfrost_checkpoint.json'
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint:
+        logging.info(f"Resuming from checkpoint: {len(checkpoint['relays'])}/{len(checkpoint['targets'])} "
+                     f"pools fetched")
+    else:
+        fingerprints = {pool['pool_id']: get_fingerprint(pool) for pool in client.get_all_pools()}
+        targets = get_pools_to_fetch(fingerprints, previous if snapshot_params['incremental'] else None,
+                                     snapshot_params['max_age_days'], time.time())
+        checkpoint = {'started_at': time.time(), 'fingerprints': fingerprints, 'targets': targets, 'relays': {}}
+        save_checkpoint(checkpoint_path, checkpoint)
+    pools = checkpoint['fingerprints']
+    all_relays = checkpoint['relays']
+    logging.info(f"Total pools fetched: {len(pools)}, fetching the relays of {len(checkpoint['targets'])}")
+    pending = [pool_id for pool_id in checkpoint['targets'] if pool_id not in all_relays]
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=client.max_workers) as executor:
+            futures = {executor.submit(client.get_pool_relays, pool_id): pool_id for pool_id in pending}
+            try:
+                for i, future in enumerate(as_completed(futures), 1):
+                    relays = future.result()
+                    if relays is None:
+                        failed.append(futures[future])
+                    else:
+                        all_relays[futures[future]] = relays
+                    if i % CHECKPOINT_INTERVAL == 0:
+                        save_checkpoint(checkpoint_path, checkpoint)
+                        logging.info(f"Processed {len(checkpoint['targets']) - len(pending) + i}/"
+                                     f"{len(checkpoint['targets'])} pools...")
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        save_checkpoint(checkpoint_path, checkpoint)
+    if failed:
+        logging.warning(f"Failed to fetch the relays of {len(failed)} pools; they are fetched again at the next run")
+    snapshot = save_snapshot(snapshot_dir, previous, pools, all_relays, time.time())
+    diff = snapshot['diff']
+    logging.info(f"Saved version {snapshot['version']} of the relay snapshot: {len(diff['added'])} pools added, "
+                 f"{len(diff['removed'])} removed, {len(diff['changed'])} with changed relays")
+    # Save results (in the order of the pools)
     with open("blockfrost_pools_relays.json", "w") as f:
-        json.dump(all_relays, f, indent=2)
+        json.dump({pool_id: entry['relays'] for pool_id, entry in snapshot['pools'].items()}, f, indent=2)
     logging.info("Saved all pool relays to blockfrost_pools_relays.json")
+    checkpoint_path.unlink()
 
 if __name__ == "__main__":
     main()
@@ -5,7 +5,7 @@ This script collects geolocation and organization data for Cardano relay nodes b
 1. Loading relay information from blockfrost_pools_relays.json and resolving DNS names via dns_resolved.json
 2. Processing each unique relay IP address to fetch geodata from ip-api.com and ipapi.is
 3. Skipping Tor onion addresses and already-processed IPs
-4. Saving results incrementally to output/geodata/cardano.json
+4. Saving results to the geodata cache shared with the other pipelines and to output/geodata/cardano.json
 
 The script uses two geolocation APIs to ensure data quality: ip-api.com provides primary data
 with fallback to ipapi.is for missing organization or country information.
@@ -73,12 +73,17 @@ def collect_cardano_geodata():
     except (FileNotFoundError, json.decoder.JSONDecodeError):
         geodata = {}
         logging.info('Starting fresh geodata collection')
+    cache = hlp.get_geodata_cache()
+    cache.import_file(filename)  # Entries collected before the shared cache was introduced
     
     # Load relays and DNS resolved DB
     pool_relays = load_blockfrost_relays()
     dns_db = load_dns_resolved()
-    # Build a lookup for (pool_id, dns_name, port) -> ip_address
-    dns_lookup = {(entry['pool_id'], entry['dns_name'], entry['port']): entry['ip_address'] for entry in dns_db}
+    # Build a lookup for (pool_id, dns_name, port) -> all the addresses the name resolved to
+    dns_lookup = {
+        (entry['pool_id'], entry['dns_name'], entry['port']): hlp.get_resolved_addresses(entry) or ['Unresolved']
+        for entry in dns_db
+    }
     # Build list of all relay IPs to process (unique per IP)
     relay_targets = set()
     for pool_id, relays in pool_relays.items():
@@ -96,9 +101,7 @@ def collect_cardano_geodata():
                     dns_name = relay.get('dns')
                     port = relay.get('port', 3001)
                     if dns_name:
-                        ip = dns_lookup.get((pool_id, dns_name, port))
-                        if ip:
-                            relay_targets.add(ip)
+                        relay_targets.update(dns_lookup.get((pool_id, dns_name, port), []))
     relay_targets = list(relay_targets)  # Unique IPs only
     if not relay_targets:
         logging.error('No relay IPs to process!')
@@ -108,12 +111,17 @@ def collect_cardano_geodata():
     skipped = 0
     new_entries = 0
     onion_count = 0
+    batch = hlp.get_geolocation_batch()
+    pending = []  # IPs looked up in batches after the loop
     for node_ip in relay_targets:
         if node_ip.endswith('onion'):
             onion_count += 1
             skipped += 1
             continue
-        if node_ip in geodata:
+        cached = cache.get(node_ip)  # Also shared with the other pipelines and refreshed once expired
+        if cached is not None or (node_ip == 'Unresolved' and node_ip in geodata):
+            if cached is not None:
+                geodata[node_ip] = cached
             skipped += 1
             processed += 1
             if processed % 100 == 0:
@@ -127,11 +135,13 @@ def collect_cardano_geodata():
             skipped += 1
             processed += 1
             continue
+        if batch:
+            pending.append(node_ip)
+            continue
         try:
             geodata[node_ip] = hlp.get_ip_geodata(node_ip)
+            cache.put(node_ip, geodata[node_ip])
             new_entries += 1
-            with open(filename, 'w') as f:
-                json.dump(geodata, f, indent=4)
             logging.debug(f'{ledger} - Collected geodata for {node_ip}')
             processed += 1
             if processed % 10 == 0:
@@ -141,6 +151,18 @@ def collect_cardano_geodata():
             logging.error(f'Error processing {node_ip}: {e}')
             processed += 1
             continue
+    if pending:
+        logging.info(f'{ledger} - Collecting geodata for {len(pending)} relay IPs in batches')
+        batch_geodata = hlp.get_ip_geodata_batch(pending)
+        cache.update(batch_geodata)
+        geodata.update(batch_geodata)
+        new_entries += len(batch_geodata)
+        processed += len(pending)
+    cache.flush()
+    backup = filename.with_suffix('.backup')
+    with open(backup, 'w') as f:
+        json.dump(geodata, f, indent=4)
+    backup.replace(filename)
     logging.info(f'{ledger} - Complete! Processed {processed}/{len(relay_targets)} relay IPs')
     logging.info(f'{ledger} - New entries: {new_entries}, Skipped: {skipped} (including {onion_count} onion nodes)')
     logging.info(f'{ledger} - Total geodata entries: {len(geodata)}')
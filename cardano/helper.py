@@ -2,7 +2,11 @@ import requests
 import time
 import logging
 import pathlib
+import sys
 from yaml import safe_load
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))  # Root of the repository, for the shared modules
+from shared.geodata_cache import GeodataCache, DEFAULT_TTL_DAYS
+from shared.geolocation import GeolocationClient
 
 logging.basicConfig(format='[%(asctime)s] %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', level=logging.INFO)
 
@@ -107,6 +111,23 @@ def get_output_directory():
     return output_dir
 
 
+_geodata_cache = None
+
+
+def get_geodata_cache():
+    """
+    Opens (once) the geodata cache shared by the bitcoin, cardano and ethereum pipelines.
+    :returns: a GeodataCache
+    """
+    global _geodata_cache
+    if _geodata_cache is None:
+        params = get_config_data().get('geodata_cache') or {}
+        path = ROOT_DIR / params.get('path', '../geodata_cache.db')
+        _geodata_cache = GeodataCache(
+            path, params.get('ttl_days', DEFAULT_TTL_DAYS), params.get('ipv4_prefix'), params.get('ipv6_prefix'))
+    return _geodata_cache
+
+
 def get_ip_geodata(ip_addr):
     """
     Retrieves geolocation and organization data for a given IP address using ip-api.com and ipapi.is. Handles rate limiting and retries until successful.
@@ -131,3 +152,104 @@ def get_ip_geodata(ip_addr):
             logging.error('Geodata rate limited, sleeping for 2 min...')
             time.sleep(120)
     return data
+
+
+def get_blockfrost_parameters():
+    """
+    Retrieves the parameters of the Blockfrost client.
+    :returns: dictionary with the keys url (base URL of the API), rate (requests per second), burst (requests that can be made at once), max_workers (concurrent requests) and max_retries (retries of a request that failed with 429, 5xx or a network error)
+    """
+    params = get_config_data().get('blockfrost') or {}
+    keys = ['url', 'rate', 'burst', 'max_workers', 'max_retries', 'max_rate_limited']
+    return {key: params[key] for key in keys if params.get(key) is not None}
+
+
+def get_relay_snapshot_parameters():
+    """
+    Retrieves how the relays of the pools are refreshed between two snapshots.
+    :returns: dictionary with the keys incremental (if True, only the relays of the new, re-registered and expired pools are fetched) and max_age_days (age after which the relays of a pool are fetched again, 0 for never)
+    """
+    params = get_config_data().get('relay_snapshots') or {}
+    return {
+        'incremental': bool(params.get('incremental', True)),
+        'max_age_days': params.get('max_age_days', 14),
+    }
+
+
+def get_dns_resolution_parameters():
+    """
+    Retrieves the parameters of the resolution of the relay DNS names.
+    :returns: dictionary with the keys max_concurrency (number of names resolved at once), timeout (seconds after which a query is given up) and hedge_delay (seconds after which the fallback DNS servers are also queried)
+    """
+    params = get_config_data().get('dns_resolution') or {}
+    return {
+        'max_concurrency': params.get('max_concurrency', 100),
+        'timeout': params.get('timeout', 5),
+        'hedge_delay': params.get('hedge_delay', 0.5),
+    }
+
+
+def get_resolved_addresses(entry):
+    """
+    Retrieves all the addresses a relay DNS name resolved to, which entries written before resolve_dns.py stored them all do not have (only their first address).
+    :param entry: an entry of output/dns_resolved.json
+    :returns: list of IP addresses (empty if the name could not be resolved)
+    """
+    addresses = entry.get('ip_addresses')
+    if addresses is None:
+        addresses = [] if entry.get('ip_address', 'Unresolved') == 'Unresolved' else [entry['ip_address']]
+    return addresses
+
+
+def get_dns_refresh_parameters():
+    """
+    Retrieves when the relay DNS names already resolved are resolved again.
+    :returns: dictionary with the keys refresh_age_hours (age after which a resolved name is resolved again, unless the TTL of its records is longer), unresolved_retry_hours (age after which a name that could not be resolved is tried again) and max_queries (maximum number of names resolved per run, 0 for no limit)
+    """
+    params = get_config_data().get('dns_resolution') or {}
+    return {
+        'refresh_age_hours': params.get('refresh_age_hours', 24),
+        'unresolved_retry_hours': params.get('unresolved_retry_hours', 6),
+        'max_queries': params.get('max_queries', 0),
+    }
+
+
+def get_geolocation_parameters():
+    """
+    Retrieves the parameters of the geolocation client (base URLs and rate limits of the APIs, number of concurrent lookups), as keyword arguments for GeolocationClient. Parameters missing from the config file fall back to the defaults of the geolocation module.
+    :returns: dictionary
+    """
+    params = get_config_data().get('geolocation') or {}
+    keys = ['ip_api_url', 'ipapi_is_url', 'ip_api_rate', 'ipapi_is_rate', 'ip_api_batch_rate', 'max_workers', 'max_retries']
+    return {key: params[key] for key in keys if params.get(key) is not None}
+
+
+def get_geolocation_batch():
+    """
+    Retrieves whether new IP addresses are geolocated with the batch endpoint of ip-api.com.
+    :returns: boolean
+    """
+    return bool((get_config_data().get('geolocation') or {}).get('batch', False))
+
+
+_geolocation_client = None
+
+
+def get_geolocation_client():
+    """
+    Creates (once) the client used to geolocate IP addresses, so that all lookups share its connections and rate limits.
+    :returns: a GeolocationClient
+    """
+    global _geolocation_client
+    if _geolocation_client is None:
+        _geolocation_client = GeolocationClient(**get_geolocation_parameters())
+    return _geolocation_client
+
+
+def get_ip_geodata_batch(ip_addrs):
+    """
+    Retrieves the geolocation of many IP addresses with the geolocation client shared with the bitcoin pipeline: the addresses are looked up 100 at a time with the batch endpoint of ip-api.com (max 15 requests per minute), and those for which ip-api.com does not return both an organisation and a country are looked up one by one, all within the rate limits of the APIs.
+    :param ip_addrs: iterable of IP addresses
+    :returns: dictionary mapping each IP address to its geodata (without the addresses that could not be geolocated, which are looked up again at the next run)
+    """
+    return {ip_addr: data for ip_addr, data in get_geolocation_client().lookup_many(ip_addrs, batch=True) if data is not None}
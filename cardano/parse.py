@@ -32,16 +32,16 @@ def load_cardano_nodes():
     relays_file = Path(__file__).parent / 'blockfrost_pools_relays.json'
     dns_resolved_file = Path(__file__).parent / 'output' / 'dns_resolved.json'
     nodes = []
-    # Build DNS to IP mapping
+    # Build DNS to IPs mapping (a name can resolve to several A/AAAA records, each a node)
     dns_to_ip = {}
     if dns_resolved_file.exists():
         with open(dns_resolved_file, 'r') as f:
             for entry in json.load(f):
                 dns_name = entry.get('dns_name')
-                ip_address = entry.get('ip_address')
+                ip_addresses = hlp.get_resolved_addresses(entry)
                 port = entry.get('port', 3001)
-                if dns_name and ip_address and ip_address != 'Unresolved':
-                    dns_to_ip[(dns_name, port)] = ip_address
+                if dns_name and ip_addresses:
+                    dns_to_ip[(dns_name, port)] = ip_addresses
 
     with open(relays_file, 'r') as f:
         pool_relays = json.load(f)
@@ -53,9 +53,9 @@ def load_cardano_nodes():
                 nodes.append((ip, port))
             elif relay.get('dns'):
                 dns_name = relay['dns']
-                resolved_ip = dns_to_ip.get((dns_name, port))
-                if resolved_ip:
-                    nodes.append((resolved_ip, port))
+                resolved_ips = dns_to_ip.get((dns_name, port))
+                if resolved_ips:
+                    nodes.extend((resolved_ip, port) for resolved_ip in resolved_ips)
                 else:
                     # Always include unresolved DNS as (dns_name, port)
                     nodes.append((dns_name, port))
@@ -1,44 +1,147 @@
 """
 Resolves DNS names from blockfrost_pools_relays.json.
-Tries default DNS first, then falls back to Google DNS (8.8.8.8) and Cloudflare DNS (1.1.1.1).
+All the names are resolved concurrently (up to max_concurrency at a time, see dns_resolution in config.yaml), with
+resolvers that are reused for every query. Each name is resolved with the default DNS first; if it has not returned any
+address after hedge_delay seconds, Google DNS (8.8.8.8) and Cloudflare DNS (1.1.1.1) are raced against it. All the
+A and AAAA records of a name are kept.
+Names already in dns_resolved.json are resolved again once stale (older than refresh_age_hours, or the TTL of their
+records if longer), and names that could not be resolved after unresolved_retry_hours, oldest first and within the
+max_queries budget of the run. Every entry keeps the history of the changes of its addresses. A name only becomes
+Unresolved when a nameserver answers that it has no records: if no resolver answers a refresh (e.g. timeouts), the
+entry keeps its addresses and is tried again after unresolved_retry_hours.
 """
+import asyncio
 import json
 import logging
-import socket
+import time
 from pathlib import Path
+import dns.asyncresolver
+import dns.exception
 import dns.resolver
 from tqdm import tqdm
+import helper as hlp
 
 logging.basicConfig(format='[%(asctime)s] %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', level=logging.INFO)
 
 DEFAULT_PORT = 3001
+RECORD_TYPES = ('A', 'AAAA')
+HISTORY_SIZE = 10  # Number of address changes kept per DNS entry
+FALLBACK_DNS_SERVERS = [
+    ('8.8.8.8', 'Google DNS'),
+    ('1.1.1.1', 'Cloudflare DNS'),
+]
 
 
-def resolve_dns(hostname, dns_server=None):
+def make_resolvers(timeout):
     """
-    Resolve DNS hostname to IP address.
+    Create the resolvers, which are reused for all the queries.
+    
+    Args:
+        timeout: Number of seconds after which a query is given up
+    
+    Returns:
+        List of (resolver, name) tuples: the default DNS (if the system has one), then the fallback DNS servers
+    """
+    resolvers = []
+    try:
+        resolvers.append((dns.asyncresolver.Resolver(), 'default'))
+    except dns.resolver.NoResolverConfiguration:
+        logging.warning('No default DNS configured, only the fallback DNS servers are used')
+    for dns_server, server_name in FALLBACK_DNS_SERVERS:
+        resolver = dns.asyncresolver.Resolver(configure=False)
+        resolver.nameservers = [dns_server]
+        resolvers.append((resolver, server_name))
+    for resolver, _ in resolvers:
+        resolver.timeout = timeout
+        resolver.lifetime = timeout
+    return resolvers
+
+
+async def resolve_dns(hostname, resolver):
+    """
+    Resolve DNS hostname to all its IP addresses (A and AAAA records, queried at once).
     
     Args:
         hostname: DNS name to resolve
-        dns_server: Optional DNS server IP to use (e.g., '8.8.8.8')
+        resolver: dns.asyncresolver.Resolver to use
     
     Returns:
-        IP address string or None if resolution fails
+        (addresses, ttl, answered) tuple: list of IP address strings (IPv4 first), empty if resolution fails, the lowest
+        TTL of the records (None if resolution fails), and whether the nameserver answered every query, possibly that
+        the name has no such records (False if a query failed, e.g. timed out)
+    """
+    async def query(rdtype):
+        try:
+            answers = await resolver.resolve(hostname, rdtype)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            return [], None, True
+        except dns.exception.DNSException:
+            return [], None, False
+        return [str(rdata) for rdata in answers], answers.rrset.ttl, True
+
+    results = await asyncio.gather(*(query(rdtype) for rdtype in RECORD_TYPES))
+    ttls = [ttl for _, ttl, _ in results if ttl is not None]
+    addresses = [address for addresses, _, _ in results for address in addresses]
+    return addresses, min(ttls, default=None), all(answered for _, _, answered in results)
+
+
+async def resolve_hedged(hostname, resolvers, hedge_delay):
     """
+    Resolve DNS hostname with the first resolver and, if it has not returned any address after hedge_delay seconds,
+    with all the other resolvers at once. The first addresses returned are used.
+    
+    Returns:
+        (addresses, ttl, resolver name, failed) tuple, where failed is True if no resolver returned any address nor
+        answered that the name has none (i.e. all the resolvers failed)
+    """
+    (resolver, server_name), *fallbacks = resolvers
+    tasks = {asyncio.ensure_future(resolve_dns(hostname, resolver)): server_name}
+    pending = set(tasks)
+    hedged = False
+    failed = True
     try:
-        if dns_server:
-            # Use specific DNS server
-            resolver = dns.resolver.Resolver()
-            resolver.nameservers = [dns_server]
-            answers = resolver.resolve(hostname, 'A')
-            if answers:
-                return str(answers[0])
-        else:
-            # Use default system DNS
-            return socket.gethostbyname(hostname)
-    except (socket.gaierror, dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, 
-            dns.resolver.NoNameservers, dns.exception.Timeout, Exception):
-        return None
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=None if hedged else hedge_delay,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                addresses, ttl, answered = task.result()
+                if addresses:
+                    return addresses, ttl, tasks[task], False
+                failed = failed and not answered
+            if not hedged:
+                hedged = True
+                for resolver, server_name in fallbacks:
+                    task = asyncio.ensure_future(resolve_dns(hostname, resolver))
+                    tasks[task] = server_name
+                    pending.add(task)
+        return [], None, None, failed
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def resolve_all(hostnames, max_concurrency, timeout, hedge_delay):
+    """
+    Resolve DNS hostnames concurrently, up to max_concurrency at a time.
+    
+    Returns:
+        Dictionary mapping each hostname to its (addresses, ttl, resolver name, failed) tuple
+    """
+    resolvers = make_resolvers(timeout)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    progress = tqdm(total=len(hostnames), desc='Resolving DNS', unit='dns')
+
+    async def resolve(hostname):
+        async with semaphore:
+            result = await resolve_hedged(hostname, resolvers, hedge_delay)
+        progress.update()
+        return result
+
+    try:
+        results = await asyncio.gather(*(resolve(hostname) for hostname in hostnames))
+    finally:
+        progress.close()
+    return dict(zip(hostnames, results))
 
 
 def load_existing_dns_db(output_path):
@@ -56,8 +159,52 @@ def save_dns_db(output_path, db):
         json.dump(db, f, indent=2)
 
 
+def is_due(entry, now, refresh_age, unresolved_retry):
+    """
+    Whether a stored DNS entry must be resolved again: resolved entries once older than refresh_age seconds (or than the
+    TTL of their records, if longer), unresolved ones, and the resolved ones whose last refresh failed, once
+    unresolved_retry seconds have passed. Entries stored before resolution times were recorded are always due.
+    """
+    resolved_at = entry.get('resolved_at')
+    if resolved_at is None:
+        return True
+    if entry.get('failed_at') is not None:
+        return now - entry['failed_at'] >= unresolved_retry
+    if entry.get('ip_address') == 'Unresolved':
+        return now - resolved_at >= unresolved_retry
+    return now - resolved_at >= max(refresh_age, entry.get('ttl') or 0)
+
+
+def update_entry(entry, addresses, ttl, resolver, now):
+    """
+    Store the result of a resolution in a DNS entry. The history of the entry only records the changes of its addresses,
+    as [time, addresses] pairs (an empty list when the name did not resolve), of which the last HISTORY_SIZE are kept.
+    
+    Returns:
+        True if the addresses of the entry changed
+    """
+    previous = hlp.get_resolved_addresses(entry)
+    changed = sorted(addresses) != sorted(previous)
+    history = entry.setdefault('history', [])
+    if changed or not history:
+        history.append([int(now), addresses])
+        del history[:-HISTORY_SIZE]
+    entry.update({
+        'ip_address': addresses[0] if addresses else 'Unresolved',
+        'ip_addresses': addresses,
+        'resolver': resolver,
+        'resolved_at': int(now),
+        'ttl': ttl,
+        'failed_at': None,
+    })
+    return changed
+
+
 def resolve_unresolved_entries():
-    """Attempt to resolve unresolved DNS entries."""
+    """
+    Resolve the new DNS entries, then refresh the stale and unresolved ones (oldest first), within the query budget of
+    the run.
+    """
     relays_file = Path(__file__).parent / 'blockfrost_pools_relays.json'
     output_path = Path(__file__).parent / 'output' / 'dns_resolved.json'
     # Create output directory if it doesn't exist
@@ -69,87 +216,86 @@ def resolve_unresolved_entries():
         return
     with open(relays_file, 'r') as f:
         pool_relays = json.load(f)
-    # Build a set for fast lookup: (dns_name, port)
-    existing_keys = set((entry['dns_name'], entry.get('port', DEFAULT_PORT)) for entry in dns_db)
-    # Collect all unique DNS entries from all pools
+    # Index the DNS DB by (dns_name, port)
+    entries = {(entry['dns_name'], entry.get('port', DEFAULT_PORT)): entry for entry in dns_db}
+    refresh = hlp.get_dns_refresh_parameters()
+    now = time.time()
+    # Collect the new DNS entries and the stored ones that are due, from all pools
     seen_dns = set()
-    unresolved_entries = []
+    new_entries = []
+    due_entries = []
     for pool_id, relays in pool_relays.items():
         for relay in relays:
             dns_name = relay.get('dns')
             port = relay.get('port', DEFAULT_PORT)
-            if dns_name:
-                key = (dns_name, port)
-                if key not in seen_dns and key not in existing_keys:
-                    unresolved_entries.append({'dns_name': dns_name, 'pool_id': pool_id, 'port': port})
-                    seen_dns.add(key)
-
-    if not unresolved_entries:
-        logging.info('No new DNS entries to resolve!')
+            key = (dns_name, port)
+            if not dns_name or key in seen_dns:
+                continue
+            seen_dns.add(key)
+            if key not in entries:
+                new_entries.append({'dns_name': dns_name, 'pool_id': pool_id, 'port': port})
+            elif is_due(entries[key], now, refresh['refresh_age_hours'] * 3600,
+                        refresh['unresolved_retry_hours'] * 3600):
+                due_entries.append(entries[key])
+
+    pending = new_entries + sorted(due_entries, key=lambda entry: entry.get('resolved_at') or 0)
+    if not pending:
+        logging.info('No new or stale DNS entries to resolve!')
         return
-    logging.info(f'Attempting to resolve {len(unresolved_entries)} new DNS names from blockfrost_pools_relays.json...')
-    
+    hostnames = list(dict.fromkeys(entry['dns_name'] for entry in pending))
+    deferred = 0
+    if refresh['max_queries'] and len(hostnames) > refresh['max_queries']:
+        hostnames = hostnames[:refresh['max_queries']]
+        selected = set(hostnames)
+        deferred = sum(entry['dns_name'] not in selected for entry in pending)
+        pending = [entry for entry in pending if entry['dns_name'] in selected]
+    logging.info(f'Attempting to resolve {len(hostnames)} DNS names from blockfrost_pools_relays.json '
+                 f'({len(new_entries)} new and {len(due_entries)} stale or unresolved entries, {deferred} deferred '
+                 f'to the next runs)...')
+
     # Track results
     newly_resolved = []
     still_unresolved = []
-    
-    dns_servers = [
-        (None, 'default'),
-        ('8.8.8.8', 'Google DNS'),
-        ('1.1.1.1', 'Cloudflare DNS'),
-    ]
-    
-    for entry in tqdm(unresolved_entries, desc='Resolving DNS', unit='dns'):
-        dns_name = entry['dns_name']
-        pool_id = entry['pool_id']
-        port = entry['port']
-        resolved_ip = None
-        resolver_used = None
-        for dns_server, server_name in dns_servers:
-            resolved_ip = resolve_dns(dns_name, dns_server)
-            if resolved_ip:
-                resolver_used = server_name
-                break
-        if resolved_ip:
-            new_entry = {
-                'dns_name': dns_name,
-                'ip_address': resolved_ip,
-                'pool_id': pool_id,
-                'port': port,
-                'resolver': resolver_used
-            }
-            newly_resolved.append(new_entry)
-            dns_db.append(new_entry)
+    refreshed = []
+    failed_refreshes = []
+    resolver_counts = {}
+
+    results = asyncio.run(resolve_all(hostnames, **hlp.get_dns_resolution_parameters()))
+
+    for entry in pending:
+        key = (entry['dns_name'], entry['port'])
+        resolved_ips, ttl, resolver_used, failed = results[entry['dns_name']]
+        if failed and entry.get('ip_address', 'Unresolved') != 'Unresolved':
+            # No resolver answered: the addresses are kept, and resolved again after unresolved_retry_hours
+            entry['failed_at'] = int(now)
+            failed_refreshes.append(entry)
+            continue
+        addresses_changed = update_entry(entry, resolved_ips, ttl, resolver_used, now)
+        if key in entries:
+            refreshed.append(addresses_changed)
+        else:
+            entries[key] = entry
+            dns_db.append(entry)
+            if resolved_ips:
+                newly_resolved.append(entry)
+        if resolved_ips:
+            resolver_counts[resolver_used] = resolver_counts.get(resolver_used, 0) + 1
         else:
-            unresolved_entry = {
-                'dns_name': dns_name,
-                'ip_address': 'Unresolved',
-                'pool_id': pool_id,
-                'port': port,
-                'resolver': None
-            }
             still_unresolved.append(entry)
-            dns_db.append(unresolved_entry)
-    
+
     # Update data
+    save_dns_db(output_path, dns_db)
     logging.info(f'\nResolution complete!')
     logging.info(f'Newly resolved: {len(newly_resolved)}')
+    logging.info(f'Refreshed: {len(refreshed)} ({sum(refreshed)} with new addresses)')
     logging.info(f'Still unresolved: {len(still_unresolved)}')
-    
-    if newly_resolved:
-        save_dns_db(output_path, dns_db)
-        logging.info(f'\nAppended newly resolved IPs to {output_path}')
+    logging.info(f'Failed refreshes (previous addresses kept): {len(failed_refreshes)}')
+    logging.info(f'\nSaved the DNS entries to {output_path}')
+    if resolver_counts:
         # Show breakdown by DNS server
-        resolver_counts = {}
-        for resolved in newly_resolved:
-            resolver = resolved['resolver']
-            resolver_counts[resolver] = resolver_counts.get(resolver, 0) + 1
         logging.info('\nResolution breakdown:')
         for resolver, count in sorted(resolver_counts.items(), key=lambda x: x[1], reverse=True):
-            logging.info(f'  {resolver}: {count} IPs')
-        logging.info('\n✓ You can now use dns_resolved.json for further processing!')
-    else:
-        logging.info('No new IPs were resolved. All DNS names remain unresolved or already present.')
+            logging.info(f'  {resolver}: {count} entries')
 
 
 def main():
@@ -1,5 +1,6 @@
 import helper as hlp
 import json
+import os
 import time
 import logging
 
@@ -22,14 +23,24 @@ def collect_geodata(layers):
         logging.info(f'JSONDecodeError: {filename}')
         geodata = {}
 
+    cache = hlp.get_geodata_cache()
+    cache.import_file(filename)  # Entries collected before the shared cache was introduced
+
     nodes = hlp.get_nodes(layers)
     logging.info(f'Got {len(nodes)} nodes')
-    for node in nodes:
-        node_ip = node[0]
-        if node_ip not in geodata.keys() and not node_ip.endswith('onion'):
-            geodata[node_ip] = hlp.get_ip_geodata(node_ip)
-            with open(filename, 'w') as f:
-                json.dump(geodata, f, indent=4)
-
+    node_ips = {node[0] for node in nodes if not node[0].endswith('onion')}
+    new_ips = cache.missing(node_ips)
+    if hlp.get_geolocation_batch():
+        logging.info(f'Collecting geodata for {len(new_ips)} new nodes in batches')
+        cache.update(hlp.get_ip_geodata_batch(new_ips))
+    else:
+        for node_ip in new_ips:
+            cache.put(node_ip, hlp.get_ip_geodata(node_ip))
             logging.debug(f'Collected geodata for {node_ip}')
             time.sleep(5)  # Sleep to avoid getting rate limited
+        cache.flush()
+
+    geodata.update(cache.get_many(node_ips))
+    with open(filename.with_suffix('.backup'), 'w') as f:
+        json.dump(geodata, f, indent=4)
+    os.replace(filename.with_suffix('.backup'), filename)
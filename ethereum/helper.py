@@ -4,6 +4,10 @@ import pathlib
 import requests
 import time
 import logging
+import sys
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))  # Root of the repository, for the shared modules
+from shared.geodata_cache import GeodataCache, DEFAULT_TTL_DAYS
+from shared.geolocation import GeolocationClient
 
 logging.basicConfig(format='[%(asctime)s] %(message)s', datefmt='%Y/%m/%d %I:%M:%S %p', level=logging.INFO)
 
@@ -157,6 +161,23 @@ def get_nodes(layers):
     return nodes
 
 
+_geodata_cache = None
+
+
+def get_geodata_cache():
+    """
+    Opens (once) the geodata cache shared by the bitcoin, cardano and ethereum pipelines.
+    :returns: a GeodataCache
+    """
+    global _geodata_cache
+    if _geodata_cache is None:
+        params = get_config_data().get('geodata_cache') or {}
+        path = pathlib.Path(__file__).resolve().parent / params.get('path', '../geodata_cache.db')
+        _geodata_cache = GeodataCache(
+            path, params.get('ttl_days', DEFAULT_TTL_DAYS), params.get('ipv4_prefix'), params.get('ipv6_prefix'))
+    return _geodata_cache
+
+
 def get_ip_geodata(ip_addr):
     """
     Retrieves the node geolocation using ip-api.com or api.ipapi.is.
@@ -181,3 +202,44 @@ def get_ip_geodata(ip_addr):
             logging.error('Geodata rate limited, sleeping for 1 min...')
             time.sleep(60)
     return data
+
+
+def get_geolocation_parameters():
+    """
+    Retrieves the parameters of the geolocation client (base URLs and rate limits of the APIs, number of concurrent lookups), as keyword arguments for GeolocationClient. Parameters missing from the config file fall back to the defaults of the geolocation module.
+    :returns: dictionary
+    """
+    params = get_config_data().get('geolocation') or {}
+    keys = ['ip_api_url', 'ipapi_is_url', 'ip_api_rate', 'ipapi_is_rate', 'ip_api_batch_rate', 'max_workers', 'max_retries', 'max_rate_limited']
+    return {key: params[key] for key in keys if params.get(key) is not None}
+
+
+def get_geolocation_batch():
+    """
+    Retrieves whether new IP addresses are geolocated with the batch endpoint of ip-api.com.
+    :returns: boolean
+    """
+    return bool((get_config_data().get('geolocation') or {}).get('batch', False))
+
+
+_geolocation_client = None
+
+
+def get_geolocation_client():
+    """
+    Creates (once) the client used to geolocate IP addresses, so that all lookups share its connections and rate limits.
+    :returns: a GeolocationClient
+    """
+    global _geolocation_client
+    if _geolocation_client is None:
+        _geolocation_client = GeolocationClient(**get_geolocation_parameters())
+    return _geolocation_client
+
+
+def get_ip_geodata_batch(ip_addrs):
+    """
+    Retrieves the geolocation of many IP addresses with the geolocation client shared with the bitcoin pipeline: the addresses are looked up 100 at a time with the batch endpoint of ip-api.com (max 15 requests per minute), and those for which ip-api.com does not return both an organisation and a country are looked up one by one, all within the rate limits of the APIs.
+    :param ip_addrs: iterable of IP addresses
+    :returns: dictionary mapping each IP address to its geodata (without the addresses that could not be geolocated, which are looked up again at the next run)
+    """
+    return {ip_addr: data for ip_addr, data in get_geolocation_client().lookup_many(ip_addrs, batch=True) if data is not None}
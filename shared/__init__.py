@@ -0,0 +1,4 @@
+"""
+Modules shared by the bitcoin, cardano and ethereum pipelines. Each pipeline adds the root directory of the repository
+to its import path to use them.
+"""
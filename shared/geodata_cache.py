@@ -0,0 +1,211 @@
+"""
+On-disk cache of the geolocation of IP addresses, shared by the bitcoin, cardano and ethereum pipelines.
+
+The cache is a SQLite database with one row per IP address, holding the reply of the geolocation API and the time it
+was fetched. Entries older than the TTL are treated as missing, so that they are fetched again. Since addresses of the
+same network prefix almost always share their country and organisation, an address that is not in the cache can
+optionally reuse the entry of another address of the same prefix: either the route reported by api.ipapi.is or, if
+configured, a fixed-length prefix (e.g. /24 for IPv4).
+
+New entries are buffered in memory and written by the process that owns the cache in one transaction per flush, so the
+database is never left with a partial batch and concurrent runs of the pipelines do not overwrite each other's
+entries.
+"""
+import ipaddress
+import json
+import pathlib
+import sqlite3
+import threading
+import time
+
+DEFAULT_TTL_DAYS = 90
+FLUSH_SIZE = 500  # Number of buffered entries after which put() flushes the cache
+
+
+def get_route(data):
+    """
+    :returns: the network prefix reported by api.ipapi.is for an address, or None
+    """
+    asn = data.get('asn') if isinstance(data, dict) else None
+    if isinstance(asn, dict) and asn.get('route'):
+        try:
+            return ipaddress.ip_network(asn['route'], strict=False)
+        except ValueError:
+            return None
+    return None
+
+
+def candidate_networks(address):
+    """
+    :returns: the networks that contain the address, from the most to the least specific (down to /8 for IPv4 and /16
+    for IPv6)
+    """
+    min_length = 8 if address.version == 4 else 16
+    return [
+        str(ipaddress.ip_network(f'{address}/{length}', strict=False))
+        for length in range(address.max_prefixlen, min_length - 1, -1)
+    ]
+
+
+class GeodataCache(object):
+    """
+    :param path: the path of the SQLite database
+    :param ttl_days: optional, the number of days after which an entry is fetched again
+    :param ipv4_prefix: optional, if set then IPv4 addresses reuse the entries of addresses of the same prefix of this
+    length
+    :param ipv6_prefix: optional, the same for IPv6 addresses
+    """
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS geodata (ip TEXT PRIMARY KEY, data TEXT NOT NULL, fetched_at REAL NOT NULL)',
+        '''CREATE TABLE IF NOT EXISTS prefixes (
+            network TEXT PRIMARY KEY,
+            length INTEGER NOT NULL,
+            ip TEXT NOT NULL,
+            fetched_at REAL NOT NULL)''',
+    ]
+
+    def __init__(self, path, ttl_days=DEFAULT_TTL_DAYS, ipv4_prefix=None, ipv6_prefix=None):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl_days * 86400
+        self.prefix_lengths = {4: ipv4_prefix, 6: ipv6_prefix}
+        self.pending = {}
+        self.pending_times = {}
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection as conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+
+    def is_fresh(self, fetched_at):
+        return fetched_at >= time.time() - self.ttl
+
+    def networks(self, ip, data=None):
+        """
+        :returns: the prefixes whose other addresses can reuse the entry of the given address
+        """
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return []  # e.g. onion addresses
+        networks = []
+        route = get_route(data)
+        if route is not None and address in route:
+            networks.append(route)
+        prefix_length = self.prefix_lengths[address.version]
+        if prefix_length:
+            networks.append(ipaddress.ip_network(f'{ip}/{prefix_length}', strict=False))
+        return networks
+
+    def get(self, ip, reuse_prefix=True):
+        """
+        Retrieves the geodata of an address, if it is in the cache and has not expired.
+        :param ip: the ip address
+        :param reuse_prefix: optional, if set then the entry of another address of the same prefix is returned when the
+        address itself is not in the cache
+        :returns: the geodata, or None
+        """
+        with self.lock:
+            if ip in self.pending:
+                return self.pending[ip]
+            row = self.connection.execute('SELECT data, fetched_at FROM geodata WHERE ip = ?', (ip,)).fetchone()
+            if row is not None and self.is_fresh(row[1]):
+                return json.loads(row[0])
+            if not reuse_prefix:
+                return None
+            try:
+                networks = candidate_networks(ipaddress.ip_address(ip))
+            except ValueError:
+                return None
+            placeholders = ', '.join('?' * len(networks))
+            row = self.connection.execute(
+                'SELECT g.data FROM prefixes p JOIN geodata g ON g.ip = p.ip '
+                f'WHERE p.network IN ({placeholders}) AND g.fetched_at >= ? ORDER BY p.length DESC LIMIT 1',
+                networks + [time.time() - self.ttl]).fetchone()
+            return json.loads(row[0]) if row is not None else None
+
+    def get_many(self, ips, reuse_prefix=True):
+        """
+        :returns: a dictionary mapping the given addresses that are in the cache to their geodata
+        """
+        geodata = {}
+        for ip in ips:
+            data = self.get(ip, reuse_prefix)
+            if data is not None:
+                geodata[ip] = data
+        return geodata
+
+    def missing(self, ips, reuse_prefix=True):
+        """
+        :returns: the given addresses that are not in the cache or whose entry has expired, i.e. those to fetch
+        """
+        return [ip for ip in ips if self.get(ip, reuse_prefix) is None]
+
+    def put(self, ip, data, fetched_at=None):
+        """
+        Adds the geodata of an address to the buffer of entries to write.
+        :param fetched_at: optional, the time (seconds since the epoch) the geodata was fetched; defaults to now
+        """
+        with self.lock:
+            self.pending[ip] = data
+            self.pending_times[ip] = fetched_at or time.time()
+            full = len(self.pending) >= FLUSH_SIZE
+        if full:
+            self.flush()
+
+    def update(self, geodata, fetched_at=None):
+        """
+        Adds the geodata of many addresses and flushes the cache.
+        :param geodata: dictionary mapping ip addresses to their geodata
+        """
+        for ip, data in geodata.items():
+            if data is not None:
+                self.put(ip, data, fetched_at)
+        self.flush()
+
+    def flush(self):
+        """
+        Writes all buffered entries in a single transaction.
+        """
+        with self.lock:
+            if not self.pending:
+                return
+            rows, prefix_rows = [], []
+            for ip, data in self.pending.items():
+                fetched_at = self.pending_times[ip]
+                rows.append((ip, json.dumps(data), fetched_at))
+                for network in self.networks(ip, data):
+                    prefix_rows.append((str(network), network.prefixlen, ip, fetched_at))
+            with self.connection as conn:
+                conn.executemany(
+                    'INSERT INTO geodata (ip, data, fetched_at) VALUES (?, ?, ?) ON CONFLICT (ip) DO UPDATE SET '
+                    'data = excluded.data, fetched_at = excluded.fetched_at '
+                    'WHERE excluded.fetched_at >= geodata.fetched_at', rows)
+                conn.executemany(
+                    'INSERT INTO prefixes (network, length, ip, fetched_at) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (network) DO UPDATE SET ip = excluded.ip, fetched_at = excluded.fetched_at '
+                    'WHERE excluded.fetched_at >= prefixes.fetched_at', prefix_rows)
+            self.pending.clear()
+            self.pending_times.clear()
+
+    def import_file(self, filename):
+        """
+        Imports the entries of a legacy per-ledger geodata JSON file that are not in the cache yet, dated with the
+        modification time of the file.
+        :param filename: the path of the JSON file, mapping ip addresses to geodata
+        """
+        filename = pathlib.Path(filename)
+        try:
+            with open(filename) as f:
+                geodata = json.load(f)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return
+        known = {row[0] for row in self.connection.execute('SELECT ip FROM geodata')}
+        new = {ip: data for ip, data in geodata.items() if ip not in known and isinstance(data, dict)}
+        if new:
+            self.update(new, filename.stat().st_mtime)
+
+    def close(self):
+        self.flush()
+        self.connection.close()
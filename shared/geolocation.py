@@ -0,0 +1,285 @@
+"""
+Rate-limit-aware client for the IP geolocation APIs, shared by the bitcoin, cardano and ethereum pipelines.
+
+Nodes are geolocated with ip-api.com, falling back to api.ipapi.is when ip-api.com does not know the country or the
+organisation of an address. Both providers are free but rate limited (ip-api.com: 45 requests per minute, api.ipapi.is:
+1000 requests per day), so each one gets a token bucket that all lookups share. Lookups run concurrently on a pool of
+threads that reuse the connections of a single HTTP session. When a provider answers that the limit was exceeded, its
+bucket is paused for the time the provider asks for instead of a fixed delay.
+
+In batch mode, addresses are first looked up 100 at a time with the batch endpoint of ip-api.com (15 requests per
+minute); only the addresses whose reply is incomplete are then looked up one by one.
+
+The base URLs of the providers are configurable, so the client can be pointed at a local stub server.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+IP_API_URL = 'http://ip-api.com'
+IPAPI_IS_URL = 'https://api.ipapi.is'
+IP_API_RATE = (45, 60)  # 45 requests per minute
+IP_API_BATCH_RATE = (15, 60)  # 15 batch requests per minute
+IP_API_BATCH_SIZE = 100
+IPAPI_IS_RATE = (1000, 86400)  # 1000 requests per day
+RATE_LIMIT_PAUSE = 60  # Seconds to pause a provider that is rate limited but does not say for how long
+REQUEST_TIMEOUT = 10
+MAX_RETRIES = 3
+MAX_RATE_LIMITED = 10  # "Too many requests" replies after which an address or a batch is given up
+
+
+def fill_org(data):
+    """
+    Uses the AS name as organisation if ip-api.com did not return an organisation but returned an ASN.
+    """
+    if not data.get('org') and data.get('as'):
+        data['org'] = data['as'][data['as'].find(' ')+1:]
+    return data
+
+
+def is_complete(data):
+    """
+    :returns: True if the geodata contains both the organisation and the country of the address
+    """
+    return bool(data) and bool(data.get('org')) and bool(data.get('country'))
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after=None):
+        super().__init__(f'rate limited (retry after {retry_after} secs)')
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket that allows `count` requests every `period` seconds, with bursts of up to `capacity`
+    requests (by default, the whole allowance of a period).
+    """
+
+    def __init__(self, count, period, capacity=None):
+        self.rate = count / period
+        self.capacity = capacity or count
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        if now > self.updated:  # The bucket does not refill while it is paused
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def acquire(self):
+        """
+        Blocks until a request can be made.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Blocks all requests for the given time and empties the bucket (e.g. after a "too many requests" reply).
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.tokens = 0
+            self.updated = self.paused_until
+
+
+class Provider(object):
+    """
+    A geolocation API and the token bucket that limits the requests made to it.
+    """
+
+    def __init__(self, name, url, rate):
+        self.name = name
+        self.url = url.rstrip('/')
+        self.bucket = TokenBucket(*rate)
+
+    def request_url(self, ip_addr):
+        raise NotImplementedError
+
+    def get(self, session, ip_addr):
+        """
+        Retrieves the geodata of an address, waiting for the provider's rate limit.
+        :raises RateLimited: if the provider replied that the rate limit was exceeded (the bucket is then paused)
+        :raises requests.exceptions.RequestException: if the request failed or the reply was not JSON
+        """
+        return self.send(session, self.bucket, 'GET', self.request_url(ip_addr))
+
+    def send(self, session, bucket, method, url, **kwargs):
+        bucket.acquire()
+        r = session.request(method, url, timeout=REQUEST_TIMEOUT, **kwargs)
+        retry_after = self.retry_after(r)
+        if r.status_code == 429 or retry_after is not None:
+            pause = retry_after if retry_after is not None else RATE_LIMIT_PAUSE
+            logging.warning(f'{self.name} rate limited, pausing for {pause} secs')
+            bucket.pause(pause)
+            if r.status_code == 429:
+                raise RateLimited(pause)
+        r.raise_for_status()
+        return r.json()
+
+    def retry_after(self, r):
+        """
+        :returns: the number of seconds the provider asks to wait before the next request, or None
+        """
+        if 'Retry-After' in r.headers:
+            try:
+                return float(r.headers['Retry-After'])
+            except ValueError:
+                return RATE_LIMIT_PAUSE
+        return None
+
+
+class IpApi(Provider):
+    """
+    ip-api.com, which reports the requests left in the current window (X-Rl) and the seconds until it resets (X-Ttl).
+    The batch endpoint has its own, separate limit.
+    """
+
+    def __init__(self, name, url, rate, batch_rate=IP_API_BATCH_RATE):
+        super().__init__(name, url, rate)
+        self.batch_bucket = TokenBucket(*batch_rate)
+
+    def request_url(self, ip_addr):
+        return f'{self.url}/json/{ip_addr}'
+
+    def batch(self, session, ip_addrs):
+        """
+        Retrieves the geodata of up to IP_API_BATCH_SIZE addresses with a single request.
+        :returns: list of replies, in the order of the addresses
+        """
+        return self.send(session, self.batch_bucket, 'POST', f'{self.url}/batch', json=list(ip_addrs))
+
+    def retry_after(self, r):
+        retry_after = super().retry_after(r)
+        if retry_after is None and r.headers.get('X-Rl') == '0':
+            try:
+                return float(r.headers.get('X-Ttl', RATE_LIMIT_PAUSE))
+            except ValueError:
+                return RATE_LIMIT_PAUSE
+        return retry_after
+
+
+class IpApiIs(Provider):
+    def request_url(self, ip_addr):
+        return f'{self.url}/?q={ip_addr}'
+
+
+class GeolocationClient(object):
+    """
+    Geolocates ip addresses using ip-api.com and api.ipapi.is.
+    :param ip_api_url: optional, the base URL of ip-api.com
+    :param ipapi_is_url: optional, the base URL of api.ipapi.is
+    :param ip_api_rate: optional, (requests, seconds) allowed by ip-api.com
+    :param ipapi_is_rate: optional, (requests, seconds) allowed by api.ipapi.is
+    :param ip_api_batch_rate: optional, (requests, seconds) allowed by the batch endpoint of ip-api.com
+    :param max_workers: optional, the maximum number of concurrent lookups
+    :param max_retries: optional, the number of failed requests (other than rate limiting) after which an address is
+    given up
+    :param max_rate_limited: optional, the number of "too many requests" replies after which an address (or a batch) is
+    given up
+    """
+
+    def __init__(self, ip_api_url=IP_API_URL, ipapi_is_url=IPAPI_IS_URL, ip_api_rate=IP_API_RATE,
+                 ipapi_is_rate=IPAPI_IS_RATE, ip_api_batch_rate=IP_API_BATCH_RATE, max_workers=8,
+                 max_retries=MAX_RETRIES, max_rate_limited=MAX_RATE_LIMITED):
+        self.ip_api = IpApi('ip-api.com', ip_api_url, ip_api_rate, ip_api_batch_rate)
+        self.ipapi_is = IpApiIs('api.ipapi.is', ipapi_is_url, ipapi_is_rate)
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.max_rate_limited = max_rate_limited
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def lookup(self, ip_addr, ip_api_data=None):
+        """
+        Retrieves the geolocation of an address.
+        :param ip_addr: the ip address
+        :param ip_api_data: optional, the reply of ip-api.com for the address (e.g. from a batch request), in which case
+        ip-api.com is not queried again
+        :returns: the geolocation information, or None if it could not be retrieved
+        """
+        failures, rate_limited = 0, 0
+        while failures < self.max_retries and rate_limited < self.max_rate_limited:
+            try:
+                data = ip_api_data or fill_org(self.ip_api.get(self.session, ip_addr))
+                if not is_complete(data):
+                    data = self.ipapi_is.get(self.session, ip_addr)
+                if 'error' not in data:
+                    return data
+                logging.debug(f'Geodata error for {ip_addr}: {data["error"]}')
+            except RateLimited:
+                rate_limited += 1  # The bucket of the provider was paused, so there is no need to back off here
+                continue
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logging.debug(f'Geodata request for {ip_addr} failed: {e}')
+            failures += 1
+            time.sleep(2 ** failures)
+        logging.warning(f'Could not retrieve the geodata of {ip_addr}')
+        return None
+
+    def lookup_batches(self, ip_addrs):
+        """
+        Retrieves the replies of ip-api.com for many addresses using its batch endpoint.
+        :param ip_addrs: iterable of ip addresses
+        :returns: generator of (ip address, reply) pairs. The reply is None for the addresses of batches that failed.
+        """
+        ip_addrs = list(ip_addrs)
+        for i in range(0, len(ip_addrs), IP_API_BATCH_SIZE):
+            batch = ip_addrs[i:i + IP_API_BATCH_SIZE]
+            replies, failures, rate_limited = None, 0, 0
+            while replies is None and failures < self.max_retries and rate_limited < self.max_rate_limited:
+                try:
+                    replies = self.ip_api.batch(self.session, batch)
+                except RateLimited:
+                    rate_limited += 1
+                    continue
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    logging.debug(f'Geodata batch request failed: {e}')
+                    failures += 1
+                    time.sleep(2 ** failures)
+            if not isinstance(replies, list) or len(replies) != len(batch):
+                logging.warning(f'Could not retrieve the geodata of a batch of {len(batch)} addresses')
+                replies = [None] * len(batch)
+            for ip_addr, data in zip(batch, replies):
+                yield ip_addr, fill_org(data) if isinstance(data, dict) else None
+
+    def lookup_many(self, ip_addrs, batch=False):
+        """
+        Geolocates addresses concurrently, within the rate limits of the providers.
+        :param ip_addrs: iterable of ip addresses
+        :param batch: optional, if set then the addresses are first looked up with the batch endpoint of ip-api.com, and
+        only those with an incomplete reply are looked up one by one
+        :returns: generator of (ip address, geolocation information or None) pairs, in order of completion
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            if batch:
+                for ip_addr, data in self.lookup_batches(ip_addrs):
+                    if is_complete(data):
+                        yield ip_addr, data
+                    else:
+                        futures[executor.submit(self.lookup, ip_addr, data)] = ip_addr
+            else:
+                futures = {executor.submit(self.lookup, ip_addr): ip_addr for ip_addr in ip_addrs}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def close(self):
+        self.session.close()
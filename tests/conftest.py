@@ -0,0 +1,11 @@
+"""
+The tests import the shared modules from the root of the repository, the bitcoin package from bitcoin/ and the cardano
+scripts from cardano/, as the pipelines do when they run from their own folder.
+"""
+import pathlib
+import sys
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parent.parent
+for path in [ROOT_DIR, ROOT_DIR / 'bitcoin', ROOT_DIR / 'cardano']:
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
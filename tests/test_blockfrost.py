@@ -0,0 +1,149 @@
+"""
+Tests of the Blockfrost client of the cardano pipeline against a local stub of the Blockfrost API.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+import collect
+
+POOLS = [{'pool_id': f'pool{idx}', 'declared_pledge': '100', 'margin_cost': 0.01, 'fixed_cost': '340',
+          'metadata': {'hash': f'hash{idx}'}} for idx in range(3)]
+RELAYS = {pool['pool_id']: [{'ipv4': f'192.0.2.{idx}', 'dns': None, 'port': 3001}] for idx, pool in enumerate(POOLS)}
+
+
+class StubBlockfrostHandler(BaseHTTPRequestHandler):
+    """
+    Serves /pools/extended and /pools/<pool>/relays from POOLS and RELAYS. The first rate_limited[path] requests to a
+    path are answered with 429.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        server = self.server
+        with server.lock:
+            server.requests.append(url.path)
+            rate_limited = server.rate_limited.get(url.path, 0) > 0
+            if rate_limited:
+                server.rate_limited[url.path] -= 1
+        if self.headers.get('project_id') != 'key':
+            return self.reply(403, {'error': 'Forbidden'})
+        if rate_limited:
+            return self.reply(429, {'error': 'Project Over Limit'}, {'Retry-After': '0'})
+        if url.path == '/pools/extended':
+            query = parse_qs(url.query)
+            page, count = int(query['page'][0]), int(query['count'][0])
+            return self.reply(200, POOLS[(page - 1) * count:page * count])
+        parts = url.path.strip('/').split('/')
+        if len(parts) == 3 and parts[0] == 'pools' and parts[2] == 'relays' and parts[1] in RELAYS:
+            return self.reply(200, RELAYS[parts[1]])
+        self.reply(404, {'error': 'Not Found'})
+
+    def reply(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def stub_blockfrost(monkeypatch):
+    monkeypatch.setattr(collect, 'BACKOFF_BASE', 0.01)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubBlockfrostHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = []
+    server.rate_limited = {}
+    server.url = f'http://127.0.0.1:{server.server_port}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_client(server, max_retries=collect.MAX_RETRIES):
+    return collect.BlockfrostClient('key', url=server.url, rate=1000, burst=100, max_workers=4,
+                                    max_retries=max_retries)
+
+
+def test_rate_limited_request_is_retried(stub_blockfrost):
+    stub_blockfrost.rate_limited['/pools/pool0/relays'] = 2
+    client = make_client(stub_blockfrost)
+    assert client.get_pool_relays('pool0') == RELAYS['pool0']
+    assert stub_blockfrost.requests == ['/pools/pool0/relays'] * 3
+    assert client.bucket.paused_until > 0  # The other requests were held back too
+
+
+def test_rate_limited_request_is_given_up(stub_blockfrost):
+    stub_blockfrost.rate_limited['/pools/pool0/relays'] = 10
+    client = make_client(stub_blockfrost, max_retries=2)
+    assert client.get_pool_relays('pool0') is None
+    assert len(stub_blockfrost.requests) == 3
+
+
+def test_get_all_pools(stub_blockfrost, monkeypatch):
+    monkeypatch.setattr(collect, 'PAGE_SIZE', 2)
+    stub_blockfrost.rate_limited['/pools/extended'] = 1
+    assert make_client(stub_blockfrost).get_all_pools() == POOLS
+
+
+@pytest.fixture
+def run_dir(stub_blockfrost, tmp_path, monkeypatch):
+    """
+    Runs collect.main in a temporary directory, against the stub.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('BLOCKFROST_API_KEY', 'key')
+    monkeypatch.setattr(collect.hlp, 'get_output_directory', lambda: tmp_path / 'output')
+    monkeypatch.setattr(collect.hlp, 'get_blockfrost_parameters',
+                        lambda: {'url': stub_blockfrost.url, 'rate': 1000, 'burst': 100, 'max_workers': 4})
+    monkeypatch.setattr(collect.hlp, 'get_relay_snapshot_parameters',
+                        lambda: {'incremental': True, 'max_age_days': 14})
+    (tmp_path / 'output').mkdir()
+    return tmp_path
+
+
+def test_resume_from_checkpoint(stub_blockfrost, run_dir):
+    checkpoint_path = run_dir / 'output' / 'blockfrost_checkpoint.json'
+    fingerprints = {pool['pool_id']: collect.get_fingerprint(pool) for pool in POOLS}
+    collect.save_checkpoint(checkpoint_path, {
+        'started_at': time.time(), 'fingerprints': fingerprints, 'targets': list(fingerprints),
+        'relays': {'pool0': RELAYS['pool0']},
+    })
+    stub_blockfrost.rate_limited['/pools/pool2/relays'] = 1
+
+    collect.main()
+
+    # Neither the pool list nor the relays fetched before the interruption are requested again
+    assert sorted(set(stub_blockfrost.requests)) == ['/pools/pool1/relays', '/pools/pool2/relays']
+    with open(run_dir / 'blockfrost_pools_relays.json') as f:
+        assert json.load(f) == RELAYS
+    assert not checkpoint_path.exists()
+    snapshot = collect.load_latest_snapshot(run_dir / 'output' / 'relay_snapshots')
+    assert snapshot['version'] == 1 and sorted(snapshot['refetched']) == sorted(RELAYS)
+
+
+def test_stale_checkpoint_is_ignored(stub_blockfrost, run_dir, monkeypatch):
+    monkeypatch.setattr(collect, 'PAGE_SIZE', 10)
+    checkpoint_path = run_dir / 'output' / 'blockfrost_checkpoint.json'
+    collect.save_checkpoint(checkpoint_path, {
+        'started_at': time.time() - collect.CHECKPOINT_MAX_AGE - 1, 'fingerprints': {}, 'targets': [], 'relays': {},
+    })
+
+    collect.main()
+
+    assert '/pools/extended' in stub_blockfrost.requests
+    with open(run_dir / 'blockfrost_pools_relays.json') as f:
+        assert json.load(f) == RELAYS
@@ -0,0 +1,123 @@
+"""
+Tests of the resolution of the DNS seeds against a local stub DNS server.
+"""
+import socketserver
+import threading
+import time
+import types
+
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+import pytest
+
+from network_decentralization import dns_seeds
+from network_decentralization.dns_seeds import SeedResolver
+
+ZONE = {
+    ('seed1.test.', 'A'): (['192.0.2.1', '192.0.2.2'], 1),
+    ('seed1.test.', 'AAAA'): (['2001:db8::1'], 1),
+    ('seed2.test.', 'A'): (['192.0.2.3'], 3600),
+}
+NAMES = ['seed1.test', 'seed2.test', 'missing.test']
+SEED1_ADDRESSES = ['192.0.2.1', '192.0.2.2', '2001:db8::1']
+
+
+class StubDnsHandler(socketserver.BaseRequestHandler):
+    """
+    Answers the queries from ZONE after the delay of the server (NXDOMAIN for unknown names, no answer for the other
+    record types of known names), or not at all if the server is down.
+    """
+
+    def handle(self):
+        data, sock = self.request
+        query = dns.message.from_wire(data)
+        question = query.question[0]
+        name, rdtype = question.name.to_text(), dns.rdatatype.to_text(question.rdtype)
+        server = self.server
+        with server.lock:
+            server.queries.append((name, rdtype))
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        time.sleep(server.delay)
+        with server.lock:
+            server.in_flight -= 1
+        if server.down:
+            return
+        response = dns.message.make_response(query)
+        if (name, rdtype) in ZONE:
+            addresses, ttl = ZONE[(name, rdtype)]
+            response.answer.append(dns.rrset.from_text(name, ttl, 'IN', rdtype, *addresses))
+        elif not any(key[0] == name for key in ZONE):
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        sock.sendto(response.to_wire(), self.client_address)
+
+
+@pytest.fixture
+def stub_dns():
+    server = socketserver.ThreadingUDPServer(('127.0.0.1', 0), StubDnsHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.queries = []
+    server.in_flight = server.max_in_flight = 0
+    server.delay = 0
+    server.down = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def move_clock(monkeypatch, seconds):
+    """
+    Moves the clock of the cache forward, without affecting the timeouts of the queries.
+    """
+    monkeypatch.setattr(dns_seeds, 'time', types.SimpleNamespace(time=lambda: time.time() + seconds))
+
+
+def make_resolver(server, cache_path):
+    host, port = server.server_address
+    return SeedResolver(cache_path, nameservers=[host], port=port, timeout=1)
+
+
+def test_resolve_many_queries_a_and_aaaa_concurrently(stub_dns, tmp_path):
+    stub_dns.delay = 0.3
+    start = time.monotonic()
+    addresses = make_resolver(stub_dns, tmp_path / 'dns_seeds.json').resolve_many(NAMES)
+    elapsed = time.monotonic() - start
+
+    assert {name: sorted(name_addresses) for name, name_addresses in addresses.items()} == {
+        'seed1.test': SEED1_ADDRESSES,
+        'seed2.test': ['192.0.2.3'],
+        'missing.test': [],
+    }
+    assert sorted(stub_dns.queries) == sorted(
+        (f'{name}.', rdtype) for name in NAMES for rdtype in dns_seeds.RECORD_TYPES)
+    assert stub_dns.max_in_flight > 1
+    assert elapsed < len(stub_dns.queries) * stub_dns.delay / 2
+
+
+def test_cached_answers_expire_with_their_ttl(stub_dns, tmp_path, monkeypatch):
+    cache_path = tmp_path / 'dns_seeds.json'
+    make_resolver(stub_dns, cache_path).resolve_many(NAMES)
+    assert len(stub_dns.queries) == 6
+
+    stub_dns.queries.clear()
+    resolver = make_resolver(stub_dns, cache_path)  # The cache is persisted between runs
+    assert sorted(resolver.resolve_many(NAMES)['seed1.test']) == SEED1_ADDRESSES
+    assert stub_dns.queries == []
+
+    move_clock(monkeypatch, 10)
+    resolver.resolve_many(NAMES)
+    assert sorted(stub_dns.queries) == [('seed1.test.', 'A'), ('seed1.test.', 'AAAA')]  # Only the TTLs of 1 sec expired
+
+
+def test_failed_query_keeps_expired_answer(stub_dns, tmp_path, monkeypatch):
+    resolver = make_resolver(stub_dns, tmp_path / 'dns_seeds.json')
+    resolver.resolve_many(['seed1.test'])
+
+    stub_dns.down = True
+    move_clock(monkeypatch, 10)
+    assert sorted(resolver.resolve_many(['seed1.test'])['seed1.test']) == SEED1_ADDRESSES
@@ -0,0 +1,68 @@
+"""
+Tests of the geolocation client against a local stub of ip-api.com that is always rate limited.
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from shared.geolocation import GeolocationClient
+
+
+class RateLimitedHandler(BaseHTTPRequestHandler):
+    requests = 0
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self):
+        type(self).requests += 1
+        body = json.dumps({'status': 'fail', 'message': 'too many requests'}).encode()
+        self.send_response(429)
+        self.send_header('Retry-After', '0')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = reply
+    do_POST = reply
+
+
+@pytest.fixture
+def stub_url():
+    RateLimitedHandler.requests = 0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RateLimitedHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+
+def make_client(url):
+    fast = (100, 1)  # The buckets are emptied by each "too many requests" reply, so they must refill quickly
+    return GeolocationClient(ip_api_url=url, ipapi_is_url=url, ip_api_rate=fast, ipapi_is_rate=fast,
+                             ip_api_batch_rate=fast, max_workers=2, max_rate_limited=4)
+
+
+def test_lookup_gives_up_when_always_rate_limited(stub_url):
+    client = make_client(stub_url)
+    assert client.lookup('192.0.2.1') is None
+    assert RateLimitedHandler.requests == 4
+    client.close()
+
+
+def test_lookup_batches_gives_up_when_always_rate_limited(stub_url):
+    client = make_client(stub_url)
+    replies = list(client.lookup_batches(['192.0.2.1', '192.0.2.2']))
+    assert replies == [('192.0.2.1', None), ('192.0.2.2', None)]
+    assert RateLimitedHandler.requests == 4
+    client.close()
+
+
+def test_lookup_many_ends_when_always_rate_limited(stub_url):
+    client = make_client(stub_url)
+    results = dict(client.lookup_many(['192.0.2.1', '192.0.2.2'], batch=True))
+    assert results == {'192.0.2.1': None, '192.0.2.2': None}
+    client.close()
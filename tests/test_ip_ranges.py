@@ -0,0 +1,23 @@
+"""
+Tests of the offline resolution of IP addresses from a table of IP ranges.
+"""
+import io
+
+from network_decentralization.ip_ranges import IpRangeIndex
+
+IP2ASN = '\n'.join([
+    '192.0.2.0\t192.0.2.255\t64500\tGR\tEXAMPLE-NET',
+    '192.0.2.128\t192.0.2.191\t64501\tNone\tNO-COUNTRY',
+    '198.51.100.0\t198.51.100.255\t64502\tDE\t',
+    '203.0.113.0\t203.0.113.255\t0\tNone\tNot routed',
+])
+
+
+def test_incomplete_records_are_not_resolved():
+    index = IpRangeIndex(IpRangeIndex.read_ip2asn(io.StringIO(IP2ASN)))
+    assert index.lookup('192.0.2.1') == {'country': 'GR', 'org': 'EXAMPLE-NET', 'as': 'AS64500 EXAMPLE-NET',
+                                         'source': 'ip_ranges'}
+    assert index.lookup('192.0.2.130') is None  # Not resolved to the enclosing range either
+    assert index.lookup('192.0.2.200')['org'] == 'EXAMPLE-NET'
+    assert index.lookup('198.51.100.1') is None
+    assert index.lookup('203.0.113.1') is None
@@ -0,0 +1,185 @@
+"""
+Tests of the connections made through a SOCKS5 proxy (Tor) against a local stub proxy, behind which a stub node
+answers the handshake and getaddr.
+"""
+import asyncio
+import socket
+import socketserver
+import struct
+import threading
+
+import pytest
+
+from network_decentralization import collect
+from network_decentralization import protocol as network_proto
+
+ONION = 'pg6mmjiyjmcrsslvykfwnntlaru7p5svn6y2ymmju6nubxndf4pscryd.onion'
+PORT = 8333
+ADDR_LIST = [(1700000000, 1, f'192.0.2.{idx}', 8333) for idx in range(1, 4)]
+
+
+def read_exactly(sock, length):
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+class StubProxyHandler(socketserver.BaseRequestHandler):
+    """
+    SOCKS5 proxy without authentication that, depending on the mode of the server, rejects the greeting, fails the
+    CONNECT or answers as the node requested.
+    """
+
+    def handle(self):
+        sock = self.request
+        try:
+            read_exactly(sock, 3)
+            if self.server.mode == 'reject':
+                sock.sendall(b'\x05\xff')
+                return
+            sock.sendall(b'\x05\x00')
+            read_exactly(sock, 4)
+            host = read_exactly(sock, read_exactly(sock, 1)[0]).decode()
+            port, = struct.unpack('>H', read_exactly(sock, 2))
+            self.server.requests.append((host, port))
+            if self.server.mode == 'connect_fail':
+                sock.sendall(b'\x05\x04\x00\x01' + bytes(6))  # Host unreachable
+                return
+            sock.sendall(b'\x05\x00\x00\x01' + bytes(6))
+            self.serve_node(sock)
+        except (EOFError, OSError):
+            pass
+
+    @staticmethod
+    def serve_node(sock):
+        serializer = network_proto.Serializer()
+        data = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return
+            data += chunk
+            while True:
+                try:
+                    msg, data = serializer.deserialize_msg(data)
+                except (network_proto.HeaderTooShortError, network_proto.PayloadTooShortError):
+                    break
+                if msg['command'] == b'version':
+                    sock.sendall(serializer.serialize_msg(command=b'version', to_addr=('192.0.2.9', PORT),
+                                                          from_addr=('0.0.0.0', 0))
+                                 + serializer.serialize_msg(command=b'verack'))
+                elif msg['command'] == b'getaddr':
+                    sock.sendall(serializer.serialize_msg(command=b'addr', addr_list=ADDR_LIST))
+                elif msg['command'] == b'ping':
+                    sock.sendall(serializer.serialize_msg(command=b'pong', nonce=msg['nonce']))
+
+
+@pytest.fixture
+def stub_proxy():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), StubProxyHandler)
+    server.daemon_threads = True
+    server.mode = 'ok'
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def connection_conf(proxy):
+    return dict(proxy=proxy, connect_timeout=5, handshake_timeout=5, getaddr_timeout=5,
+                getaddr_max_addrs=len(ADDR_LIST))
+
+
+async def crawl_async(proxy):
+    conn = network_proto.AsyncConnection((ONION, PORT), **connection_conf(proxy))
+    try:
+        await conn.open()
+        version_msg = await conn.handshake()
+        addr_msgs = await conn.getaddr()
+    finally:
+        await conn.close()
+    return version_msg, addr_msgs
+
+
+def crawl_sync(proxy):
+    conn = network_proto.Connection((ONION, PORT), **connection_conf(proxy))
+    try:
+        conn.open()
+        version_msg = conn.handshake()
+        addr_msgs = conn.getaddr()
+    finally:
+        conn.close()
+    return version_msg, addr_msgs
+
+
+def crawl_asyncio(proxy):
+    return asyncio.run(crawl_async(proxy))
+
+
+CRAWLS = [crawl_sync, crawl_asyncio]
+
+
+@pytest.mark.parametrize('crawl', CRAWLS)
+def test_handshake_through_proxy(stub_proxy, crawl):
+    version_msg, addr_msgs = crawl(stub_proxy.server_address)
+    assert version_msg['command'] == b'version'
+    assert sum(len(msg['addr_list']) for msg in addr_msgs) == len(ADDR_LIST)
+    assert stub_proxy.requests == [(ONION, PORT)]  # The onion address is resolved by the proxy
+
+
+@pytest.mark.parametrize('crawl', CRAWLS)
+def test_greeting_rejected(stub_proxy, crawl):
+    stub_proxy.mode = 'reject'
+    with pytest.raises(network_proto.ProxyUnavailable):
+        crawl(stub_proxy.server_address)
+
+
+@pytest.mark.parametrize('crawl', CRAWLS)
+def test_proxy_down(closed_port, crawl):
+    with pytest.raises(network_proto.ProxyUnavailable):
+        crawl(('127.0.0.1', closed_port))
+
+
+@pytest.mark.parametrize('crawl', CRAWLS)
+def test_target_unreachable_is_not_proxy_failure(stub_proxy, crawl):
+    stub_proxy.mode = 'connect_fail'
+    with pytest.raises(network_proto.ConnectionError) as info:
+        crawl(stub_proxy.server_address)
+    assert not isinstance(info.value, network_proto.ProxyUnavailable)
+
+
+@pytest.fixture
+def tor_proxy(monkeypatch):
+    def use(address):
+        monkeypatch.setattr(collect.hlp, 'get_tor_parameters',
+                            lambda: {'proxy': list(address), 'handshake_timeout': 5, 'getaddr_timeout': 5})
+        monkeypatch.setattr(collect.hlp, 'get_connection_parameters', lambda: {'getaddr_max_addrs': len(ADDR_LIST)})
+    return use
+
+
+def test_crawl_onion_node(stub_proxy, tor_proxy):
+    tor_proxy(stub_proxy.server_address)
+    observation, connect_time = asyncio.run(collect.get_node_addresses_async('bitcoin', ONION, PORT, 5))
+    assert connect_time is not None
+    assert len(observation['addresses']) == len(ADDR_LIST)
+
+
+def test_crawl_onion_node_proxy_down(closed_port, tor_proxy):
+    tor_proxy(('127.0.0.1', closed_port))
+    assert asyncio.run(collect.get_node_addresses_async('bitcoin', ONION, PORT, 5)) == (None, None)
+    assert collect.get_node_addresses('bitcoin', ONION, PORT, 5) == (None, None)